@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Measure the time Log takes to handle a CHAN_LOGDATA packet, by driving
+Log._new_packet_cb with synthetic packets for several log blocks. The same
+packets are also handled the way it was done before the blocks were indexed
+by id: the payload rebuilt from datal and the block found by walking
+log_blocks.
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "crazyflieROS"))
+
+from optparse import OptionParser
+import struct, timeit
+
+from cflib.crazyflie.log import Log, LogConfig, CHAN_LOGDATA
+from cflib.crtp.crtpstack import CRTPPacket, CRTPPort
+
+
+class FakeCrazyflie(object):
+    """ Just enough of a Crazyflie to create a Log """
+    link = True
+
+    def add_port_callback(self, port, cb):
+        pass
+
+
+class FakeToc(object):
+    """ TOC knowing every variable """
+    def get_element_by_complete_name(self, name):
+        return True
+
+
+def scan_packet_cb(log, packet):
+    """ Handle a CHAN_LOGDATA packet like _new_packet_cb did before """
+    payload = struct.pack("B" * (len(packet.datal) - 1), *packet.datal[1:])
+    id = packet.datal[0]
+    block = None
+    for b in log.log_blocks:
+        if b.id == id:
+            block = b
+            break
+    timestamps = struct.unpack("<BBB", packet.data[1:4])
+    timestamp = (timestamps[0] | timestamps[1] << 8 | timestamps[2] << 16)
+    block.unpack_log_data(packet.data[4:], timestamp)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-b", "--blocks", type="int", default=8, help="Log blocks [default: %default]")
+    parser.add_option("-v", "--variables", type="int", default=7, help="Float variables per block [default: %default]")
+    parser.add_option("-n", "--count", type="int", default=20000, help="Rounds of one packet per block [default: %default]")
+    (options, args) = parser.parse_args()
+
+    log = Log(FakeCrazyflie())
+    log._toc = FakeToc()
+    packets = []
+    for i in xrange(options.blocks):
+        lc = LogConfig("block%d" % i, 10)
+        for j in xrange(options.variables):
+            lc.add_variable("group.var%d" % j, "float")
+        log.add_config(lc)
+        lc.data_received_cb.add_callback(lambda ts, data, logconf: None)
+        pk = CRTPPacket()
+        pk.set_header(CRTPPort.LOGGING, CHAN_LOGDATA)
+        pk.data = struct.pack("<BBBB", lc.id, 1, 2, 3) + struct.pack("<%df" % options.variables, *range(options.variables))
+        packets.append(pk)
+
+    def run(handle):
+        for pk in packets:
+            handle(pk)
+
+    for name, handle in (("scan", lambda pk: scan_packet_cb(log, pk)), ("indexed", log._new_packet_cb)):
+        elapsed = timeit.timeit(lambda: run(handle), number=options.count)
+        print "%-8s %6.2f us/packet" % (name, elapsed / options.count / len(packets) * 1e6)
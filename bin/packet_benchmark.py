@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Measure the cost of a received CRTPPacket: building it from the data read
+from the USB dongle and reading its data, datal and datat, and the memory
+each packet keeps. The same is done with a copy of the previous packet, which
+stored the payload as a str and converted it with struct on every access.
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "crazyflieROS"))
+
+from optparse import OptionParser
+import array, struct, timeit
+
+from cflib.crtp.crtpstack import CRTPPacket
+
+
+class StrPacket(object):
+    """ The str backed CRTPPacket, only what is used on received packets """
+
+    def __init__(self, header=0, data=None):
+        self.size = 0
+        self._data = ""
+        self.header = header | 0x3 << 2
+        self._port = (header & 0xF0) >> 4
+        self._channel = header & 0x03
+        if data:
+            self._set_data(data)
+
+    def _get_data(self):
+        return self._data
+
+    def _set_data(self, data):
+        if type(data) == str:
+            self._data = data
+        elif len(data) == 1:
+            self._data = struct.pack("B", data[0])
+        elif len(data) > 1:
+            self._data = struct.pack("B" * len(data), *data)
+        else:
+            self._data = ""
+
+    def _get_data_l(self):
+        return list(self._get_data_t())
+
+    def _get_data_t(self):
+        return struct.unpack("B" * len(self._data), self._data)
+
+    data = property(_get_data, _set_data)
+    datal = property(_get_data_l, _set_data)
+    datat = property(_get_data_t, _set_data)
+
+
+def str_packet(raw):
+    """ Received packet, the way the radio driver built it before """
+    return StrPacket(raw[0], list(raw[1:]))
+
+
+def crtp_packet(raw):
+    """ Received packet, the way the radio driver builds it now """
+    return CRTPPacket(raw[0], buffer(raw, 1))
+
+
+def size_of(pk):
+    """ Bytes held by a packet and its payload """
+    size = sys.getsizeof(pk)
+    if hasattr(pk, "__dict__"):
+        size += sys.getsizeof(pk.__dict__) + sys.getsizeof(pk._data)
+    else:
+        size += sys.getsizeof(pk._buf)
+    return size
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-s", "--size", type="int", default=31, help="Payload bytes per packet [default: %default]")
+    parser.add_option("-n", "--count", type="int", default=100000, help="Packets per measurement [default: %default]")
+    (options, args) = parser.parse_args()
+
+    raw = array.array('B', [0x52] + [i & 0xFF for i in xrange(options.size)])
+
+    for name, build in (("str", str_packet), ("bytearray", crtp_packet)):
+        def receive():
+            pk = build(raw)
+            pk.datat
+            pk.datal
+            pk.data
+        elapsed = timeit.timeit(receive, number=options.count)
+        print "%-10s %5.2f us/packet, %3d bytes/packet" % (
+            name, elapsed / options.count * 1e6, size_of(build(raw)))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Compare the queue backends of the radio driver. A producer thread puts
+packets at a fixed rate (or as fast as it can) and the consumer measures the
+latency of each packet, the same way the radio thread and the incoming packet
+handler use the queues. Note that the out queue of the radio driver is a
+PriorityOutQueue unless RadioDriver.priority_out_queue is cleared, so by
+default the backend only applies to the incoming packets.
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "crazyflieROS"))
+
+from optparse import OptionParser
+import threading, time, Queue
+
+from cflib.crtp.crtpstack import CRTPPacket
+from cflib.crtp.ringbuffer import RingBuffer
+
+
+def run(q, count, rate, timeout):
+    """ Pass count packets through q at rate packets/s (0 for no limit), return (seconds, sorted latencies) """
+    def produce():
+        period = 1.0/rate if rate else 0
+        t = time.time()
+        for i in xrange(count):
+            if period:
+                t += period
+                d = t - time.time()
+                if d > 0:
+                    time.sleep(d)
+            q.put((time.time(), CRTPPacket(0x52, "0123456789")))
+        q.put(None)
+
+    latencies = []
+    producer = threading.Thread(target=produce)
+    start = time.time()
+    producer.start()
+    while True:
+        try:
+            item = q.get(True, timeout)
+        except Queue.Empty:
+            continue
+        if item is None:
+            break
+        latencies.append(time.time()-item[0])
+    elapsed = time.time() - start
+    producer.join()
+    latencies.sort()
+    return elapsed, latencies
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-r", "--rate", type="int", default=1000, help="Packets per second for the latency test [default: %default]")
+    parser.add_option("-n", "--count", type="int", default=5000, help="Packets for the latency test [default: %default]")
+    parser.add_option("-t", "--timeout", type="float", default=1, help="Timeout of the blocking gets, as used by the incoming packet handler [default: %default]")
+    (options, args) = parser.parse_args()
+
+    backends = [("Queue.Queue", lambda: Queue.Queue(1000)), ("RingBuffer", lambda: RingBuffer(1000))]
+    for name, make in backends:
+        elapsed, lat = run(make(), options.count, options.rate, options.timeout)
+        print "%-12s %5d pk/s: latency median %6.0f us, 99%% %6.0f us, max %6.0f us" % (
+            name, options.rate, lat[len(lat)/2]*1e6, lat[int(len(lat)*0.99)]*1e6, lat[-1]*1e6)
+    for name, make in backends:
+        elapsed, lat = run(make(), options.count*20, 0, options.timeout)
+        print "%-12s throughput %8.0f pk/s" % (name, options.count*20/elapsed)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Test the serial link driver against a pty pair. The other end of the pty
+echoes the bytes it receives back, at most at the given baudrate (10 bits per
+byte) to simulate the UART. Reports the round trip time of single packets and
+the throughput of a stream of packets.
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "crazyflieROS"))
+
+from optparse import OptionParser
+import threading, time
+
+from cflib.crtp.serialdriver import SerialDriver
+from cflib.crtp.crtpstack import CRTPPacket
+
+
+def echo(fd, baudrate, stop):
+    """ Echo the bytes read from fd back, paced at baudrate """
+    rate = baudrate / 10.0
+    t = time.time()
+    try:
+        while not stop.is_set():
+            data = os.read(fd, 4096)
+            t = max(t, time.time()) + len(data) / rate
+            d = t - time.time()
+            if d > 0:
+                time.sleep(d)
+            while data:
+                data = data[os.write(fd, data):]
+    except OSError:
+        # The pty was closed
+        pass
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-b", "--baudrate", type="int", default=1000000, help="Simulated UART baudrate [default: %default]")
+    parser.add_option("-n", "--count", type="int", default=20000, help="Packets for the throughput test [default: %default]")
+    parser.add_option("-s", "--size", type="int", default=30, help="Data bytes per packet [default: %default]")
+    (options, args) = parser.parse_args()
+
+    (master, slave) = os.openpty()
+    stop = threading.Event()
+    echoer = threading.Thread(target=echo, args=(master, options.baudrate, stop))
+    echoer.setDaemon(True)
+    echoer.start()
+
+    errors = []
+    driver = SerialDriver()
+    driver.connect("serial://%s?baud=%d" % (os.ttyname(slave), options.baudrate), None, errors.append)
+
+    latencies = []
+    for i in xrange(1000):
+        t = time.time()
+        driver.send_packet(CRTPPacket(0x30, [i & 0xFF] * 3))
+        pk = driver.receive_packet(1)
+        latencies.append(time.time() - t)
+        if pk is None or pk.datal != [i & 0xFF] * 3:
+            raise Exception("Packet %d lost or corrupted: %s" % (i, pk))
+    latencies.sort()
+    print "round trip: median %6.0f us, 99%% %6.0f us, max %6.0f us" % (
+        latencies[500]*1e6, latencies[990]*1e6, latencies[-1]*1e6)
+
+    received = [0]
+    def receive():
+        while received[0] < options.count:
+            pk = driver.receive_packet(2)
+            if pk is None:
+                break
+            received[0] += 1
+    receiver = threading.Thread(target=receive)
+    start = time.time()
+    receiver.start()
+    for i in xrange(options.count):
+        driver.send_packet(CRTPPacket(0x50, [i & 0xFF] * options.size))
+    receiver.join()
+    elapsed = time.time() - start
+    # Header, data, checksum, COBS code and frame end
+    frame = options.size + 4
+    print "throughput: %d/%d packets, %.0f pk/s, %.0f%% of %d baud, %s" % (
+        received[0], options.count, received[0] / elapsed,
+        100 * received[0] * frame * 10 / elapsed / options.baudrate,
+        options.baudrate, driver.get_status())
+    if errors:
+        print "errors:", errors
+
+    driver.close()
+    stop.set()
+    os.close(slave)
+    echoer.join()
+    os.close(master)
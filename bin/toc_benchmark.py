@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Measure the time to connect to the debug driver, which is mostly the time to
+download the log and param TOCs, for several TOC windows (the number of TOC
+elements requested at the same time). The TOC cache is emptied before every
+connection, so every connection downloads the TOCs. debug://0/3 delays each answer by a random
+0-250 ms like a slow link. --latency delays every answer by a fixed time
+without serialising them, like a radio link, and --toc-size grows the fake log
+TOC, which is where the window makes a difference.
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "crazyflieROS"))
+
+from optparse import OptionParser
+import threading, time
+
+import cflib.crtp
+from cflib.crtp import debugdriver
+from cflib.crazyflie import Crazyflie
+from cflib.crazyflie import toccache
+
+
+def add_latency(latency):
+    """ Delay every answer of the debug driver by latency seconds """
+    def send_packet(self, pk):
+        threading.Timer(latency, self.queue.put, (pk,)).start()
+    debugdriver._PacketHandlingThread._send_packet = send_packet
+
+
+def grow_log_toc(size):
+    """ Pad the fake log TOC of the debug driver to size elements """
+    driver = [d for d in cflib.crtp.INSTANCES if isinstance(d, debugdriver.DebugDriver)][0]
+    toc = driver.fakeLogToc
+    base = list(toc)
+    for i in xrange(len(base), size):
+        element = dict(base[i % len(base)])
+        element["varid"] = i
+        element["varname"] = "v%d" % i
+        toc.append(element)
+
+
+def connect(uri, window, timeout):
+    """ Connect with the TOC window, return (seconds or None, retries by port) """
+    with toccache._memory_lock:
+        toccache._memory.clear()
+    cf = Crazyflie(toc_window=window)
+    connected = threading.Event()
+    cf.connected.add_callback(lambda uri: connected.set())
+    # The incoming packet thread sleeps a second while there is no link
+    time.sleep(1.1)
+    start = time.time()
+    cf.open_link(uri)
+    deadline = start + timeout
+    # Timed waits on an Event poll with long sleeps in Python 2
+    while not connected.is_set() and time.time() < deadline:
+        time.sleep(0.001)
+    elapsed = time.time() - start if connected.is_set() else None
+    retries = dict(cf.retransmit.retries)
+    cf.close_link()
+    return elapsed, retries
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-u", "--uri", default="debug://0/0", help="Debug driver URI, debug://0/3 for delayed answers [default: %default]")
+    parser.add_option("-w", "--windows", default="1,2,4,8,16", help="Comma separated TOC windows [default: %default]")
+    parser.add_option("-n", "--count", type="int", default=3, help="Connections per window [default: %default]")
+    parser.add_option("-t", "--timeout", type="float", default=60, help="Give up a connection after (s) [default: %default]")
+    parser.add_option("-l", "--latency", type="float", default=0, help="Fixed answer latency (s) [default: %default]")
+    parser.add_option("-s", "--toc-size", type="int", default=0, help="Pad the fake log TOC to this many elements [default: %default]")
+    (options, args) = parser.parse_args()
+
+    cflib.crtp.init_drivers(enable_debug_driver=True)
+    if options.latency > 0:
+        add_latency(options.latency)
+    if options.toc_size:
+        grow_log_toc(options.toc_size)
+    for window in [int(w) for w in options.windows.split(",")]:
+        times = []
+        retries = 0
+        for i in xrange(options.count):
+            elapsed, r = connect(options.uri, window, options.timeout)
+            if elapsed is None:
+                print "window %2d: connection %d timed out" % (window, i)
+                continue
+            times.append(elapsed)
+            retries += sum(r.values())
+        if times:
+            print "window %2d: connect mean %6.3f s, min %6.3f s, max %6.3f s, %.1f retries per connection" % (
+                window, sum(times) / len(times), min(times), max(times), float(retries) / options.count)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Compare sending packets one by one with Crazyradio.send_packet and in batches
+with Crazyradio.send_packets, against a simulated dongle. Each USB transfer
+takes a fixed host latency and the dongle sends one packet over the air at a
+time, holding a limited number of packets whose acks have not been read.
+With --fail-every some ack reads fail and lose their ack. The packets
+without an ack are sent again, and every ack is checked against the packet
+it answers, as the simulated Crazyflie echoes the data of each packet.
+"""
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "crazyflieROS"))
+
+from optparse import OptionParser
+from collections import deque
+import threading, time, array
+import usb
+
+from cflib.drivers.crazyradio import Crazyradio
+
+
+class SimulatedDongle(object):
+    """ USB device answering like a Crazyradio with a Crazyflie in range, for both pyusb APIs """
+    bcdDevice = 0x0005
+    deviceVersion = "0.5"
+
+    def __init__(self, usb_latency, air_time, buffers, fail_every=0):
+        self.usb_latency = usb_latency
+        self.air_time = air_time
+        self.buffers = buffers
+        self.fail_every = fail_every
+        self._reads = 0
+        self._cond = threading.Condition()
+        self._acks = deque()
+        self._outstanding = 0
+        self._radio_free = 0
+
+    def write(self, endpoint, data, interface=0, timeout=1000):
+        time.sleep(self.usb_latency)
+        with self._cond:
+            while self._outstanding >= self.buffers:
+                self._cond.wait()
+            self._outstanding += 1
+            # The packet goes over the air once the radio is free
+            self._radio_free = max(time.time(), self._radio_free) + self.air_time
+            self._acks.append((self._radio_free, array.array('B', [0x01]) + array.array('B', data[1:])))
+        return len(data)
+
+    def read(self, endpoint, size, interface=0, timeout=1000):
+        time.sleep(self.usb_latency)
+        with self._cond:
+            while not self._acks:
+                self._cond.wait()
+            (ready, ack) = self._acks.popleft()
+        wait = ready - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        with self._cond:
+            self._outstanding -= 1
+            self._cond.notify_all()
+        self._reads += 1
+        if self.fail_every and self._reads % self.fail_every == 0:
+            raise usb.USBError("Simulated read failure")
+        return ack
+
+    bulkWrite = lambda self, endpoint, data, timeout: self.write(endpoint, data, 0, timeout)
+    bulkRead = lambda self, endpoint, size, timeout: self.read(endpoint, size, 0, timeout)
+
+    def ctrl_transfer(self, *args, **kwargs):
+        time.sleep(self.usb_latency)
+
+    def controlMsg(self, *args, **kwargs):
+        time.sleep(self.usb_latency)
+
+    def open(self):
+        return self
+
+    def set_configuration(self, *args):
+        pass
+    setConfiguration = claimInterface = releaseInterface = set_configuration
+
+    def reset(self):
+        pass
+
+
+def run(radio, count, batch):
+    """
+    Send count packets batch at a time (0 for send_packet), return (seconds,
+    sorted latencies, resent packets, acks of another packet)
+    """
+    packets = [array.array('B', [0x30] + [i & 0xFF] * 30) for i in xrange(count)]
+    latencies = []
+    resent = wrong = 0
+    start = time.time()
+    i = 0
+    while i < count:
+        t = time.time()
+        sending = packets[i:i + (batch or 1)]
+        if batch:
+            acks = radio.send_packets(sending)
+        else:
+            acks = [radio.send_packet(sending[0])]
+        done = time.time()
+        for (dataOut, ack) in zip(sending, acks):
+            if ack is None or not ack.ack:
+                # Sent again with the next transfer, in order
+                resent += 1
+                break
+            if list(ack.data) != list(dataOut[1:]):
+                wrong += 1
+            latencies.append(done - t)
+            i += 1
+    elapsed = time.time() - start
+    latencies.sort()
+    return elapsed, latencies, resent, wrong
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--count", type="int", default=2000, help="Packets sent in each mode [default: %default]")
+    parser.add_option("-b", "--batch", type="int", default=8, help="Packets per batch [default: %default]")
+    parser.add_option("-w", "--window", type="int", default=4, help="Packets written ahead of their acks [default: %default]")
+    parser.add_option("-u", "--usb-latency", type="float", default=0.25, help="Latency of a USB transfer (ms) [default: %default]")
+    parser.add_option("-a", "--air-time", type="float", default=0.3, help="Time to send a packet and get its ack over the air (ms) [default: %default]")
+    parser.add_option("-d", "--buffers", type="int", default=2, help="Packets the dongle holds before its acks are read [default: %default]")
+    parser.add_option("-f", "--fail-every", type="int", default=0, help="Fail every nth ack read, 0 for none [default: %default]")
+    (options, args) = parser.parse_args()
+
+    radio = Crazyradio(device=SimulatedDongle(options.usb_latency / 1000, options.air_time / 1000, options.buffers,
+                                              options.fail_every))
+    radio.batch_window = options.window
+    for name, batch in (("send_packet", 0), ("send_packets", options.batch)):
+        elapsed, lat, resent, wrong = run(radio, options.count, batch)
+        print "%-12s %6.0f pk/s: latency median %6.0f us, 99%% %6.0f us, max %6.0f us, %d resent, %d wrong acks" % (
+            name, options.count / elapsed, lat[len(lat)/2]*1e6, lat[int(len(lat)*0.99)]*1e6, lat[-1]*1e6, resent, wrong)
+    radio.close()
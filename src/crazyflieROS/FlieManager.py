@@ -2,10 +2,13 @@ __author__ = 'ollie'
 __all__=['FlieControl','STATE']
 
 
+import os
+import time
 from PyQt4 import QtGui, uic
 from PyQt4.QtCore import Qt, pyqtSignal, pyqtSlot, QObject, QTimer
 from commonTools import KBSecMonitor, FreqMonitor, STATE
 from cflib.crazyflie import Crazyflie
+from cflib.crtp.recorder import FlightRecorder
 import rospy
 #import logging
 #logger = logging.getLogger(__name__)
@@ -14,7 +17,8 @@ import rospy
 class FlieControl(QObject):
     """ Class that andles the flie library """
 
-    sig_console = pyqtSignal(str)     # Console messages from the flie - emiited for every console message
+    sig_console = pyqtSignal(str)     # Console messages from the flie - emitted with a batch of complete lines
+    sig_consoleLines = pyqtSignal(object) # Same batch of console lines as a list, without newlines
     sig_packetSpeed = pyqtSignal(int, int) # Packets in/out per second - emitted every self.updatePacketSpeed ms
     sig_stateUpdate = pyqtSignal(int,str,str) # Send state update and optional messages (stateNr, uri, errmsg)
 
@@ -25,21 +29,31 @@ class FlieControl(QObject):
     def __init__(self, parent=None):
         super(FlieControl, self).__init__(parent)
 
-        # Temporary
-        #cache_dir = os.path.dirname(os.path.realpath(__file__))
-        #cache_dir =  cache_dir[0:cache_dir.find("src/crazyflieROS")]+"cache/"
-
         # Parameters
+        # TOC cache directory shared by all driver nodes, empty to disable
+        cache_dir = rospy.get_param("~toc_cache_dir", "")
+        cache_binary = rospy.get_param("~toc_cache_binary", False)
+        # Number of parameter requests sent before waiting for the answers
+        param_window = rospy.get_param("~param_window", 8)
+        # Number of TOC elements requested before waiting for the answers
+        toc_window = rospy.get_param("~toc_window", 4)
+        # Rate (Hz) at which the latest setpoint is sent, 0 to send every command as it comes
+        self.setpoint_rate = rospy.get_param("~setpoint_rate", 100)
+        # Directory to record the raw link traffic of every connection to, empty to disable
+        self.record_dir = os.path.expanduser(rospy.get_param("~record_dir", ""))
 
         # Members
-        self.console_cache = "" # Used to buffer crazyflie console messages that go over newlines
-        self.crazyflie = Crazyflie()
-        #self.crazyflie = Crazyflie(cache_dir+"/ro", cache_dir+"/rw")
+        if cache_dir:
+            rospy.loginfo("Using shared TOC cache in [%s]", cache_dir)
+            self.crazyflie = Crazyflie(rw_cache=os.path.expanduser(cache_dir), toc_cache_binary=cache_binary, param_window=param_window, toc_window=toc_window)
+        else:
+            self.crazyflie = Crazyflie(param_window=param_window, toc_window=toc_window)
         self.linkQuality = LinkQuality(window=50)
         self.status = STATE.DISCONNECTED
         self.killswitch = False
         self.hovering = False
         self.hoverAllowed = True
+        self.recorder = None
 
         # Timers
         self.inKBPS = KBSecMonitor()
@@ -56,7 +70,7 @@ class FlieControl(QObject):
         self.crazyflie.link_quality_updated.add_callback(self.linkQualityCB)         # Called when the link driver updates the link quality measurement
         self.crazyflie.packet_received.add_callback(self.packetReceivedCB)           # Called for every packet received
         self.crazyflie.packet_sent.add_callback(self.packetSentCB)                   # Called for every packet sent
-        self.crazyflie.console.receivedChar.add_callback(self.consoleCB)             # Called with console text
+        self.crazyflie.console.receivedLines.add_callback(self.consoleCB)            # Called with batches of console lines
 
 
 
@@ -64,12 +78,18 @@ class FlieControl(QObject):
 
     def connectedCB(self, uri, msg=""):
         """ Called when the link is established and the TOCs (that are not cached) have been downloaded """
+        if self.setpoint_rate > 0:
+            self.crazyflie.commander.start_streaming(self.setpoint_rate)
         self.sig_stateUpdate.emit(STATE.CONNECTED, uri, msg)
 
 
     def disconnectedCB(self, uri, msg=""):
         """ Called on disconnect, no matter the reason """
-        self.console_cache = ""
+        self.stopRecording()
+        stats = self.crazyflie.commander.get_stream_stats()
+        self.crazyflie.commander.stop_streaming()
+        if stats and stats["given"]:
+            rospy.loginfo("Setpoints: %(given)d given, %(sent)d sent, %(coalesced)d coalesced, %(dropped)d dropped, jitter mean %(mean_jitter).4fs max %(max_jitter).4fs", stats)
         self.inKBPS.stop()
         self.outKBPS.stop()
         self.crazyflie.packet_received.remove_callback(self.packetReceivedCB)
@@ -85,6 +105,7 @@ class FlieControl(QObject):
     def connectionFailedCB(self, uri, msg=""):
         """ Called if establishing of the link fails (i.e times out) """
         # stop counting packets
+        self.stopRecording()
         self.inKBPS.stop()
         self.outKBPS.stop()
         self.crazyflie.packet_received.remove_callback(self.packetReceivedCB)
@@ -99,6 +120,7 @@ class FlieControl(QObject):
         self.outKBPS.start()
         self.crazyflie.packet_received.add_callback(self.packetReceivedCB)
         self.crazyflie.packet_sent.add_callback(self.packetSentCB)
+        self.startRecording(uri)
         self.sig_stateUpdate.emit(STATE.CONNECTION_REQUESTED, uri, msg)
 
 
@@ -116,34 +138,46 @@ class FlieControl(QObject):
             self.sig_flieLink.emit(percentage)
 
 
-    def consoleCB(self, msg):
-        """ Crazyflie console messages are routed to this function. Newlines are detected and the strings joined. """
-        # Join messages if they are max length
-        if len(msg)==30:
-            self.console_cache += msg
-        else:
-            #msg = cyan+(self.console_cache+msg).strip("\n")+reset
-            msg = (self.console_cache+msg).strip("\n")
-            self.sig_console.emit(msg+"\n")
-
-
-            CSI = "\x1b["
-            cyan = CSI+"36m"
-            reset = CSI+"m"
-            msg = cyan+(self.console_cache+msg).strip("\n")+reset
-            rospy.loginfo(msg)
-
+    def consoleCB(self, lines):
+        """ Crazyflie console lines are routed to this function, in batches delivered a few times per second """
+        msg = "\n".join(lines)
+        self.sig_console.emit(msg+"\n")
+        self.sig_consoleLines.emit(lines)
 
-            self.console_cache = ""
+        CSI = "\x1b["
+        cyan = CSI+"36m"
+        reset = CSI+"m"
+        rospy.loginfo(cyan+msg+reset)
 
 
     def packetReceivedCB(self, pk=None):
         """ Called for every packet received """
-        self.inKBPS.count(1+len(pk.datal))
+        self.inKBPS.count(1+len(pk.datab))
 
     def packetSentCB(self, pk=None):
         """ Called for every packet sent """
-        self.outKBPS.count(1+len(pk.datal)) #TODO: write function that gets the size directly
+        self.outKBPS.count(1+len(pk.datab))
+
+    def startRecording(self, uri):
+        """ Record the link traffic to the record directory, if one is set. Replayed links are not recorded again. """
+        self.stopRecording()
+        if not self.record_dir or str(uri).startswith("replay://"):
+            return
+        try:
+            if not os.path.exists(self.record_dir):
+                os.makedirs(self.record_dir)
+            filename = os.path.join(self.record_dir, time.strftime("flight-%Y%m%d-%H%M%S.crec"))
+            self.recorder = FlightRecorder(filename)
+            self.recorder.attach(self.crazyflie)
+            rospy.loginfo("Recording link to [%s]", filename)
+        except (IOError, OSError) as e:
+            rospy.logwarn("Could not record link: %s", e)
+            self.recorder = None
+
+    def stopRecording(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
 
     def setPacketUpdateSpeed(self, hz):
         self.inKBPS.setHZ(hz)
@@ -175,7 +209,7 @@ class FlieControl(QObject):
 
 
     def requestHover(self, on=True):
-        self.crazyflie.param.set_value("flightmode.althold", "1" if on and self.hoverAllowed else "0")
+        self.crazyflie.param.set_value("flightmode.althold", 1 if on and self.hoverAllowed else 0)
 
 
 
@@ -41,9 +41,11 @@ __all__ = ['Crazyflie']
 import logging
 logger = logging.getLogger(__name__)
 import time
+import heapq
+import itertools
 from threading import Thread
 
-from threading import Timer, Lock
+from threading import Condition, Lock
 
 from .commander import Commander
 from .console import Console
@@ -89,33 +91,51 @@ class Crazyflie():
 
     state = State.DISCONNECTED
 
-    def __init__(self, link=None, ro_cache=None, rw_cache=None):
+    def __init__(self, link=None, ro_cache=None, rw_cache=None, toc_window=1,
+                 toc_cache_binary=False, param_window=1):
         """
         Create the objects from this module and register callbacks.
 
         ro_cache -- Path to read-only cache (string)
-        rw_cache -- Path to read-write cache (string)
+        rw_cache -- Path to read-write cache, can be shared by several
+                    processes (string)
+        toc_window -- Number of TOC elements requested at the same time while
+                      downloading a TOC (int)
+        toc_cache_binary -- Write new cache files in the binary format
+                            instead of JSON (bool)
+        param_window -- Number of parameter requests sent at the same time
+                        while reading or writing parameters (int)
         """
         self.link = link
+        self.toc_window = toc_window
         self._toc_cache = TocCache(ro_cache=ro_cache,
-                                   rw_cache=rw_cache)
+                                   rw_cache=rw_cache,
+                                   binary=toc_cache_binary)
 
         self.incoming = _IncomingPacketHandler(self)
         self.incoming.setDaemon(True)
         self.incoming.start()
 
+        # Used for retry when no reply was sent back
+        self.retransmit = _RetransmitScheduler(self)
+        self.retransmit.start()
+
         self.commander = Commander(self)
         self.log = Log(self)
         self.console = Console(self)
-        self.param = Param(self)
+        self.param = Param(self, param_window)
 
         self.link_uri = ""
 
-        # Used for retry when no reply was sent back
         self.packet_received.add_callback(self._check_for_initial_packet_cb)
         self.packet_received.add_callback(self._check_for_answers)
 
+        # Pending answers by pattern, and the patterns indexed by header and
+        # then by the rest of the pattern for quick matching
         self._answer_patterns = {}
+        self._answer_index = {}
+        self._answer_max_len = 0
+        self._answer_lock = Lock()
 
         self._send_lock = Lock()
 
@@ -224,11 +244,12 @@ class Crazyflie():
         """Close the communication link."""
         logger.info("Closing link")
         if (self.link is not None):
-            self.commander.send_setpoint(0, 0, 0, 0)
+            self.commander.send_stop_setpoint()
         if (self.link is not None):
             self.link.close()
             self.link = None
-        self._answer_patterns = {}
+        self._clear_answer_patterns()
+        self.retransmit.clear()
         self.disconnected.call(self.link_uri)
 
     def add_port_callback(self, port, cb):
@@ -239,11 +260,85 @@ class Crazyflie():
         """Remove the callback cb on port"""
         self.incoming.remove_port_callback(port, cb)
 
-    def _no_answer_do_retry(self, pk, pattern):
-        """Resend packets that we have not gotten answers to"""
-        logger.debug("Resending for pattern %s", pattern)
-        # Set the timer to None before trying to send again
-        self.send_packet(pk, expected_reply=pattern, resend=True)
+    def _no_answer_do_retry(self, pending):
+        """
+        Resend a packet that we have not gotten an answer to. Returns True if
+        the packet was sent again and False if it has been answered meanwhile
+        or the link is closed.
+
+        The Crazyflie answers the packets of a port and channel in order, so
+        while an older packet with the same header is waiting for an answer
+        the packet is most likely still queued behind it. It is then not
+        resent but waited for again, instead of piling up retries behind
+        slow answers.
+        """
+        self._send_lock.acquire()
+        try:
+            if (self.link is None or
+                    self._answer_patterns.get(pending.pattern) is not pending):
+                return False
+            if self._older_pending(pending):
+                self.retransmit.schedule(pending)
+                return False
+            logger.debug("Resending for pattern %s", pending.pattern)
+            self.link.send_packet(pending.pk)
+            self.packet_sent.call(pending.pk)
+            pending.retries += 1
+            self.retransmit.schedule(pending)
+            return True
+        finally:
+            self._send_lock.release()
+
+    def _older_pending(self, pending):
+        """Return True if a packet with the same header sent before pending
+        is waiting for an answer"""
+        with self._answer_lock:
+            for pattern in self._answer_index.get(pending.pattern[0],
+                                                  {}).values():
+                if self._answer_patterns[pattern].seq < pending.seq:
+                    return True
+        return False
+
+    def _no_answer_give_up(self, pending):
+        """
+        Stop waiting for an answer to a packet that has been resent too many
+        times. Returns False if it was answered meanwhile.
+        """
+        return self._remove_answer_pattern(pending.pattern, pending)
+
+    def _add_answer_pattern(self, pattern, pending):
+        """Start waiting for an answer matching pattern"""
+        with self._answer_lock:
+            self._answer_patterns[pattern] = pending
+            self._answer_index.setdefault(pattern[0], {})[pattern[1:]] = \
+                pattern
+            self._answer_max_len = max(self._answer_max_len,
+                                       len(pattern) - 1)
+
+    def _remove_answer_pattern(self, pattern, pending=None):
+        """
+        Stop waiting for an answer matching pattern. If pending is supplied
+        the pattern is only removed if it still belongs to it. Returns True
+        if the pattern was removed.
+        """
+        with self._answer_lock:
+            if (pattern not in self._answer_patterns or
+                    (pending is not None and
+                     self._answer_patterns[pattern] is not pending)):
+                return False
+            del self._answer_patterns[pattern]
+            prefixes = self._answer_index[pattern[0]]
+            del prefixes[pattern[1:]]
+            if not prefixes:
+                del self._answer_index[pattern[0]]
+            return True
+
+    def _clear_answer_patterns(self):
+        """Stop waiting for any answers"""
+        with self._answer_lock:
+            self._answer_patterns = {}
+            self._answer_index = {}
+            self._answer_max_len = 0
 
     def _check_for_answers(self, pk):
         """
@@ -251,19 +346,19 @@ class Crazyflie():
         waiting for an answer on this port. If so, then cancel the retry
         timer.
         """
-        longest_match = ()
-        if len(self._answer_patterns) > 0:
-            data = (pk.header,) + pk.datat
-            for p in self._answer_patterns.keys():
-                logger.debug("Looking for pattern match on %s vs %s", p, data)
-                if len(p) <= len(data):
-                    if p == data[0:len(p)]:
-                        match = data[0:len(p)]
-                        if len(match) >= len(longest_match):
-                            logger.debug("Found new longest match %s", match)
-                            longest_match = match
-        if len(longest_match) > 0:
-            del self._answer_patterns[longest_match]
+        if not self._answer_patterns:
+            return
+        prefixes = self._answer_index.get(pk.header)
+        if not prefixes:
+            return
+        # Try the longest possible prefix of the data first
+        data = pk.datab
+        for length in range(min(len(data), self._answer_max_len), 0, -1):
+            pattern = prefixes.get(tuple(data[:length]))
+            if pattern is not None:
+                logger.debug("Found longest match %s", pattern)
+                self._remove_answer_pattern(pattern)
+                return
 
     def send_packet(self, pk, expected_reply=(), resend=False):
         """
@@ -272,6 +367,8 @@ class Crazyflie():
         pk -- Packet to send
         expect_answer -- True if a packet from the Crazyflie is expected to
                          be sent back, otherwise false
+        resend -- True if this is a retry of a packet that is already waiting
+                  for expected_reply, no new retry is scheduled for it
 
         """
         self._send_lock.acquire()
@@ -282,33 +379,111 @@ class Crazyflie():
                 pattern = (pk.header,) + expected_reply
                 logger.debug("Sending packet and expecting the %s pattern back",
                              pattern)
-                new_timer = Timer(0.2,
-                                  lambda: self._no_answer_do_retry(pk, pattern))
-                self._answer_patterns[pattern] = new_timer
-                new_timer.start()
-            elif resend:
-                # Check if we have gotten an answer, if not try again
-                pattern = expected_reply
-                if pattern in self._answer_patterns:
-                    logger.debug("We want to resend and the pattern is there")
-                    if self._answer_patterns[pattern]:
-                        new_timer = Timer(0.2,
-                                          lambda:
-                                          self._no_answer_do_retry(
-                                              pk, pattern))
-                        self._answer_patterns[pattern] = new_timer
-                        new_timer.start()
-                else:
-                    logger.debug("Resend requested, but no pattern found: %s",
-                                 self._answer_patterns)
+                pending = _PendingAnswer(pk, pattern)
+                self._add_answer_pattern(pattern, pending)
+                self.retransmit.schedule(pending)
         self._send_lock.release()
 
+
+class _PendingAnswer(object):
+    """A sent packet that is waiting for a reply starting with pattern"""
+
+    __slots__ = ('pk', 'pattern', 'retries', 'seq')
+
+    # Numbers the pending answers in the order they were created
+    _counter = itertools.count()
+
+    def __init__(self, pk, pattern):
+        self.pk = pk
+        self.pattern = pattern
+        self.retries = 0
+        self.seq = next(self._counter)
+
+
+class _RetransmitScheduler(Thread):
+    """
+    Resends packets that have not been answered in time. All the packets
+    waiting for an answer share this thread, which sleeps until the closest
+    deadline in a heap.
+
+    The time to wait for the n:th retry is timeout * backoff ** n, limited to
+    max_timeout. After max_retries resends (None means never) the packet is
+    dropped. The number of retries and timeouts are counted per CRTP port in
+    the retries and timeouts dicts.
+    """
+
+    def __init__(self, cf, timeout=0.2, backoff=1.0, max_timeout=2.0,
+                 max_retries=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.cf = cf
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_timeout = max_timeout
+        self.max_retries = max_retries
+        self.retries = {}
+        self.timeouts = {}
+        self._heap = []
+        self._seq = 0
+        self._cond = Condition()
+
+    def schedule(self, pending):
+        """Wait for an answer to pending, retry if there is none in time"""
+        delay = min(self.timeout * self.backoff ** pending.retries,
+                    self.max_timeout)
+        self._cond.acquire()
+        # The sequence number keeps the heap from ever comparing two entries
+        self._seq += 1
+        heapq.heappush(self._heap, (time.time() + delay, self._seq, pending))
+        self._cond.notify()
+        self._cond.release()
+
+    def clear(self):
+        """Forget about all the packets waiting for an answer"""
+        self._cond.acquire()
+        self._heap = []
+        self._cond.release()
+
+    def _expired(self, pending):
+        """Called when the deadline for pending has passed"""
+        port = pending.pk.port
+        if (self.max_retries is not None and
+                pending.retries >= self.max_retries):
+            if self.cf._no_answer_give_up(pending):
+                logger.warning("No answer for pattern %s after %d retries",
+                               pending.pattern, pending.retries)
+                self.timeouts[port] = self.timeouts.get(port, 0) + 1
+        elif self.cf._no_answer_do_retry(pending):
+            self.retries[port] = self.retries.get(port, 0) + 1
+
+    def run(self):
+        while(True):
+            expired = []
+            self._cond.acquire()
+            if not self._heap:
+                self._cond.wait()
+            else:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    expired.append(heapq.heappop(self._heap)[2])
+                if not expired:
+                    self._cond.wait(self._heap[0][0] - now)
+            self._cond.release()
+
+            # Handle them without holding the lock since a retry will
+            # schedule a new deadline
+            for pending in expired:
+                self._expired(pending)
+
+
 class _IncomingPacketHandler(Thread):
     """Handles incoming packets and sends the data to the correct receivers"""
     def __init__(self, cf):
         Thread.__init__(self)
         self.cf = cf
         self.cb = []
+        self._cb_lock = Lock()
+        self._rebuild_dispatch_table()
 
     def add_port_callback(self, port, cb):
         """Add a callback for data that comes on a specific port"""
@@ -318,9 +493,11 @@ class _IncomingPacketHandler(Thread):
     def remove_port_callback(self, port, cb):
         """Remove a callback for data that comes on a specific port"""
         logger.debug("Removing callback on port [%d] to [%s]", port, cb)
-        for port_callback in self.cb:
-            if (port_callback[0] == port and port_callback[4] == cb):
-                self.cb.remove(port_callback)
+        with self._cb_lock:
+            self.cb = [port_callback for port_callback in self.cb
+                       if not (port_callback[0] == port and
+                               port_callback[4] == cb)]
+            self._rebuild_dispatch_table()
 
     def add_header_callback(self, cb, port, channel, port_mask=0xFF,
                             channel_mask=0xFF):
@@ -329,7 +506,27 @@ class _IncomingPacketHandler(Thread):
         possibility to add a mask for channel and port for multiple
         hits for same callback.
         """
-        self.cb.append([port, port_mask, channel, channel_mask, cb])
+        with self._cb_lock:
+            self.cb = self.cb + [[port, port_mask, channel, channel_mask, cb]]
+            self._rebuild_dispatch_table()
+
+    def _rebuild_dispatch_table(self):
+        """
+        Resolve the registered callbacks into a 16x4 (port x channel) table
+        so that dispatching a packet is a single lookup. Each entry holds the
+        callbacks for that header, in the order they were added, and if any
+        of them is a port specific (not catch-all) handler.
+        """
+        table = []
+        for port in range(16):
+            for channel in range(4):
+                cbs = tuple(cb for cb in self.cb
+                            if (cb[0] == port & cb[1] and
+                                cb[2] == channel & cb[3]))
+                handled = any(cb[0] != 0xFF for cb in cbs)
+                table.append((tuple(cb[4] for cb in cbs), handled))
+        # Swap in the new table in one go, run() might be using the old one
+        self._dispatch = table
 
     def run(self):
         while(True):
@@ -344,22 +541,19 @@ class _IncomingPacketHandler(Thread):
             #All-packet callbacks
             self.cf.packet_received.call(pk)
 
-            found = False
-            for cb in self.cb:
-                if (cb[0] == pk.port & cb[1] and
-                        cb[2] == pk.channel & cb[3]):
-                    try:
-                        cb[4](pk)
-                    except Exception:  # pylint: disable=W0703
-                        # Disregard pylint warning since we want to catch all
-                        # exceptions and we can't know what will happen in
-                        # the callbacks.
-                        import traceback
-                        logger.warning("Exception while doing callback on port"
-                                       " [%d]\n\n%s", pk.port,
-                                       traceback.format_exc())
-                    if (cb[0] != 0xFF):
-                        found = True
+            (callbacks, found) = self._dispatch[
+                (pk.port & 0x0F) << 2 | (pk.channel & 0x03)]
+            for cb in callbacks:
+                try:
+                    cb(pk)
+                except Exception:  # pylint: disable=W0703
+                    # Disregard pylint warning since we want to catch all
+                    # exceptions and we can't know what will happen in
+                    # the callbacks.
+                    import traceback
+                    logger.warning("Exception while doing callback on port"
+                                   " [%d]\n\n%s", pk.port,
+                                   traceback.format_exc())
 
             if not found:
                 logger.warning("Got packet on header (%d,%d) but no callback "
@@ -28,13 +28,32 @@
 
 """
 Used for sending control setpoints to the Crazyflie
+
+By default every setpoint is sent as soon as it is given. Once streaming is
+started, setpoints are only latched and a dedicated thread sends the latest
+one at a fixed rate, so bursts of input do not flood the link queue and
+slow input is still sent regularly.
 """
 
 __author__ = 'Bitcraze AB'
 __all__ = ['Commander']
 
 from cflib.crtp.crtpstack import CRTPPacket, CRTPPort
+from threading import Thread, Lock, current_thread
 import struct
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Roll, pitch, yaw and thrust
+_SETPOINT = struct.Struct('<fffH')
+
+# Default rate (Hz) of the setpoint stream
+STREAM_RATE = 100
+# A setpoint older than this (s) is not sent any more, so the Crazyflie
+# stops as usual when the input stops
+STREAM_HOLD = 0.5
 
 
 class Commander():
@@ -49,6 +68,7 @@ class Commander():
         """
         self._cf = crazyflie
         self._x_mode = False
+        self._streamer = None
 
     def set_client_xmode(self, enabled):
         """
@@ -62,13 +82,179 @@ class Commander():
         Send a new control setpoint for roll/pitch/yaw/thust to the copter
 
         The arguments roll/pitch/yaw/trust is the new setpoints that should
-        be sent to the copter
+        be sent to the copter. While streaming the setpoint replaces the
+        latest one, which is sent at the next tick of the stream.
         """
         if self._x_mode:
             roll = 0.707 * (roll - pitch)
             pitch = 0.707 * (roll + pitch)
 
+        streamer = self._streamer
+        if streamer is not None:
+            streamer.latch(roll, -pitch, yaw, thrust)
+        else:
+            self._send(roll, -pitch, yaw, thrust)
+
+    def send_stop_setpoint(self):
+        """
+        Send a zero setpoint right away. A latched setpoint is forgotten so
+        the stream does not send it again.
+        """
+        streamer = self._streamer
+        if streamer is not None:
+            streamer.clear()
+        self._send(0, 0, 0, 0)
+
+    def _send(self, roll, pitch, yaw, thrust):
         pk = CRTPPacket()
         pk.port = CRTPPort.COMMANDER
-        pk.data = struct.pack('<fffH', roll, -pitch, yaw, thrust)
+        pk.data = _SETPOINT.pack(roll, pitch, yaw, thrust)
         self._cf.send_packet(pk)
+
+    def start_streaming(self, rate=STREAM_RATE, hold=STREAM_HOLD):
+        """
+        Send the latest setpoint rate times per second from now on, for up to
+        hold seconds after it was given.
+        """
+        self.stop_streaming()
+        self._streamer = _SetpointStreamer(self._cf, rate, hold)
+        self._streamer.start()
+
+    def stop_streaming(self):
+        """Go back to sending every setpoint as soon as it is given"""
+        (streamer, self._streamer) = (self._streamer, None)
+        if streamer is not None:
+            streamer.stop()
+
+    def get_stream_stats(self, reset=False):
+        """
+        Return the counters of the setpoint stream, see
+        _SetpointStreamer.get_stats, or None when not streaming
+        """
+        streamer = self._streamer
+        if streamer is None:
+            return None
+        return streamer.get_stats(reset)
+
+
+class _SetpointStreamer(Thread):
+    """
+    Thread sending the latest setpoint at a fixed rate. A new packet is
+    built for each send, as the drivers queue the packet objects.
+
+    The setpoint is copied with the lock held and sent after releasing it,
+    so latch() does not wait for a send blocked on a full queue. Sends are
+    done with the send lock held, which clear() also takes, so once clear()
+    returns the forgotten setpoint is not sent any more.
+    """
+
+    def __init__(self, cf, rate, hold):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self._cf = cf
+        self.period = 1.0 / rate
+        self.hold = hold
+        self._lock = Lock()
+        self._send_lock = Lock()
+        self._sp = False
+        # Latest setpoint, when it was given and if it was not sent yet
+        self._setpoint = None
+        self._given = 0
+        self._fresh = False
+        self._last_send = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        # Setpoints given, replaced before being sent and not sent because
+        # the link was closed
+        self.given = 0
+        self.coalesced = 0
+        self.dropped = 0
+        # Packets sent, and the error of the intervals between them (s)
+        self.sent = 0
+        self._intervals = 0
+        self._total_jitter = 0.0
+        self._max_jitter = 0.0
+
+    def latch(self, roll, pitch, yaw, thrust):
+        with self._lock:
+            if self._fresh:
+                self.coalesced += 1
+            self._setpoint = (roll, pitch, yaw, thrust)
+            self._given = time.time()
+            self._fresh = True
+            self.given += 1
+
+    def clear(self):
+        """Forget the latched setpoint, waiting for a send in progress"""
+        with self._send_lock:
+            with self._lock:
+                if self._fresh:
+                    self.dropped += 1
+                self._setpoint = None
+                self._fresh = False
+
+    def stop(self):
+        self._sp = True
+        if current_thread() is not self:
+            self.join()
+
+    def get_stats(self, reset=False):
+        """
+        Return the setpoint counters and the jitter (s), the mean and maximum
+        difference between the period and the intervals between two packets
+        """
+        with self._lock:
+            stats = {"given": self.given,
+                     "sent": self.sent,
+                     "coalesced": self.coalesced,
+                     "dropped": self.dropped,
+                     "mean_jitter": (self._total_jitter / self._intervals
+                                     if self._intervals else 0.0),
+                     "max_jitter": self._max_jitter}
+            if reset:
+                self._reset_stats()
+        return stats
+
+    def _tick(self, now):
+        """Send the latest setpoint if there is one to send"""
+        with self._send_lock:
+            with self._lock:
+                setpoint = self._setpoint
+                fresh = self._fresh
+                self._fresh = False
+                if setpoint is None or now - self._given > self.hold:
+                    self._last_send = None
+                    return
+                if self._cf.link is None:
+                    if fresh:
+                        self.dropped += 1
+                    self._last_send = None
+                    return
+                if self._last_send is not None:
+                    jitter = abs(now - self._last_send - self.period)
+                    self._intervals += 1
+                    self._total_jitter += jitter
+                    self._max_jitter = max(self._max_jitter, jitter)
+                self._last_send = now
+                self.sent += 1
+            pk = CRTPPacket()
+            pk.port = CRTPPort.COMMANDER
+            pk.data = _SETPOINT.pack(*setpoint)
+            self._cf.send_packet(pk)
+
+    def run(self):
+        deadline = time.time()
+        while not self._sp:
+            now = time.time()
+            if deadline > now:
+                time.sleep(deadline - now)
+                now = time.time()
+            try:
+                self._tick(now)
+            except Exception:
+                logger.exception("Could not send setpoint")
+            deadline += self.period
+            if deadline < now:
+                # Skip the ticks missed when running late
+                deadline = now + self.period
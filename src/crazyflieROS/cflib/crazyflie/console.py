@@ -28,15 +28,33 @@
 """
 Crazyflie console is used to receive characters printed using printf
 from the firmware.
+
+The text is assembled into lines, and the last lines are kept as a history.
+Complete lines are delivered to the subscribers of receivedLines in batches,
+at most DELIVERY_RATE times per second, so a firmware printing a lot does
+not make every subscriber handle every packet.
 """
 
 __author__ = 'Bitcraze AB'
 __all__ = ['Console']
 
-import struct
+from collections import deque
+from threading import Thread, Lock, Event
+import time
+
 from cflib.utils.callbacks import Caller
 from cflib.crtp.crtpstack import CRTPPort
 
+import logging
+logger = logging.getLogger(__name__)
+
+# Number of lines kept in the history, and waiting to be delivered
+HISTORY_LINES = 1000
+# Batches of lines delivered per second
+DELIVERY_RATE = 10
+# Longer lines are split
+MAX_LINE_LENGTH = 1024
+
 
 class Console:
     """
@@ -46,19 +64,108 @@ class Console:
 
     receivedChar = Caller()
 
-    def __init__(self, crazyflie):
+    def __init__(self, crazyflie, history=HISTORY_LINES, rate=DELIVERY_RATE):
         """
         Initialize the console and register it to receive data from the copter.
+        The last history lines are kept, and lines are delivered rate times
+        per second.
         """
         self.cf = crazyflie
+        # Called with a list of lines, without the newlines
+        self.receivedLines = Caller()
+        self.history = deque(maxlen=history)
+        # Lines not delivered yet, the oldest are dropped when the
+        # subscribers are too slow
+        self._pending = deque(maxlen=history)
+        self.dropped = 0
+        # Received text after the last newline
+        self._partial = bytearray()
+        # Held while using the partial line, history and pending lines
+        self._lock = Lock()
+        # Set while there are pending lines
+        self._ready = Event()
+
+        self._delivery = _LineDelivery(self, 1.0 / rate)
+        self._delivery.start()
+
         self.cf.add_port_callback(CRTPPort.CONSOLE, self.incoming)
+        self.cf.disconnected.add_callback(self._disconnected)
 
     def incoming(self, packet):
         """
         Callback for data received from the copter.
         """
-        # This might be done prettier ;-)
-        console_text = "%s" % struct.unpack("%is" % len(packet.data),
-                                            packet.data)
+        self.receivedChar.call(packet.data)
+
+        with self._lock:
+            partial = self._partial
+            partial.extend(packet.datab)
+            if (packet.datab.find("\n") < 0 and
+                    len(partial) < MAX_LINE_LENGTH):
+                return
+            lines = partial.split("\n")
+            self._partial = lines.pop()
+            while len(self._partial) >= MAX_LINE_LENGTH:
+                lines.append(self._partial[:MAX_LINE_LENGTH])
+                self._partial = self._partial[MAX_LINE_LENGTH:]
+            self._add_lines([str(line).rstrip("\r") for line in lines])
+
+    def _disconnected(self, uri):
+        """Deliver the unfinished line"""
+        with self._lock:
+            if self._partial:
+                line = str(self._partial).rstrip("\r")
+                self._partial = bytearray()
+                self._add_lines([line])
+
+    def _add_lines(self, lines):
+        """Add lines to the history and to deliver, with the lock held"""
+        self.history.extend(lines)
+        space = self._pending.maxlen - len(self._pending)
+        if len(lines) > space:
+            self.dropped += len(lines) - space
+        self._pending.extend(lines)
+        self._ready.set()
+
+    def _take_lines(self):
+        """Wait for lines to deliver and return them"""
+        self._ready.wait()
+        with self._lock:
+            lines = list(self._pending)
+            self._pending.clear()
+            self._ready.clear()
+        return lines
+
+    def get_history(self):
+        """Return the last lines received, the oldest first"""
+        with self._lock:
+            return list(self.history)
+
+
+class _LineDelivery(Thread):
+    """
+    Thread delivering the lines of the console as they come, waiting at
+    least period seconds between two deliveries
+    """
+
+    def __init__(self, console, period):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.console = console
+        self.period = period
 
-        self.receivedChar.call(console_text)
+    def run(self):
+        dropped = 0
+        while True:
+            lines = self.console._take_lines()
+            if self.console.dropped != dropped:
+                logger.warning("%d console lines dropped",
+                               self.console.dropped - dropped)
+                dropped = self.console.dropped
+            if lines:
+                try:
+                    self.console.receivedLines.call(lines)
+                except Exception:
+                    logger.exception("Console line callback failed")
+            # Lines coming meanwhile are delivered together at the next turn
+            time.sleep(self.period)
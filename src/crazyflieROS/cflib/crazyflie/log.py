@@ -68,6 +68,11 @@ __all__ = ['Log', 'LogTocElement']
 
 import struct
 import errno
+try:
+    import numpy
+except ImportError:
+    # Only needed for decoding log data in batches
+    numpy = None
 from cflib.crtp.crtpstack import CRTPPacket, CRTPPort
 from cflib.utils.callbacks import Caller
 from .toc import Toc, TocFetcher
@@ -97,6 +102,9 @@ GET_TOC_ELEMENT = "GET_TOC_ELEMENT"
 # The max size of a CRTP packet payload
 MAX_LOG_DATA_PACKET_SIZE = 30
 
+# Block id and 24-bit timestamp heading every CHAN_LOGDATA packet
+_LOG_DATA_HEADER = struct.Struct("<BBBB")
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -159,6 +167,15 @@ class LogConfig(object):
         self.variables = []
         self.default_fetch_as = []
         self.name = name
+        # Precompiled decoder for a whole log packet, see _compile_unpacker
+        self._unpacker = None
+        self._var_names = ()
+        # When batch_size > 0 the data is decoded batch_size packets at a
+        # time with unpack_log_data_batch and delivered to batch_received_cb
+        # instead of data_received_cb
+        self.batch_size = 0
+        self.batch_received_cb = Caller()
+        self._batch = []
 
     def add_variable(self, name, fetch_as=None):
         """Add a new variable to the configuration.
@@ -265,33 +282,85 @@ class LogConfig(object):
                 pk.data = (CMD_DELETE_BLOCK, self.id)
                 self.cf.send_packet(pk, expected_reply=(CMD_DELETE_BLOCK, self.id))
 
+    def _compile_unpacker(self):
+        """Build a single struct.Struct that decodes all the variables of the
+        configuration in one call, together with the matching names"""
+        fmt = "".join(LogTocElement.get_unpack_string_from_id(var.fetch_as)[1:]
+                      for var in self.variables)
+        self._unpacker = struct.Struct("<" + fmt)
+        self._var_names = tuple(var.name for var in self.variables)
+
+    def get_batch_dtype(self):
+        """Return the NumPy dtype of the arrays returned by
+        unpack_log_data_batch"""
+        return numpy.dtype([("timestamp", "<u4")] +
+                           [(var.name,
+                             LogTocElement.get_dtype_from_id(var.fetch_as))
+                            for var in self.variables])
+
+    def unpack_log_data_batch(self, log_data):
+        """Unpack the data of several logging packets for this configuration
+        at once.
+
+        log_data -- Either a list with the data of each CHAN_LOGDATA packet
+                    (str or bytearray, starting with the block id), or one
+                    buffer with the packet data back to back
+
+        Returns a NumPy structured array with one row per packet, with the
+        timestamp and one column per variable in the configuration."""
+        if numpy is None:
+            raise ImportError("NumPy is needed to unpack log data in batches")
+        raw_dtype = numpy.dtype(
+            [("id", "u1"), ("ts", "u1", (3,))] +
+            [(var.name, LogTocElement.get_dtype_from_id(var.fetch_as))
+             for var in self.variables])
+        if not isinstance(log_data, (str, bytearray, buffer)):
+            log_data = "".join(str(data[:raw_dtype.itemsize])
+                               for data in log_data)
+        raw = numpy.frombuffer(log_data, dtype=raw_dtype)
+
+        ret_data = numpy.empty(len(raw), dtype=self.get_batch_dtype())
+        ts = raw["ts"].astype("<u4")
+        ret_data["timestamp"] = ts[:, 0] | ts[:, 1] << 8 | ts[:, 2] << 16
+        for var in self.variables:
+            ret_data[var.name] = raw[var.name]
+        return ret_data
+
+    def _add_to_batch(self, log_data):
+        """Queue the data of a logging packet and deliver the batch when it is
+        full"""
+        self._batch.append(log_data)
+        if len(self._batch) >= self.batch_size:
+            self.flush_batch()
+
+    def flush_batch(self):
+        """Deliver the logging packets waiting to be decoded in a batch"""
+        if self._batch:
+            batch = self._batch
+            self._batch = []
+            self.batch_received_cb.call(self.unpack_log_data_batch(batch),
+                                        self)
+
     def unpack_log_data(self, log_data, timestamp):
         """Unpack received logging data so it represent real values according
         to the configuration in the entry"""
-        ret_data = {}
-        data_index = 0
-        for var in self.variables:
-            size = LogTocElement.get_size_from_id(var.fetch_as)
-            name = var.name
-            unpackstring = LogTocElement.get_unpack_string_from_id(
-                var.fetch_as)
-            value = struct.unpack(unpackstring,
-                                  log_data[data_index:data_index + size])[0]
-            data_index += size
-            ret_data[name] = value
+        if self._unpacker is None:
+            self._compile_unpacker()
+        ret_data = dict(zip(self._var_names,
+                            self._unpacker.unpack_from(log_data)))
         self.data_received_cb.call(timestamp, ret_data, self)
 
 
 class LogTocElement:
     """An element in the Log TOC."""
-    types = {0x01: ("uint8_t",  '<B', 1),
-             0x02: ("uint16_t", '<H', 2),
-             0x03: ("uint32_t", '<L', 4),
-             0x04: ("int8_t",   '<b', 1),
-             0x05: ("int16_t",  '<h', 2),
-             0x06: ("int32_t",  '<i', 4),
-             0x08: ("FP16",     '<h', 2),
-             0x07: ("float",    '<f', 4)}
+    types = {0x01: ("uint8_t",  '<B', 1, 'u1'),
+             0x02: ("uint16_t", '<H', 2, '<u2'),
+             0x03: ("uint32_t", '<L', 4, '<u4'),
+             0x04: ("int8_t",   '<b', 1, 'i1'),
+             0x05: ("int16_t",  '<h', 2, '<i2'),
+             0x06: ("int32_t",  '<i', 4, '<i4'),
+             0x08: ("FP16",     '<h', 2, '<i2'),
+             0x07: ("float",    '<f', 4, '<f4')}
 
     @staticmethod
     def get_id_from_cstring(name):
@@ -328,6 +397,15 @@ class LogTocElement:
             raise KeyError("Type [%d] not found in LogTocElement.types"
                            "!" % ident)
 
+    @staticmethod
+    def get_dtype_from_id(ident):
+        """Return the NumPy dtype string given the variable type id"""
+        try:
+            return LogTocElement.types[ident][3]
+        except KeyError:
+            raise KeyError("Type [%d] not found in LogTocElement.types"
+                           "!" % ident)
+
     def __init__(self, data=None):
         """TocElement creator. Data is the binary payload of the element."""
 
@@ -361,6 +439,8 @@ class Log():
 
     def __init__(self, crazyflie=None):
         self.log_blocks = []
+        # Blocks indexed by id, used for lookups on incoming packets
+        self._blocks_by_id = {}
         # Called with newly created blocks
         self.block_added_cb = Caller()
 
@@ -424,7 +504,9 @@ class Log():
                 (logconf.period > 0 and logconf.period < 0xFF)):
             logconf.valid = True
             logconf.cf = self.cf
+            logconf._compile_unpacker()
             self.log_blocks.append(logconf)
+            self._blocks_by_id.setdefault(logconf.id, logconf)
             self.block_added_cb.call(logconf)
         else:
             logconf.valid = False
@@ -441,21 +523,39 @@ class Log():
         pk.data = (CMD_RESET_LOGGING, )
         self.cf.send_packet(pk, expected_reply=(CMD_RESET_LOGGING,))
 
+    def _update_log_period(self):
+        """Tell the link about the shortest period of the started blocks"""
+        periods = [block.period_in_ms for block in self.log_blocks
+                   if block.started]
+        if self.cf.link is not None:
+            self.cf.link.set_log_period(min(periods) / 1000.0 if periods
+                                        else None)
+
     def _find_block(self, id):
-        for block in self.log_blocks:
-            if block.id == id:
-                return block
-        return None
+        return self._blocks_by_id.get(id)
 
     def _new_packet_cb(self, packet):
         """Callback for newly arrived packets with TOC information"""
         chan = packet.channel
-        cmd = packet.datal[0]
-        payload = struct.pack("B" * (len(packet.datal) - 1), *packet.datal[1:])
+        data = packet.datab
+
+        if (chan == CHAN_LOGDATA):
+            [id, ts0, ts1, ts2] = _LOG_DATA_HEADER.unpack_from(data)
+            block = self._blocks_by_id.get(id)
+            if (block is not None and block.batch_size > 0):
+                block._add_to_batch(data)
+            elif (block is not None):
+                block.unpack_log_data(data[4:], ts0 | ts1 << 8 | ts2 << 16)
+            else:
+                logger.warning("Error no LogEntry to handle id=%d", id)
+            return
+
+        cmd = data[0]
+        payload = data[1:]
 
         if (chan == CHAN_SETTINGS):
-            id = ord(payload[0])
-            error_status = ord(payload[1])
+            id = payload[0]
+            error_status = payload[1]
             block = self._find_block(id)
             if (cmd == CMD_CREATE_BLOCK):
                 if (block is not None):
@@ -486,6 +586,7 @@ class Log():
                                 id)
                     if block:
                         block.started = True
+                        self._update_log_period()
 
                 else:
                     msg = self._err_codes[error_status]
@@ -505,7 +606,9 @@ class Log():
                     logger.info("Have successfully stopped logging for id=%d",
                                 id)
                     if block:
+                        block.flush_batch()
                         block.started = False
+                        self._update_log_period()
 
             if (cmd == CMD_DELETE_BLOCK):
                 # Accept deletion of a block that isn't added. This could
@@ -514,30 +617,23 @@ class Log():
                     logger.info("Have successfully deleted id=%d",
                                 id)
                     if block:
+                        block.flush_batch()
                         block.started = False
                         block.added = False
+                        self._update_log_period()
 
             if (cmd == CMD_RESET_LOGGING):
                 # Guard against multiple responses due to re-sending
                 if not self._toc:
                     logger.debug("Logging reset, continue with TOC download")
                     self.log_blocks = []
+                    self._blocks_by_id = {}
+                    self._update_log_period()
 
                     self._toc = Toc()
                     toc_fetcher = TocFetcher(self.cf, LogTocElement,
                                              CRTPPort.LOGGING,
                                              self._toc, self._refresh_callback,
-                                             self._toc_cache)
+                                             self._toc_cache,
+                                             self.cf.toc_window)
                     toc_fetcher.start()
-
-        if (chan == CHAN_LOGDATA):
-            chan = packet.channel
-            id = packet.datal[0]
-            block = self._find_block(id)
-            timestamps = struct.unpack("<BBB", packet.data[1:4])
-            timestamp = (timestamps[0] | timestamps[1] << 8 | timestamps[2] << 16)
-            logdata = packet.data[4:]
-            if (block is not None):
-                block.unpack_log_data(logdata, timestamp)
-            else:
-                logger.warning("Error no LogEntry to handle id=%d", id)
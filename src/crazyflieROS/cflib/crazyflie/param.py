@@ -35,15 +35,17 @@ the parameters that can be written/read.
 """
 
 __author__ = 'Bitcraze AB'
-__all__ = ['Param', 'ParamTocElement']
+__all__ = ['Param', 'ParamTocElement', 'save_snapshot', 'load_snapshot']
 
 from cflib.utils.callbacks import Caller
 import struct
+import json
 from cflib.crtp.crtpstack import CRTPPacket, CRTPPort
 from .toc import Toc, TocFetcher
-from threading import Thread, Lock
+from threading import Thread, Condition
+import time
 
-from Queue import Queue
+from Queue import Queue, Empty
 
 import logging
 logger = logging.getLogger(__name__)
@@ -63,6 +65,39 @@ TOC_RESET = 0
 TOC_GETNEXT = 1
 TOC_GETCRC32 = 2
 
+# Time (s) after which an unanswered request is given up
+REQUEST_TIMEOUT = 2.0
+# While the window is full the updater polls for free slots with an interval
+# growing from POLL_MIN to POLL_MAX, timed waits on a Condition poll with
+# sleeps of up to 50 ms in Python 2
+POLL_MIN = 0.0001
+POLL_MAX = 0.005
+
+
+def _to_int(value):
+    """
+    Coerce a number, or a string with an integer literal or an integral
+    number ("1.0", "2e3"), to an int
+    """
+    if isinstance(value, basestring):
+        try:
+            return int(value, 0)
+        except ValueError:
+            pass
+        try:
+            number = float(value)
+        except ValueError:
+            number = None
+        if number is None or not number.is_integer():
+            raise ValueError("%s is not an integer" % value)
+        return int(number)
+    return int(value)
+
+
+def _to_float(value):
+    """Coerce a number, or a string with a number, to a float"""
+    return float(value)
+
 
 # One element entry in the TOC
 class ParamTocElement:
@@ -83,6 +118,14 @@ class ParamTocElement:
              0x06: ("float",    '<f'),
              0x07: ("double",   '<d')}
 
+    # Shared struct.Struct by format, built once
+    _packers = dict((pytype, struct.Struct(pytype))
+                    for (ctype, pytype) in types.values() if pytype)
+
+    # Set by compile(), None for types that cannot be packed
+    packer = None
+    coerce = None
+
     def __init__(self, data=None):
         """TocElement creator. Data is the binary payload of the element."""
         if (data):
@@ -106,6 +149,35 @@ class ParamTocElement:
             return "RO"
         return "RW"
 
+    def compile(self):
+        """
+        Set the struct.Struct and the coercion function of the element.
+        Called once the TOC is loaded, as elements from the TOC cache are not
+        built from their data.
+        """
+        self.packer = self._packers.get(self.pytype)
+        if self.pytype in ('<f', '<d'):
+            self.coerce = _to_float
+        else:
+            self.coerce = _to_int
+
+    def pack(self, value):
+        """
+        Return the binary value of the element. Raises ValueError if value
+        cannot be coerced to the type or is out of its range, or if the type
+        of the element cannot be packed.
+        """
+        if self.packer is None:
+            raise ValueError("%s values cannot be written" % self.ctype)
+        try:
+            return self.packer.pack(self.coerce(value))
+        except (struct.error, TypeError) as exp:
+            raise ValueError("%s: %s" % (self.ctype, str(exp)))
+
+    def unpack(self, data):
+        """Return the value of the element from its binary form"""
+        return self.packer.unpack(data)[0]
+
 
 class Param():
     """
@@ -114,25 +186,41 @@ class Param():
 
     toc = Toc()
 
-    def __init__(self, crazyflie):
+    def __init__(self, crazyflie, window=1):
+        """
+        Up to window requests are sent to the Crazyflie before waiting for
+        the answers.
+        """
         self.cf = crazyflie
         self.param_update_callbacks = {}
         self.group_update_callbacks = {}
         self.param_updater = None
-
-        self.param_updater = _ParamUpdater(self.cf, self._param_updated)
+        # Last value read of each parameter by complete name
+        self.values = {}
+        # Elements of the loaded TOC by id
+        self._elements_by_id = {}
+        # Called with the number of requests answered and the time (s) it
+        # took, every time the queued requests have all been answered
+        self.refresh_done = Caller()
+        # Called with the element and value of every parameter answer
+        self.value_received = Caller()
+
+        self.param_updater = _ParamUpdater(self.cf, self._param_updated,
+                                           self.refresh_done.call, window)
         self.param_updater.start()
 
         self.cf.disconnected.add_callback(self.param_updater.close)
 
     def _param_updated(self, pk):
         """Callback with data for an updated parameter"""
-        var_id = pk.datal[0]
-        element = self.toc.get_element_by_id(var_id)
+        var_id = pk.datab[0]
+        element = self._elements_by_id.get(var_id)
         if element:
-            s = struct.unpack(element.pytype, pk.data[1:])[0]
-            s = s.__str__()
+            s = element.unpack(pk.data[1:])
             complete_name = "%s.%s" % (element.group, element.name)
+            self.values[complete_name] = s
+            self.value_received.call(element, s)
+            s = s.__str__()
             logger.debug("Updated parameter [%s]" % complete_name)
             if complete_name in self.param_update_callbacks:
                 self.param_update_callbacks[complete_name].call(complete_name, s)
@@ -182,11 +270,28 @@ class Param():
         Initiate a refresh of the parameter TOC.
         """
         self.toc = Toc()
+        self.values = {}
+        self._elements_by_id = {}
+
+        def toc_loaded():
+            self._compile_toc()
+            refresh_done_callback()
         toc_fetcher = TocFetcher(self.cf, ParamTocElement,
                                 CRTPPort.PARAM, self.toc,
-                                refresh_done_callback, toc_cache)
+                                toc_loaded, toc_cache,
+                                self.cf.toc_window)
         toc_fetcher.start()
 
+    def _compile_toc(self):
+        """Compile the elements of the loaded TOC and index them by id"""
+        elements_by_id = {}
+        for group in self.toc.toc.values():
+            for element in group.values():
+                element.compile()
+                if element.packer:
+                    elements_by_id[element.ident] = element
+        self._elements_by_id = elements_by_id
+
     def disconnected(self, uri):
         """Disconnected callback from Crazyflie API"""
         self.param_updater.close()
@@ -200,7 +305,9 @@ class Param():
 
     def set_value(self, complete_name, value):
         """
-        Set the value for the supplied parameter.
+        Set the value for the supplied parameter. The value is a number, or a
+        string with a number. Raises ValueError if it does not fit the type of
+        the parameter.
         """
         element = self.toc.get_element_by_complete_name(complete_name)
 
@@ -210,57 +317,229 @@ class Param():
         elif element.access == ParamTocElement.RO_ACCESS:
             logger.debug("[%s] is read only, no trying to set value", complete_name)
         else:
-            varid = element.ident
-            pk = CRTPPacket()
-            pk.set_header(CRTPPort.PARAM, WRITE_CHANNEL)
-            pk.data = struct.pack('<B', varid)
-            pk.data += struct.pack(element.pytype, eval(value))
-            self.param_updater.request_param_setvalue(pk)
+            self._write(element, value)
+
+    def _write(self, element, value):
+        """Queue a request to write value to the element"""
+        pk = CRTPPacket()
+        pk.set_header(CRTPPort.PARAM, WRITE_CHANNEL)
+        pk.data = struct.pack('<B', element.ident) + element.pack(value)
+        self.param_updater.request_param_setvalue(pk)
+
+    def _elements(self, names=None):
+        """
+        Return the TOC elements of the complete names, or of all the
+        parameters. Names not in the TOC and types that cannot be unpacked
+        are left out.
+        """
+        if names is None:
+            elements = [e for group in self.toc.toc.values()
+                        for e in group.values()]
+        else:
+            elements = [self.toc.get_element_by_complete_name(name)
+                        for name in names]
+            elements = [e for e in elements if e]
+        return [e for e in elements if e.packer]
+
+    def take_snapshot(self, callback, names=None):
+        """
+        Read the parameters with the complete names, or all of them, and call
+        callback with a snapshot: a dict of the values by complete name.
+        Parameters that could not be read are left out, values read before
+        the snapshot are not used.
+        """
+        elements = self._elements(names)
+        wanted = set(element.ident for element in elements)
+        snapshot = {}
+
+        def received(element, value):
+            if element.ident in wanted:
+                snapshot["%s.%s" % (element.group, element.name)] = value
+
+        def done():
+            self.value_received.remove_callback(received)
+            callback(snapshot)
+
+        self.value_received.add_callback(received)
+        for element in elements:
+            self.param_updater.request_param_update(element.ident)
+        self.param_updater.when_idle(done)
+
+    def restore_snapshot(self, snapshot, callback=None):
+        """
+        Write the values of a snapshot that differ from the current ones.
+        The current values are read first, and the changed values are then
+        written pipelined. callback is called with the list of the names
+        written once they have all been answered. Read only parameters are
+        not written.
+        """
+        def restore(current):
+            changed = []
+            for name in sorted(snapshot.keys()):
+                element = self.toc.get_element_by_complete_name(name)
+                if element is None or not element.packer:
+                    continue
+                try:
+                    element.pack(snapshot[name])
+                except ValueError as exp:
+                    logger.warning("[%s] not restored: %s", name, str(exp))
+                    continue
+                if element.access == ParamTocElement.RO_ACCESS:
+                    if (name in current and
+                            _differs(element, current[name], snapshot[name])):
+                        logger.warning("[%s] is read only, not restored", name)
+                    continue
+                if (name not in current or
+                        _differs(element, current[name], snapshot[name])):
+                    self._write(element, snapshot[name])
+                    changed.append(name)
+            logger.info("Restoring %d of %d parameters", len(changed),
+                        len(snapshot))
+            if callback:
+                self.param_updater.when_idle(lambda: callback(changed))
+        self.take_snapshot(restore, snapshot.keys())
+
+
+def _differs(element, a, b):
+    """Return True if a and b are different values of the element"""
+    return element.pack(a) != element.pack(b)
+
+
+def save_snapshot(filename, snapshot):
+    """Save a snapshot of parameters to a JSON file"""
+    with open(filename, "w") as f:
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+
+
+def load_snapshot(filename):
+    """Load a snapshot of parameters saved with save_snapshot"""
+    with open(filename) as f:
+        snapshot = json.load(f)
+    return dict((str(name), value) for (name, value) in snapshot.items())
 
 
 class _ParamUpdater(Thread):
     """This thread will update params through a queue to make sure that we
-    get back values"""
-    def __init__(self, cf, updated_callback):
+    get back values. Up to window requests are outstanding at the same time,
+    at most one per variable, and a request that is not answered within
+    timeout seconds is given up."""
+    def __init__(self, cf, updated_callback, refresh_done_callback=None,
+                 window=1, timeout=REQUEST_TIMEOUT):
         """Initialize the thread"""
         Thread.__init__(self)
         self.setDaemon(True)
-        self.wait_lock = Lock()
         self.cf = cf
         self.updated_callback = updated_callback
+        self.refresh_done_callback = refresh_done_callback
+        self.window = max(1, window)
+        self.timeout = timeout
         self.request_queue = Queue()
         self.cf.add_port_callback(CRTPPort.PARAM, self._new_packet_cb)
         self._should_close = False
-        self._req_param = -1
+        self._cond = Condition()
+        # Deadline, answer pattern and sequence numbers of the requests
+        # answered by each outstanding request, by var id
+        self._outstanding = {}
+        # Sequence number of the last request queued, and of the requests
+        # not answered or given up yet
+        self._seq = 0
+        self._unfinished = set()
+        # Start time and number of answers of the current refresh
+        self._refresh_start = None
+        self._refresh_answers = 0
+        # Number of answers and duration (s) of the last refresh
+        self.last_refresh = None
+        self.timeouts = 0
+        # (sequence number, callback) called once the requests up to the
+        # sequence number are finished
+        self._idle_callbacks = []
+        # (callback, args) to call once the lock is released
+        self._reports = []
 
     def close(self, uri):
         # First empty the queue from all packets
         while not self.request_queue.empty():
             self.request_queue.get()
-        # Then force an unlock of the mutex if we are waiting for a packet
-        # we didn't get back due to a disconnect for example.
-        try:
-            self.wait_lock.release()
-        except:
-            pass
+        # Then forget the requests we will not get an answer to due to a
+        # disconnect for example.
+        with self._cond:
+            self._outstanding = {}
+            self._unfinished = set()
+            self._refresh_start = None
+            self._idle_callbacks = []
+            self._reports = []
+
+    def when_idle(self, callback):
+        """Call callback once all the requests queued so far are answered
+        or given up. Requests queued later are not waited for."""
+        with self._cond:
+            if self._unfinished:
+                self._idle_callbacks.append((self._seq, callback))
+                return
+        callback()
+
+    def _queue(self, pk):
+        """Queue a request, starting a refresh if none is running"""
+        with self._cond:
+            self._seq += 1
+            seq = self._seq
+            self._unfinished.add(seq)
+            if self._refresh_start is None:
+                self._refresh_start = time.time()
+                self._refresh_answers = 0
+        self.request_queue.put((seq, pk))
+
+    def _done(self, seqs):
+        """
+        Called with the lock held when the requests with the sequence
+        numbers seqs are answered or given up. The finished refresh and the
+        idle callbacks due are left for _report.
+        """
+        self._unfinished.difference_update(seqs)
+        if not self._unfinished and self._refresh_start is not None:
+            self.last_refresh = (self._refresh_answers,
+                                 time.time() - self._refresh_start)
+            self._refresh_start = None
+            logger.debug("%d parameter requests answered in %.3f s",
+                         *self.last_refresh)
+            if self.refresh_done_callback:
+                self._reports.append((self.refresh_done_callback,
+                                      self.last_refresh))
+        if self._idle_callbacks:
+            oldest = (min(self._unfinished) if self._unfinished
+                      else self._seq + 1)
+            waiting = []
+            for (seq, callback) in self._idle_callbacks:
+                if seq < oldest:
+                    self._reports.append((callback, ()))
+                else:
+                    waiting.append((seq, callback))
+            self._idle_callbacks = waiting
+
+    def _report(self):
+        """Call the callbacks left by _done, without the lock held"""
+        with self._cond:
+            (reports, self._reports) = (self._reports, [])
+        for (callback, args) in reports:
+            callback(*args)
 
     def request_param_setvalue(self, pk):
         """Place a param set value request on the queue. When this is sent to
         the Crazyflie it will answer with the update param value. """
-        self.request_queue.put(pk)
+        self._queue(pk)
 
     def _new_packet_cb(self, pk):
         """Callback for newly arrived packets"""
         if pk.channel == READ_CHANNEL or pk.channel == WRITE_CHANNEL:
-            var_id = pk.datal[0]
-            if (pk.channel != TOC_CHANNEL and self._req_param == var_id
-                and pk is not None):
-                self.updated_callback(pk)
-                self._req_param = -1
-                try:
-                    self.wait_lock.release()
-                except:
-                    pass
+            var_id = pk.datab[0]
+            with self._cond:
+                if var_id not in self._outstanding:
+                    return
+                (deadline, pattern, seqs) = self._outstanding.pop(var_id)
+                self._refresh_answers += 1
+                self._done(seqs)
+            self.updated_callback(pk)
+            self._report()
 
     def request_param_update(self, var_id):
         """Place a param update request on the queue"""
@@ -268,14 +547,70 @@ class _ParamUpdater(Thread):
         pk.set_header(CRTPPort.PARAM, READ_CHANNEL)
         pk.data = struct.pack('<B', var_id)
         logger.debug("Requesting request to update param [%d]", var_id)
-        self.request_queue.put(pk)
+        self._queue(pk)
+
+    def _expire(self):
+        """Give up the requests past their deadline, with the lock held"""
+        now = time.time()
+        for (var_id, (deadline, pattern, seqs)) in self._outstanding.items():
+            if deadline <= now:
+                logger.warning("No answer for param [%d] after %.1f s",
+                               var_id, self.timeout)
+                del self._outstanding[var_id]
+                self.timeouts += 1
+                # Stop resending it
+                self.cf._remove_answer_pattern(pattern)
+                self._done(seqs)
+
+    def _wait_for_slot(self, var_id):
+        """
+        Wait with the lock held until the window has room for a request for
+        var_id
+        """
+        delay = POLL_MIN
+        while (len(self._outstanding) >= self.window or
+               var_id in self._outstanding):
+            self._expire()
+            self._cond.release()
+            try:
+                time.sleep(delay)
+            finally:
+                self._cond.acquire()
+            delay = min(delay * 2, POLL_MAX)
 
     def run(self):
         while not self._should_close:
-            pk = self.request_queue.get()  # Wait for request update
-            self.wait_lock.acquire()
-            if self.cf.link:
-                self._req_param = pk.datal[0]
-                self.cf.send_packet(pk, expected_reply=(pk.datat[0:2]))
-            else:
-                self.wait_lock.release()
+            # Wait for request update, or for the outstanding requests to
+            # time out
+            try:
+                if self._outstanding:
+                    (seq, pk) = self.request_queue.get(True,
+                                                       self.timeout / 4)
+                else:
+                    (seq, pk) = self.request_queue.get()
+            except Empty:
+                with self._cond:
+                    self._expire()
+                self._report()
+                continue
+
+            var_id = pk.datab[0]
+            expected_reply = pk.datat[0:2]
+            with self._cond:
+                if (pk.channel == READ_CHANNEL and
+                        var_id in self._outstanding):
+                    # The answer to the outstanding request will do
+                    self._outstanding[var_id][2].append(seq)
+                    send = False
+                else:
+                    self._wait_for_slot(var_id)
+                    send = self.cf.link is not None
+                    if send:
+                        self._outstanding[var_id] = (
+                            time.time() + self.timeout,
+                            (pk.header,) + expected_reply, [seq])
+                    else:
+                        self._done([seq])
+            self._report()
+            if send:
+                self.cf.send_packet(pk, expected_reply=expected_reply)
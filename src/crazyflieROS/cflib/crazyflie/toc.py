@@ -122,13 +122,22 @@ class Toc:
 
 
 class TocFetcher:
-    """Fetches TOC entries from the Crazyflie"""
+    """
+    Fetches TOC entries from the Crazyflie.
+
+    Up to window element requests are kept outstanding at the same time.
+    Replies are accepted in any order and each request is retried on its own
+    until it is answered.
+    """
     def __init__(self, crazyflie, element_class, port, toc_holder,
-                 finished_callback, toc_cache):
+                 finished_callback, toc_cache, window=1):
         self.cf = crazyflie
         self.port = port
         self._crc = 0
-        self.requested_index = None
+        self.window = max(1, window)
+        self._next_index = 0
+        self._outstanding = set()
+        self._nbr_of_received = 0
         self.nbr_of_items = None
         self.state = None
         self.toc = toc_holder
@@ -160,7 +169,7 @@ class TocFetcher:
         chan = packet.channel
         if (chan != 0):
             return
-        payload = struct.pack("B" * (len(packet.datal) - 1), *packet.datal[1:])
+        payload = packet.data[1:]
 
         if (self.state == GET_TOC_INFO):
             [self.nbr_of_items, self._crc] = struct.unpack("<BI", payload[:5])
@@ -172,28 +181,46 @@ class TocFetcher:
                 self.toc.toc = cache_data
                 logger.info("TOC for port [%s] found in cache" % self.port)
                 self._toc_fetch_finished()
+            elif (self.nbr_of_items == 0):
+                self._toc_cache.insert(self._crc, self.toc.toc)
+                self._toc_fetch_finished()
             else:
                 self.state = GET_TOC_ELEMENT
-                self.requested_index = 0
-                self._request_toc_element(self.requested_index)
+                self._next_index = 0
+                self._outstanding = set()
+                self._nbr_of_received = 0
+                self._request_toc_elements()
 
         elif (self.state == GET_TOC_ELEMENT):
-            # Always add new element, but only request new if it's not the
-            # last one.
-            if self.requested_index != ord(payload[0]):
+            # Only add elements we are waiting for, replies to resent
+            # requests can arrive more than once
+            if packet.datab[0] != CMD_TOC_ELEMENT:
                 return
-            self.toc.add_element(self.element_class(payload))
-            logger.debug("Added element [%s]",
-                         self.element_class(payload).ident)
-            if (self.requested_index < (self.nbr_of_items - 1)):
-                logger.debug("[%d]: More variables, requesting index %d",
-                             self.port, self.requested_index + 1)
-                self.requested_index = self.requested_index + 1
-                self._request_toc_element(self.requested_index)
+            index = ord(payload[0])
+            if index not in self._outstanding:
+                return
+            self._outstanding.remove(index)
+            element = self.element_class(payload)
+            self.toc.add_element(element)
+            self._nbr_of_received += 1
+            logger.debug("Added element [%s]", element.ident)
+            if (self._nbr_of_received < self.nbr_of_items):
+                self._request_toc_elements()
             else:  # No more variables in TOC
                 self._toc_cache.insert(self._crc, self.toc.toc)
                 self._toc_fetch_finished()
 
+    def _request_toc_elements(self):
+        """Request new elements until the window is full or all the elements
+        have been requested"""
+        while (len(self._outstanding) < self.window and
+               self._next_index < self.nbr_of_items):
+            logger.debug("[%d]: More variables, requesting index %d",
+                         self.port, self._next_index)
+            self._outstanding.add(self._next_index)
+            self._request_toc_element(self._next_index)
+            self._next_index += 1
+
     def _request_toc_element(self, index):
         """Request information about a specific item in the TOC"""
         logger.debug("Requesting index %d on port %d", index, self.port)
@@ -29,78 +29,241 @@
 """
 Access the TOC cache for reading/writing. It supports both user
 cache and dist cache.
+
+Cache files are named after the TOC CRC and are either JSON (.json) or a
+compact binary format (.toc). Decoded TOCs are also kept in memory and shared
+by all the caches in the process, so reconnecting to the same Crazyflie does
+not touch the disk.
+
+Several processes can share the same cache directories. Files are written to
+a temporary file that is renamed in place, and readers and writers take a
+shared respectively exclusive lock on the directory while accessing it.
 """
 
 __author__ = 'Bitcraze AB'
 __all__ = ['TocCache']
 
 import os
+import errno
 import json
+import struct
+import tempfile
 from glob import glob
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    # No file locking on this platform, atomic renames are still used
+    fcntl = None
 
 import logging
 logger = logging.getLogger(__name__)
 
-from .log import LogTocElement  # pylint: disable=W0611
-from .param import ParamTocElement  # pylint: disable=W0611
- 
+from .log import LogTocElement
+from .param import ParamTocElement
+
+# The only classes a cache file is allowed to instantiate
+_ELEMENT_CLASSES = {'LogTocElement': LogTocElement,
+                    'ParamTocElement': ParamTocElement}
+_ELEMENT_CLASS_IDS = {'LogTocElement': 0,
+                      'ParamTocElement': 1}
+_ELEMENT_CLASS_NAMES = dict((v, k) for k, v in _ELEMENT_CLASS_IDS.items())
+
+# Binary format: magic, number of elements and then for each element the
+# class id, ident, access and the group, name, ctype and pytype strings,
+# each prefixed by its length
+_BIN_MAGIC = "CFTOC\x01"
+_BIN_HEADER = struct.Struct("<6sH")
+_BIN_ELEMENT = struct.Struct("<BBBBBBB")
+
+JSON_EXTENSION = ".json"
+BINARY_EXTENSION = ".toc"
+LOCK_FILE = ".lock"
+
+# Decoded TOCs by CRC, shared by all TocCache instances
+MEMORY_CACHE_SIZE = 16
+_memory = OrderedDict()
+_memory_lock = Lock()
+
+
+class _CacheDirLock(object):
+    """
+    Advisory lock on a cache directory, shared for readers and exclusive for
+    writers. Does nothing if the platform has no fcntl or if the lock file
+    cannot be created (i.e a read-only cache).
+    """
+    def __init__(self, path, exclusive=False):
+        self._path = path
+        self._exclusive = exclusive
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            try:
+                self._file = open(os.path.join(self._path, LOCK_FILE), 'a')
+            except (IOError, OSError):
+                return self
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if
+                        self._exclusive else fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
 
 
 class TocCache():
     """
     Access to TOC cache. To turn of the cache functionality
     don't supply any directories.
+
+    ro_cache -- Path to read-only cache (string)
+    rw_cache -- Path to read-write cache, can be shared between processes
+                (string)
+    binary -- Write new cache files in the binary format instead of JSON
     """
-    def __init__(self, ro_cache=None, rw_cache=None):
-        self._cache_files = []
+    def __init__(self, ro_cache=None, rw_cache=None, binary=False):
+        # Cache files indexed by CRC, files in rw_cache override ro_cache
+        self._cache_files = {}
         if (ro_cache):
-            self._cache_files += glob(ro_cache + "/*.json")
+            self._index_files(ro_cache)
         if (rw_cache):
-            self._cache_files += glob(rw_cache + "/*.json")
-            if not os.path.exists(rw_cache):
+            self._index_files(rw_cache)
+            try:
                 os.makedirs(rw_cache)
+            except OSError as exp:
+                # Other processes sharing the cache may create it first
+                if exp.errno != errno.EEXIST or not os.path.isdir(rw_cache):
+                    raise
 
+        self._ro_cache = ro_cache
         self._rw_cache = rw_cache
+        self._binary = binary
+
+    def _index_files(self, path):
+        """Add the cache files found in path to the index"""
+        for name in (glob(path + "/*" + JSON_EXTENSION) +
+                     glob(path + "/*" + BINARY_EXTENSION)):
+            try:
+                crc = int(os.path.splitext(os.path.basename(name))[0], 16)
+            except ValueError:
+                continue
+            self._cache_files[crc] = name
+
+    def _find_file(self, crc):
+        """Look for a cache file that was added after the index was built"""
+        for path in (self._rw_cache, self._ro_cache):
+            if path:
+                for ext in (BINARY_EXTENSION, JSON_EXTENSION):
+                    name = "%s/%08X%s" % (path, crc, ext)
+                    if os.path.isfile(name):
+                        self._cache_files[crc] = name
+                        return name
+        return None
+
+    @staticmethod
+    def _remember(crc, toc):
+        """Keep a decoded TOC in memory, dropping the least recently used"""
+        with _memory_lock:
+            _memory.pop(crc, None)
+            _memory[crc] = toc
+            while len(_memory) > MEMORY_CACHE_SIZE:
+                _memory.popitem(last=False)
+
+    @staticmethod
+    def _recall(crc):
+        """Get a decoded TOC from memory, or None"""
+        with _memory_lock:
+            toc = _memory.pop(crc, None)
+            if toc is not None:
+                _memory[crc] = toc
+            return toc
+
+    @staticmethod
+    def _copy(toc):
+        """Copy the group dicts so the cached TOC is not modified by users"""
+        return dict((group, dict(elements))
+                    for (group, elements) in toc.items())
 
     def fetch(self, crc):
         """ Try to get a hit in the cache, return None otherwise """
-        cache_data = None
-        pattern = "%08X.json" % crc
-        hit = None
+        toc = self._recall(crc)
+        if toc is not None:
+            return self._copy(toc)
 
-        for name in self._cache_files:
-            if (name.endswith(pattern)):
-                hit = name
+        cache_data = None
+        hit = self._cache_files.get(crc)
+        if not hit:
+            hit = self._find_file(crc)
 
         if (hit):
             try:
-                cache = open(hit)
-                cache_data = json.load(cache,
-                                       object_hook=self._decoder)
-                cache.close()
+                with _CacheDirLock(os.path.dirname(hit)):
+                    cache = open(hit, 'rb')
+                    data = cache.read()
+                    cache.close()
+                if hit.endswith(BINARY_EXTENSION):
+                    cache_data = self._decode_binary(data)
+                else:
+                    cache_data = json.loads(data, object_hook=self._decoder)
+                self._remember(crc, cache_data)
+                cache_data = self._copy(cache_data)
             except Exception as exp:
                 logger.warning("Error while parsing cache file [%s]:%s",
                                hit, str(exp))
+                cache_data = None
 
         return cache_data
 
     def insert(self, crc, toc):
         """ Save a new cache to file """
+        self._remember(crc, self._copy(toc))
         if self._rw_cache:
             try:
-                filename = "%s/%08X.json" % (self._rw_cache, crc)
-                cache = open(filename, 'w')
-                cache.write(json.dumps(toc, indent=2,
-                            default=self._encoder))
-                cache.close()
+                if self._binary:
+                    filename = "%s/%08X%s" % (self._rw_cache, crc,
+                                              BINARY_EXTENSION)
+                    data = self._encode_binary(toc)
+                else:
+                    filename = "%s/%08X%s" % (self._rw_cache, crc,
+                                              JSON_EXTENSION)
+                    data = json.dumps(toc, indent=2, default=self._encoder)
+                self._write_file(filename, data)
                 logger.info("Saved cache to [%s]", filename)
-                self._cache_files += [filename]
+                self._cache_files[crc] = filename
             except Exception as exp:
                 logger.warning("Could not save cache to file [%s]: %s",
                                filename, str(exp))
         else:
             logger.warning("Could not save cache, no writable directory")
 
+    def _write_file(self, filename, data):
+        """
+        Atomically write data to filename in the rw cache. If another process
+        already cached the TOC, in any format, the cache is left as it is.
+        """
+        base = os.path.splitext(filename)[0]
+        with _CacheDirLock(self._rw_cache, exclusive=True):
+            if (os.path.isfile(base + JSON_EXTENSION) or
+                    os.path.isfile(base + BINARY_EXTENSION)):
+                return
+            (fd, tmp_name) = tempfile.mkstemp(dir=self._rw_cache,
+                                              prefix=".", suffix=".tmp")
+            try:
+                cache = os.fdopen(fd, 'wb')
+                cache.write(data)
+                cache.flush()
+                os.fsync(cache.fileno())
+                cache.close()
+                os.rename(tmp_name, filename)
+            except:
+                os.remove(tmp_name)
+                raise
+
     def _encoder(self, obj):
         """ Encode a toc element leaf-node """
         return {'__class__': obj.__class__.__name__,
@@ -115,7 +278,11 @@ class TocCache():
     def _decoder(self, obj):
         """ Decode a toc element leaf-node """
         if '__class__' in obj:
-            elem = eval(obj['__class__'])()
+            try:
+                elem = _ELEMENT_CLASSES[obj['__class__']]()
+            except KeyError:
+                raise ValueError("Unknown TOC element class [%s]" %
+                                 obj['__class__'])
             elem.ident = obj['ident']
             elem.group = str(obj['group'])
             elem.name = str(obj['name'])
@@ -124,3 +291,41 @@ class TocCache():
             elem.access = obj['access']
             return elem
         return obj
+
+    def _encode_binary(self, toc):
+        """ Encode the toc in the binary format """
+        elements = [e for group in toc.values() for e in group.values()]
+        data = [_BIN_HEADER.pack(_BIN_MAGIC, len(elements))]
+        for e in elements:
+            strings = (e.group, e.name, e.ctype, e.pytype)
+            data.append(_BIN_ELEMENT.pack(
+                _ELEMENT_CLASS_IDS[e.__class__.__name__], e.ident, e.access,
+                *[len(x) for x in strings]))
+            data.extend(strings)
+        return "".join(data)
+
+    def _decode_binary(self, data):
+        """ Decode a toc encoded by _encode_binary """
+        [magic, count] = _BIN_HEADER.unpack_from(data)
+        if magic != _BIN_MAGIC:
+            raise ValueError("Not a binary TOC cache file")
+        offset = _BIN_HEADER.size
+        toc = {}
+        for i in range(count):
+            [class_id, ident, access, group_len, name_len, ctype_len,
+             pytype_len] = _BIN_ELEMENT.unpack_from(data, offset)
+            offset += _BIN_ELEMENT.size
+            try:
+                elem = _ELEMENT_CLASSES[_ELEMENT_CLASS_NAMES[class_id]]()
+            except KeyError:
+                raise ValueError("Unknown TOC element class id [%d]" %
+                                 class_id)
+            strings = []
+            for length in (group_len, name_len, ctype_len, pytype_len):
+                strings.append(data[offset:offset + length])
+                offset += length
+            [elem.group, elem.name, elem.ctype, elem.pytype] = strings
+            elem.ident = ident
+            elem.access = access
+            toc.setdefault(elem.group, {})[elem.name] = elem
+        return toc
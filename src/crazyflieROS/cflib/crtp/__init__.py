@@ -39,9 +39,10 @@ from .radiodriver import RadioDriver
 from .udpdriver import UdpDriver
 from .serialdriver import SerialDriver
 from .debugdriver import DebugDriver
+from .replaydriver import ReplayDriver
 from .exceptions import WrongUriType
 
-DRIVERS = [RadioDriver, SerialDriver, UdpDriver, DebugDriver]
+DRIVERS = [RadioDriver, SerialDriver, UdpDriver, ReplayDriver, DebugDriver]
 INSTANCES = []
 
 
@@ -55,14 +56,28 @@ def init_drivers(enable_debug_driver=False):
             continue
 
 
-def scan_interfaces():
-    """ Scan all the interfaces for available Crazyflies """
+def scan_interfaces(found_callback=None, quick=False):
+    """
+    Scan all the interfaces for available Crazyflies
+
+    found_callback -- Called with each link found. The radio streams its
+                      links while scanning, the other drivers report theirs
+                      when they are done
+    quick -- Only probe the radio links found before, if any answers (see
+             RadioDriver.scan_interface)
+    """
     available = []
     found = []
     for instance in INSTANCES:
         logger.debug("Scanning: %s", instance)
         try:
-            found = instance.scan_interface()
+            if isinstance(instance, RadioDriver):
+                found = instance.scan_interface(found_callback, quick)
+            else:
+                found = instance.scan_interface()
+                if found_callback:
+                    for link in found:
+                        found_callback(link)
             available += found
         except Exception:
             raise
@@ -84,6 +99,9 @@ def get_link_driver(uri, link_quality_callback=None, link_error_callback=None):
     """Return the link driver for the given URI"""
     for instance in INSTANCES:
         try:
+            if getattr(instance, "share_radio", False):
+                # Links sharing a radio each need their own driver
+                instance = instance.__class__()
             instance.connect(uri, link_quality_callback, link_error_callback)
             return instance
         except WrongUriType:
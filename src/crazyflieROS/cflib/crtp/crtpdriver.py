@@ -65,6 +65,11 @@ class CRTPDriver:
         @return One CRTP packet or None if no packet has been received.
         """
 
+    def set_log_period(self, period):
+        """Hint the driver about the shortest period (in seconds) of the
+        started log blocks, None if no block is started
+        """
+
     def get_status(self):
         """
         Return a status string from the interface.
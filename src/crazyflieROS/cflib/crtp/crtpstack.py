@@ -34,7 +34,7 @@ __author__ = 'Bitcraze AB'
 __all__ = ['CRTPPort', 'CRTPPacket']
 
 
-import struct
+import array
 
 
 class CRTPPort:
@@ -54,14 +54,20 @@ class CRTPPort:
 class CRTPPacket(object):
     """
     A packet that can be sent via the CRTP.
+
+    The payload is kept in a single bytearray. The data/datal/datat
+    properties build the str, list or tuple view on access, while datab
+    and datav give direct access to the buffer without copying it.
     """
 
+    __slots__ = ('size', 'header', '_port', '_channel', '_buf')
+
     def __init__(self, header=0, data=None):
         """
         Create an empty packet with default values.
         """
         self.size = 0
-        self._data = ""
+        self._buf = bytearray()
         # The two bits in position 3 and 4 needs to be set for legacy
         # support of the bootloader
         self.header = header | 0x3 << 2
@@ -106,42 +112,48 @@ class CRTPPacket(object):
         # The two bits in position 3 and 4 needs to be set for legacy
         # support of the bootloader
         self.header = ((self._port & 0x0f) << 4 | 3 << 2 |
-                       (self.channel & 0x03))
+                       (self._channel & 0x03))
 
     #Some python madness to access different format of the data
     def _get_data(self):
         """Get the packet data"""
-        return self._data
+        return str(self._buf)
 
     def _set_data(self, data):
         """Set the packet data"""
-        if type(data) == str:
-            self._data = data
-        elif type(data) == list or type(data) == tuple:
-            if len(data) == 1:
-                self._data = struct.pack("B", data[0])
-            elif len(data) > 1:
-                self._data = struct.pack("B" * len(data), *data)
-            else:
-                self._data = ""
+        t = type(data)
+        if t == str or t == list or t == tuple or t == bytearray:
+            self._buf = bytearray(data)
+        elif t == buffer or t == memoryview or t == array.array:
+            self._buf = bytearray(data)
         else:
             raise Exception("Data shall be of str, tupple or list type")
 
     def _get_data_l(self):
         """Get the data in the packet as a list"""
-        return list(self._get_data_t())
+        return list(self._buf)
 
     def _get_data_t(self):
         """Get the data in the packet as a tuple"""
-        return struct.unpack("B" * len(self._data), self._data)
+        return tuple(self._buf)
+
+    def _get_data_b(self):
+        """Get the bytearray backing the packet data (not a copy)"""
+        return self._buf
+
+    def _get_data_v(self):
+        """Get a memoryview of the packet data, slices do not copy"""
+        return memoryview(self._buf)
 
     def __str__(self):
         """Get a string representation of the packet"""
-        return "{}:{} {}".format(self._port, self.channel, self.datat)
+        return "{}:{} {}".format(self._port, self._channel, self.datat)
 
     data = property(_get_data, _set_data)
     datal = property(_get_data_l, _set_data)
     datat = property(_get_data_t, _set_data)
     datas = property(_get_data, _set_data)
+    datab = property(_get_data_b, _set_data)
+    datav = property(_get_data_v)
     port = property(_get_port, _set_port)
     channel = property(_get_channel, _set_channel)
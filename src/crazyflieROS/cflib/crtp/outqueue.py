@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2011-2013 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Outgoing packet queue with priority classes keyed on the CRTP port.
+
+Commander packets are sent first and only the latest packet for each
+commander channel is kept, since an older setpoint is of no use once a new
+one has been sent. Log, param and link control packets come next, followed
+by everything else (sync, console, debug). Packets are sent in order within
+a class.
+"""
+
+__author__ = 'Bitcraze AB'
+__all__ = ['PriorityOutQueue']
+
+from collections import deque, OrderedDict
+from threading import Condition
+import time
+import Queue
+
+from .crtpstack import CRTPPort
+
+# Priority classes, highest first
+CLASS_COMMANDER = 0
+CLASS_CONTROL = 1
+CLASS_BULK = 2
+CLASS_NAMES = ("commander", "control", "bulk")
+
+_PORT_CLASSES = {CRTPPort.COMMANDER: CLASS_COMMANDER,
+                 CRTPPort.LOGGING: CLASS_CONTROL,
+                 CRTPPort.PARAM: CLASS_CONTROL,
+                 CRTPPort.LINKCTRL: CLASS_CONTROL}
+
+# Timed waits poll the queue with an interval growing from POLL_MIN to
+# POLL_MAX, see ringbuffer.py
+POLL_MIN = 0.0001
+POLL_MAX = 0.005
+
+
+class _ClassStats():
+    """Queue depth and wait time of one priority class"""
+
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.replaced = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self):
+        return {"depth": self.depth,
+                "max_depth": self.max_depth,
+                "sent": self.sent,
+                "replaced": self.replaced,
+                "mean_wait": (self.total_wait / self.sent if self.sent
+                              else 0.0),
+                "max_wait": self.max_wait}
+
+
+class PriorityOutQueue():
+    """
+    Queue of outgoing packets with the interface of Queue.Queue.
+
+    maxsize limits the number of queued control and bulk packets. Commander
+    packets replace each other and never block.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._cond = Condition()
+        # Latest commander packet and put time by header
+        self._commander = OrderedDict()
+        # (packet, put time) for the other classes
+        self._queues = (None, deque(), deque())
+        self._stats = [_ClassStats() for name in CLASS_NAMES]
+
+    @staticmethod
+    def get_class(pk):
+        """Return the priority class of the packet pk"""
+        return _PORT_CLASSES.get(pk.port, CLASS_BULK)
+
+    def _qsize(self):
+        return (len(self._commander) + len(self._queues[CLASS_CONTROL]) +
+                len(self._queues[CLASS_BULK]))
+
+    def qsize(self):
+        with self._cond:
+            return self._qsize()
+
+    def empty(self):
+        with self._cond:
+            return self._qsize() == 0
+
+    def full(self):
+        with self._cond:
+            return self._full()
+
+    def _full(self):
+        return 0 < self.maxsize <= (len(self._queues[CLASS_CONTROL]) +
+                                    len(self._queues[CLASS_BULK]))
+
+    def put(self, pk, block=True, timeout=None):
+        """Queue the packet pk, see Queue.Queue.put"""
+        cls = self.get_class(pk)
+        with self._cond:
+            if cls == CLASS_COMMANDER:
+                stats = self._stats[cls]
+                old = self._commander.pop(pk.header, None)
+                if old:
+                    # Keep the time of the replaced packet, the setpoint has
+                    # been waiting since then
+                    stats.replaced += 1
+                    self._commander[pk.header] = (pk, old[1])
+                else:
+                    self._commander[pk.header] = (pk, time.time())
+                stats.depth = len(self._commander)
+                stats.max_depth = max(stats.max_depth, stats.depth)
+                self._cond.notify()
+                return
+
+            if self._full():
+                if not block:
+                    raise Queue.Full
+                self._wait(self._full, timeout, Queue.Full)
+            stats = self._stats[cls]
+            self._queues[cls].append((pk, time.time()))
+            stats.depth = len(self._queues[cls])
+            stats.max_depth = max(stats.max_depth, stats.depth)
+            self._cond.notify()
+
+    def put_nowait(self, pk):
+        return self.put(pk, False)
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the packet to send next, see Queue.Queue.get"""
+        with self._cond:
+            if self._qsize() == 0:
+                if not block:
+                    raise Queue.Empty
+                self._wait(lambda: self._qsize() == 0, timeout, Queue.Empty)
+
+            if self._commander:
+                cls = CLASS_COMMANDER
+                (pk, put_time) = self._commander.popitem(last=False)[1]
+                depth = len(self._commander)
+            else:
+                cls = CLASS_CONTROL if self._queues[CLASS_CONTROL] else \
+                    CLASS_BULK
+                (pk, put_time) = self._queues[cls].popleft()
+                depth = len(self._queues[cls])
+                self._cond.notify()
+
+            stats = self._stats[cls]
+            wait = time.time() - put_time
+            stats.depth = depth
+            stats.sent += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            return pk
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def _wait(self, blocked, timeout, exception):
+        """
+        Wait with the lock held until blocked() is false, or raise exception
+        after timeout seconds. Timed waits release the lock and poll.
+        """
+        if timeout is None:
+            while blocked():
+                self._cond.wait()
+            return
+        if timeout < 0:
+            raise ValueError("'timeout' must be a non-negative number")
+        deadline = time.time() + timeout
+        delay = POLL_MIN
+        while blocked():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise exception
+            self._cond.release()
+            try:
+                time.sleep(min(remaining, delay))
+            finally:
+                self._cond.acquire()
+            delay = min(delay * 2, POLL_MAX)
+
+    def get_stats(self, reset=False):
+        """
+        Return a dict with the stats of each class by name: current and max
+        depth, number of packets sent and replaced, and mean and max time
+        (s) the sent packets waited in the queue. If reset is set the max
+        values and counters are restarted.
+        """
+        with self._cond:
+            stats = dict((CLASS_NAMES[cls], self._stats[cls].as_dict())
+                         for cls in range(len(CLASS_NAMES)))
+            if reset:
+                for s in self._stats:
+                    s.max_depth = s.depth
+                    s.sent = s.replaced = 0
+                    s.total_wait = s.max_wait = 0.0
+            return stats
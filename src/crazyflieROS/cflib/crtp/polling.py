@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2011-2013 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Policies deciding how often the radio driver polls the Crazyflie.
+
+The Crazyflie can only send a packet back in the ack of a packet from the
+radio, so when there is nothing to send the radio thread sends null packets
+to poll it. After every USB transfer the policy returns how long the radio
+thread may wait for an outgoing packet before polling again. Outgoing packets
+always end the wait, so setpoints are sent as soon as they are queued.
+"""
+
+__author__ = 'Bitcraze AB'
+__all__ = ['PollingPolicy', 'AdaptivePollingPolicy']
+
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# How often the statistics are updated (s)
+STATS_PERIOD = 1.0
+
+
+class PollingPolicy():
+    """
+    Fixed polling policy. Poll as fast as possible while packets are
+    received, and every idle_interval seconds once empty_before_idle empty
+    acks have been received in a row.
+    """
+
+    def __init__(self, idle_interval=0.01, empty_before_idle=10):
+        self.idle_interval = idle_interval
+        self.empty_before_idle = empty_before_idle
+        self._empty = 0
+        self.log_period = None
+
+        # Last chosen interval and USB transfers per second
+        self.interval = 0
+        self.transfers_per_second = 0
+        self._transfers = 0
+        self._stats_start = time.time()
+
+    def set_log_period(self, period):
+        """Set the shortest period (s) of the started log blocks, or None"""
+        self.log_period = period
+
+    def transfer(self, sent, received):
+        """
+        Called after every USB transfer, with sent True if it carried a packet
+        and received True if the ack carried a packet. Returns the time (s)
+        to wait for an outgoing packet before the next transfer.
+        """
+        self._count_transfer()
+        if received:
+            self._empty = 0
+            self.interval = 0
+        else:
+            self._empty = min(self._empty + 1, self.empty_before_idle)
+            if self._empty >= self.empty_before_idle:
+                self.interval = self.idle_interval
+            else:
+                self.interval = 0
+        return self.interval
+
+    def _count_transfer(self):
+        """Update the USB transfer rate"""
+        self._transfers += 1
+        now = time.time()
+        if now - self._stats_start >= STATS_PERIOD:
+            self.transfers_per_second = (self._transfers /
+                                         (now - self._stats_start))
+            self._transfers = 0
+            self._stats_start = now
+            logger.debug("Polling every %.1f ms, %.0f USB transfers/s",
+                         self.interval * 1000, self.transfers_per_second)
+
+    def __str__(self):
+        return "polling every %.1f ms, %.0f USB transfers/s" % (
+            self.interval * 1000, self.transfers_per_second)
+
+
+class AdaptivePollingPolicy(PollingPolicy):
+    """
+    Polling policy adapted to the load of the link.
+
+    Poll immediately while packets are received and soon after a packet has
+    been sent, since the answer is usually in one of the next acks. When the
+    link goes quiet the interval doubles from min_interval up to a limit.
+    The limit is max_interval, lowered to half of the measured interval
+    between received packets and half of the shortest log period, so
+    streamed packets do not wait in the queue of the Crazyflie.
+    """
+
+    def __init__(self, min_interval=0.0005, max_interval=0.01,
+                 smoothing=0.1):
+        PollingPolicy.__init__(self, idle_interval=max_interval)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+        # Smoothed interval between received packets
+        self.rx_interval = None
+        self._last_rx = None
+        self._last_received = False
+
+    def _limit(self):
+        """The longest interval allowed by the current load"""
+        limit = self.max_interval
+        if self.rx_interval is not None:
+            limit = min(limit, self.rx_interval / 2)
+        if self.log_period:
+            limit = min(limit, self.log_period / 2)
+        return max(limit, self.min_interval)
+
+    def transfer(self, sent, received):
+        self._count_transfer()
+        if received:
+            now = time.time()
+            # Only measure the streams, not the bursts of queued packets that
+            # are received back to back
+            if self._last_rx is not None and not self._last_received:
+                gap = now - self._last_rx
+                if self.rx_interval is None:
+                    self.rx_interval = gap
+                else:
+                    self.rx_interval += self.smoothing * (
+                        gap - self.rx_interval)
+            self._last_rx = now
+            self.interval = 0
+        elif sent:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self._limit(),
+                                max(self.min_interval, self.interval * 2))
+            # Stop following a stream once it has been silent for long
+            if (self.rx_interval is not None and self._last_rx is not None and
+                    time.time() - self._last_rx > 4 * self.rx_interval):
+                self.rx_interval = None
+        self._last_received = received
+        return self.interval
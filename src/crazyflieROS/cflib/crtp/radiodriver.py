@@ -42,17 +42,73 @@ logger = logging.getLogger(__name__)
 from cflib.crtp.crtpdriver import CRTPDriver
 from .crtpstack import CRTPPacket
 from .exceptions import WrongUriType
+from .ringbuffer import RingBuffer
+from .outqueue import PriorityOutQueue
+from .polling import AdaptivePollingPolicy
+from .scancache import ScanCache
+from . import radiomux
+from .radiomux import DROPPED_WARNING_INTERVAL
 import threading
+import time
 import Queue
 import re
 import array
 
-from cflib.drivers.crazyradio import Crazyradio
+from cflib.drivers.crazyradio import Crazyradio, _find_devices
 from usb import USBError
 
+# Size of the queue of received packets when using the ring buffer backend.
+# When it is full the radio thread drops the received packets.
+IN_QUEUE_SIZE = 1000
+# Size of the queue of packets to send, limited to avoid "ReadBack" effect
+OUT_QUEUE_SIZE = 50
+
+# Data rates scanned and their names in the URIs, in the order of the results
+SCAN_DATA_RATES = ((Crazyradio.DR_250KPS, "250K"),
+                   (Crazyradio.DR_1MPS, "1M"),
+                   (Crazyradio.DR_2MPS, "2M"))
+# Number of channels scanned at a time by a dongle
+SCAN_CHUNK = 32
+# Held while scanning, and while opening a link so a background scan does
+# not take the dongles
+_scan_lock = threading.Lock()
+# Drivers with an open link, no background scan is done while there are any
+_open_links = set()
+
 
 class RadioDriver(CRTPDriver):
     """ Crazyradio link driver """
+
+    # Queues used between the radio thread and the rest of the library,
+    # either "queue" for Queue.Queue or "ring" for RingBuffer. It always
+    # applies to the queue of received packets, and to the queue of packets
+    # to send only when priority_out_queue is not set.
+    queue_backend = "queue"
+    # Send the packets by priority class (commander first) instead of in
+    # the order they were queued, with a PriorityOutQueue
+    priority_out_queue = True
+    # Class of the policy deciding how often the Crazyflie is polled
+    polling_policy_class = AdaptivePollingPolicy
+    # Share the dongles between links, so one Crazyradio can be connected to
+    # several Crazyflies. Each link then gets its own driver instance. The
+    # links have to be opened in the same process, the ROS driver node only
+    # opens one link so it does not set this.
+    share_radio = False
+    # Largest number of queued packets sent in one batch of overlapping USB
+    # transfers (see Crazyradio.send_packets), 1 to send them one by one.
+    # Not used by shared links.
+    usb_batch = 1
+    # Crazyflies found by the scans, by dongle. Use scan_cache.load() to
+    # keep it between runs.
+    scan_cache = ScanCache()
+    # Interval (s) of the full scans done in the background after a quick
+    # scan, 0 to only scan when asked
+    background_scan_interval = 0
+    # Numbers of the dongles the scans use, None for every dongle that is
+    # not open in this process. Dongles used by other processes are not
+    # seen as open, so only scan with them when no other driver runs.
+    scan_dongles = (0,)
+
     def __init__(self):
         """ Create the link driver """
         CRTPDriver.__init__(self)
@@ -63,11 +119,16 @@ class RadioDriver(CRTPDriver):
         self.in_queue = None
         self.out_queue = None
         self._thread = None
+        self.polling_policy = None
+        self._mux = None
+        self._mux_link = None
+        self._background_scan = None
 
     def connect(self, uri, link_quality_callback, link_error_callback):
         """
         Connect the link driver to a specified URI of the format:
-        radio://<dongle nbr>/<radio channel>/[250K,1M,2M]
+        radio://<dongle nbr>/<radio channel>/[250K,1M,2M]/[address]
+        where the address is given as 10 hex digits (default E7E7E7E7E7)
 
         The callback for linkQuality can be called at any moment from the
         driver to report back the link quality in percentage. The
@@ -79,14 +140,18 @@ class RadioDriver(CRTPDriver):
         if not re.search("^radio://", uri):
             raise WrongUriType("Not a radio URI")
 
-        # Open the USB dongle
-        if not re.search("^radio://([0-9]+)((/([0-9]+))(/(250K|1M|2M))?)?$",
-                         uri):
-            raise WrongUriType('Wrong radio URI format!')
+        # Wait for a background scan to release the dongles
+        with _scan_lock:
+            self._connect(uri, link_quality_callback, link_error_callback)
+            _open_links.add(self)
 
+    def _connect(self, uri, link_quality_callback, link_error_callback):
+        # Open the USB dongle
         uri_data = re.search("^radio://([0-9]+)((/([0-9]+))"
-                             "(/(250K|1M|2M))?)?$",
+                             "(/(250K|1M|2M))?(/([0-9A-Fa-f]{10}))?)?$",
                              uri)
+        if not uri_data:
+            raise WrongUriType('Wrong radio URI format!')
 
         self.uri = uri
 
@@ -102,6 +167,17 @@ class RadioDriver(CRTPDriver):
         if uri_data.group(6) == "2M":
             datarate = Crazyradio.DR_2MPS
 
+        address = None
+        if uri_data.group(8):
+            address = tuple(int(uri_data.group(8)[i:i + 2], 16)
+                            for i in range(0, 10, 2))
+
+        if self.share_radio:
+            self._connect_shared(int(uri_data.group(1)), channel, datarate,
+                                 address or (0xE7,) * 5,
+                                 link_quality_callback, link_error_callback)
+            return
+
         if self.cradio is None:
             self.cradio = Crazyradio(devid=int(uri_data.group(1)))
         else:
@@ -116,20 +192,80 @@ class RadioDriver(CRTPDriver):
 
         self.cradio.set_data_rate(datarate)
 
-        # Prepare the inter-thread communication queue
-        self.in_queue = Queue.Queue()
-        # Limited size out queue to avoid "ReadBack" effect
-        self.out_queue = Queue.Queue(50)
+        if address:
+            self.cradio.set_address(address)
+
+        # Prepare the inter-thread communication queues
+        self._create_queues()
+
+        self.polling_policy = self.polling_policy_class()
 
         # Launch the comm thread
         self._thread = _RadioDriverThread(self.cradio, self.in_queue,
                                           self.out_queue,
+                                          self.polling_policy,
                                           link_quality_callback,
-                                          link_error_callback)
+                                          link_error_callback,
+                                          self.usb_batch)
         self._thread.start()
 
         self.link_error_callback = link_error_callback
 
+    def _create_queues(self):
+        """ Create the queues between the radio thread and the library """
+        if self.queue_backend not in ("queue", "ring"):
+            raise Exception("Unknown queue backend [%s]" % self.queue_backend)
+        ring = self.queue_backend == "ring"
+        if ring:
+            self.in_queue = RingBuffer(IN_QUEUE_SIZE)
+        else:
+            self.in_queue = Queue.Queue()
+        if self.priority_out_queue:
+            if ring:
+                logger.warning("The ring queue backend is only used for the "
+                               "incoming packets, the outgoing ones go "
+                               "through the priority queue")
+            self.out_queue = PriorityOutQueue(OUT_QUEUE_SIZE)
+        elif ring:
+            # Packets are sent from several threads
+            self.out_queue = RingBuffer(OUT_QUEUE_SIZE, multi_producer=True)
+        else:
+            self.out_queue = Queue.Queue(OUT_QUEUE_SIZE)
+
+    def _connect_shared(self, devid, channel, datarate, address,
+                        link_quality_callback, link_error_callback):
+        """ Connect through the multiplexer of the dongle """
+        if self._mux is not None:
+            raise Exception("Link already open!")
+        self._create_queues()
+        self.polling_policy = self.polling_policy_class()
+        self._mux_link = radiomux.MuxLink(self.uri, channel, datarate,
+                                          address, self.in_queue,
+                                          self.out_queue, self.polling_policy,
+                                          link_quality_callback,
+                                          link_error_callback)
+        self._mux = radiomux.get_multiplexer(devid)
+        self._mux.add_link(self._mux_link)
+        self.link_error_callback = link_error_callback
+
+    def set_weight(self, weight):
+        """
+        Set the share of a shared dongle this link gets when several links
+        are busy, relative to the other links (default 1)
+        """
+        if self._mux_link:
+            self._mux_link.weight = weight
+
+    def get_link_stats(self):
+        """
+        Return the weight, the effective rates (per second) of sent and
+        received packets and USB transfers, and the number of received
+        packets dropped on a full queue of a shared link, or None
+        """
+        if self._mux_link:
+            return self._mux_link.get_stats()
+        return None
+
     def receive_packet(self, time=0):
         """
         Receive a packet though the link. This call is blocking but will
@@ -155,32 +291,62 @@ class RadioDriver(CRTPDriver):
         """ Send the packet pk though the link """
         # if self.out_queue.full():
         #    self.out_queue.get()
-        if (self.cradio is None):
+        if (self.cradio is None and self._mux is None):
             return
 
         try:
             self.out_queue.put(pk, True, 2)
+            if self._mux:
+                self._mux.wake()
         except Queue.Full:
             if self.link_error_callback:
                 self.link_error_callback("RadioDriver: Could not send packet"
                                          " to copter")
 
+    def get_out_queue_stats(self, reset=False):
+        """
+        Return the depth and wait time of each priority class of the out
+        queue, see PriorityOutQueue.get_stats. None if the priority queue is
+        not used.
+        """
+        if isinstance(self.out_queue, PriorityOutQueue):
+            return self.out_queue.get_stats(reset)
+        return None
+
+    def set_log_period(self, period):
+        """ Poll the Crazyflie often enough for the started log blocks """
+        if self.polling_policy:
+            self.polling_policy.set_log_period(period)
+
     def pause(self):
+        if self._mux:
+            raise Exception("Cannot pause a shared radio link")
         self._thread.stop()
         self._thread = None
 
     def restart(self):
-        if self._thread:
+        if self._thread or self._mux:
             return
 
         self._thread = _RadioDriverThread(self.cradio, self.in_queue,
                                           self.out_queue,
+                                          self.polling_policy,
                                           self.link_quality_callback,
-                                          self.link_error_callback)
+                                          self.link_error_callback,
+                                          self.usb_batch)
         self._thread.start()
 
     def close(self):
         """ Close the link. """
+        with _scan_lock:
+            _open_links.discard(self)
+
+        if self._mux:
+            radiomux.release_multiplexer(self._mux, self._mux_link)
+            self._mux = None
+            self._mux_link = None
+            return
+
         # Stop the comm thread
         self._thread.stop()
 
@@ -193,45 +359,102 @@ class RadioDriver(CRTPDriver):
             pass
         self.cradio = None
 
-    def _scan_radio_channels(self, start=0, stop=125):
-        """ Scan for Crazyflies between the supplied channels. """
-        return list(self.cradio.scan_channels(start, stop, (0xff,)))
-
-    def scan_interface(self):
-        """ Scan interface for Crazyflies """
-        if self.cradio is None:
-            try:
-                self.cradio = Crazyradio()
-            except Exception:
-                return []
-        else:
+    def scan_interface(self, found_callback=None, quick=False):
+        """
+        Scan interface for Crazyflies.
+
+        The channels and data rates are split between the Crazyradios of
+        scan_dongles that are not in use, which scan in parallel. Each dongle first probes
+        the Crazyflies it found before (see scan_cache). A quick scan only
+        probes those, and does a full scan if none of them answers. If
+        found_callback is given it is called from the scanning threads with
+        each link as it is found. The URI of a link is on the dongle that
+        found it.
+
+        If background_scan_interval is set, a quick scan also starts full
+        scans at that interval while no link is open. They report the
+        Crazyflies they find to found_callback.
+        """
+        if self.cradio is not None:
             raise Exception("Cannot scann for links while the link is open!")
 
-        # FIXME: implements serial number in the Crazyradio driver!
-        serial = "N/A"
-
-        logger.info("v%s dongle with serial %s found", self.cradio.version,
-                    serial)
-        found = []
-
-        self.cradio.set_arc(1)
-
-        self.cradio.set_data_rate(self.cradio.DR_250KPS)
-        found += map(lambda c: ["radio://0/{}/250K".format(c), ""],
-                     self._scan_radio_channels())
-        self.cradio.set_data_rate(self.cradio.DR_1MPS)
-        found += map(lambda c: ["radio://0/{}/1M".format(c), ""],
-                     self._scan_radio_channels())
-        self.cradio.set_data_rate(self.cradio.DR_2MPS)
-        found += map(lambda c: ["radio://0/{}/2M".format(c), ""],
-                     self._scan_radio_channels())
-
-        self.cradio.close()
-        self.cradio = None
+        with _scan_lock:
+            found = self._scan(found_callback, quick)
+            if quick and not found:
+                found = self._scan(found_callback, False)
 
+        if quick and self.background_scan_interval > 0:
+            if self._background_scan is None:
+                self._background_scan = _BackgroundScanThread(self)
+                self._background_scan.start()
+            self._background_scan.found_callback = found_callback
         return found
 
+    def _scan(self, found_callback, quick):
+        """ Scan with the free dongles to use, with the scan lock held """
+        try:
+            dongles = [(devid, dev) for (devid, dev)
+                       in enumerate(_find_devices())
+                       if (self.scan_dongles is None or
+                           devid in self.scan_dongles)]
+        except Exception:
+            return []
+        devices = [(devid, dev) for (devid, dev) in dongles
+                   if not radiomux.is_open(devid)]
+        if not devices:
+            if dongles:
+                raise Exception("Cannot scann for links while the link is "
+                                "open!")
+            return []
+
+        # Work split in chunks of channels, taken by the dongles as they
+        # finish the previous one
+        work = Queue.Queue()
+        if not quick:
+            for (datarate, name) in SCAN_DATA_RATES:
+                for start in range(0, 126, SCAN_CHUNK):
+                    work.put((datarate, start,
+                              min(start + SCAN_CHUNK, 126) - 1))
+
+        # Dongle that found each (data rate, channel) first
+        found = {}
+        found_lock = threading.Lock()
+
+        def add(devid, datarate, channel):
+            with found_lock:
+                if (datarate, channel) in found:
+                    return
+                found[(datarate, channel)] = devid
+            if found_callback:
+                found_callback(self._scan_result(devid, datarate, channel))
+
+        threads = [_ScanThread(devid, dev, work, add, self.scan_cache)
+                   for (devid, dev) in devices]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        logger.info("%s with %d dongles, found %d Crazyflies",
+                    "Probed known links" if quick else "Scanned",
+                    len(threads), len(found))
+
+        rates = [datarate for (datarate, name) in SCAN_DATA_RATES]
+        links = sorted(found, key=lambda f: (rates.index(f[0]), f[1]))
+        return [self._scan_result(found[(datarate, channel)], datarate,
+                                  channel)
+                for (datarate, channel) in links]
+
+    @staticmethod
+    def _scan_result(devid, datarate, channel):
+        """ Return the scan result for a Crazyflie found by dongle devid """
+        name = dict(SCAN_DATA_RATES)[datarate]
+        return ["radio://{}/{}/{}".format(devid, channel, name), ""]
+
     def get_status(self):
+        if self._mux:
+            return "Crazyradio version {}, shared with {} links".format(
+                self._mux.cradio.version, len(self._mux.get_stats()))
         if self.cradio is None:
             try:
                 self.cradio = Crazyradio()
@@ -241,12 +464,100 @@ class RadioDriver(CRTPDriver):
             except Exception as e:
                 return str(e)
 
+        if self._thread:
+            return "Crazyradio version {}, {}, {} packets dropped".format(
+                self.cradio.version, self.polling_policy,
+                self._thread.dropped)
         return "Crazyradio version {}".format(self.cradio.version)
 
     def get_name(self):
         return "radio"
 
 
+class _ScanThread(threading.Thread):
+    """
+    Thread scanning with one Crazyradio. It first probes the
+    (data rate, channel) pairs the dongle found before and then scans chunks
+    of channels from the work queue until it is empty. The results are
+    stored in the scan cache.
+    """
+
+    def __init__(self, devid, device, work, found_callback, cache):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._devid = devid
+        self._device = device
+        self._work = work
+        self._found_callback = found_callback
+        self._cache = cache
+
+    def run(self):
+        try:
+            cradio = Crazyradio(device=self._device)
+        except Exception as e:
+            logger.warning("Cannot open Crazyradio for scanning: %s", e)
+            return
+
+        serial = ""
+        found = []
+        probed = []
+        try:
+            serial = cradio.get_serial() or ""
+            logger.info("v%s dongle scanning", cradio.version)
+            cradio.set_arc(1)
+            datarate = None
+            for (rate, channel) in self._cache.known(serial):
+                if rate != datarate:
+                    cradio.set_data_rate(rate)
+                    datarate = rate
+                probed.append((rate, channel))
+                if cradio.scan_channels(channel, channel, (0xff,)):
+                    found.append((rate, channel))
+                    self._found_callback(self._devid, rate, channel)
+
+            while True:
+                try:
+                    (rate, start, stop) = self._work.get(False)
+                except Queue.Empty:
+                    break
+                if rate != datarate:
+                    cradio.set_data_rate(rate)
+                    datarate = rate
+                for channel in cradio.scan_channels(start, stop, (0xff,)):
+                    found.append((rate, channel))
+                    self._found_callback(self._devid, rate, channel)
+                probed.extend((rate, channel)
+                              for channel in range(start, stop + 1))
+        finally:
+            cradio.close()
+            self._cache.update(serial, found, probed)
+
+
+class _BackgroundScanThread(threading.Thread):
+    """
+    Thread doing a full scan with the driver every background_scan_interval
+    seconds, while no radio link is open
+    """
+
+    def __init__(self, driver):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._driver = driver
+        self.found_callback = None
+
+    def run(self):
+        while self._driver.background_scan_interval > 0:
+            time.sleep(self._driver.background_scan_interval)
+            with _scan_lock:
+                if _open_links or self._driver.cradio is not None:
+                    continue
+                try:
+                    self._driver._scan(self.found_callback, False)
+                except Exception as e:
+                    logger.warning("Background scan failed: %s", e)
+        self._driver._background_scan = None
+
+
 # Transmit/receive radio thread
 class _RadioDriverThread (threading.Thread):
     """
@@ -255,17 +566,21 @@ class _RadioDriverThread (threading.Thread):
 
     RETRYCOUNT_BEFORE_DISCONNECT = 10
 
-    def __init__(self, cradio, inQueue, outQueue, link_quality_callback,
-                 link_error_callback):
+    def __init__(self, cradio, inQueue, outQueue, polling_policy,
+                 link_quality_callback, link_error_callback, batch_size=1):
         """ Create the object """
         threading.Thread.__init__(self)
         self.cradio = cradio
+        self.batch_size = batch_size
         self.in_queue = inQueue
         self.out_queue = outQueue
+        self.polling_policy = polling_policy
         self.sp = False
         self.link_error_callback = link_error_callback
         self.link_quality_callback = link_quality_callback
         self.retryBeforeDisconnect = self.RETRYCOUNT_BEFORE_DISCONNECT
+        # Received packets dropped because in_queue was full
+        self.dropped = 0
 
     def stop(self):
         """ Stop the thread """
@@ -277,77 +592,102 @@ class _RadioDriverThread (threading.Thread):
 
     def run(self):
         """ Run the receiver thread """
-        dataOut = array.array('B', [0xFF])
+        # Packets of the next transfer, several when batching
+        pending = [array.array('B', [0xFF])]
+        sent = False
         waitTime = 0
-        emptyCtr = 0
 
         while(True):
             if (self.sp):
                 break
 
             try:
-                ackStatus = self.cradio.send_packet(dataOut)
+                if len(pending) > 1:
+                    acks = self.cradio.send_packets(pending)
+                else:
+                    acks = [self.cradio.send_packet(pending[0])]
             except Exception as e:
                 import traceback
                 self.link_error_callback("Error communicating with crazy radio"
                                          " ,it has probably been unplugged!\n"
                                          "Exception:%s\n\n%s" % (e,
                                          traceback.format_exc()))
-
-            # Analise the in data packet ...
-            if ackStatus is None:
-                if (self.link_error_callback is not None):
-                    self.link_error_callback("Dongle communication error"
-                                             " (ackStatus==None)")
+                acks = [None] * len(pending)
+
+            # Packets to send again: the first one that was not acked and
+            # all the ones after it, so the Crazyflie gets them in order even
+            # if some of the later ones were acked
+            lost = None
+            for (i, ackStatus) in enumerate(acks):
+                # Analise the in data packet ...
+                if ackStatus is None:
+                    if lost is None:
+                        if (self.link_error_callback is not None):
+                            self.link_error_callback("Dongle communication"
+                                                     " error (ackStatus==None)")
+                        lost = pending[i:]
+                    continue
+
+                if (self.link_quality_callback is not None):
+                    self.link_quality_callback((10 - ackStatus.retry) * 10)
+
+                # If no copter, retry
+                if ackStatus.ack is False:
+                    if lost is None:
+                        self.retryBeforeDisconnect -= 1
+                        if (self.retryBeforeDisconnect == 0 and
+                                self.link_error_callback is not None):
+                            self.link_error_callback("Too many packets lost")
+                        lost = pending[i:]
+                    continue
+                if lost is None:
+                    self.retryBeforeDisconnect = \
+                        self.RETRYCOUNT_BEFORE_DISCONNECT
+
+                data = ackStatus.data
+
+                # If there is a copter in range, the packet is analysed
+                if (len(data) > 0):
+                    inPacket = CRTPPacket(data[0], buffer(data, 1))
+                    # print "<- " + inPacket.__str__()
+                    # Do not stall the USB transfers on a full queue
+                    try:
+                        self.in_queue.put_nowait(inPacket)
+                    except Queue.Full:
+                        self.dropped += 1
+                        if self.dropped % DROPPED_WARNING_INTERVAL == 1:
+                            logger.warning("Incoming queue full, %d packets "
+                                           "dropped", self.dropped)
+
+                waitTime = self.polling_policy.transfer(sent, len(data) > 0)
+
+            if lost:
+                pending = lost
                 continue
 
-            if (self.link_quality_callback is not None):
-                self.link_quality_callback((10 - ackStatus.retry) * 10)
-
-            # If no copter, retry
-            if ackStatus.ack is False:
-                self.retryBeforeDisconnect = self.retryBeforeDisconnect - 1
-                if (self.retryBeforeDisconnect == 0 and
-                        self.link_error_callback is not None):
-                    self.link_error_callback("Too many packets lost")
-                continue
-            self.retryBeforeDisconnect = self.RETRYCOUNT_BEFORE_DISCONNECT
-
-            data = ackStatus.data
-
-            # If there is a copter in range, the packet is analysed and the
-            # next packet to send is prepared
-            if (len(data) > 0):
-                inPacket = CRTPPacket(data[0], list(data[1:]))
-                # print "<- " + inPacket.__str__()
-                self.in_queue.put(inPacket)
-                waitTime = 0
-                emptyCtr = 0
-            else:
-                emptyCtr += 1
-                if (emptyCtr > 10):
-                    emptyCtr = 10
-                    # Relaxation time if the last 10 packet where empty
-                    waitTime = 0.01
-                else:
-                    waitTime = 0
-
-            # get the next packet to send of relaxation (wait 10ms)
+            # get the next packet to send or wait before polling again
             outPacket = None
             try:
                 outPacket = self.out_queue.get(True, waitTime)
             except Queue.Empty:
                 outPacket = None
 
-            dataOut = array.array('B')
-
             if outPacket:
                 # print "-> " + outPacket.__str__()
-                dataOut.append(outPacket.header)
-                for X in outPacket.data:
-                    if type(X) == int:
-                        dataOut.append(X)
-                    else:
-                        dataOut.append(ord(X))
+                pending = [self._pack(outPacket)]
+                while len(pending) < self.batch_size:
+                    try:
+                        pending.append(self._pack(self.out_queue.get_nowait()))
+                    except Queue.Empty:
+                        break
+                sent = True
             else:
-                dataOut.append(0xFF)
+                pending = [array.array('B', [0xFF])]
+                sent = False
+
+    @staticmethod
+    def _pack(pk):
+        """ Return the USB data of the packet pk """
+        dataOut = array.array('B', [pk.header])
+        dataOut.extend(pk.datab)
+        return dataOut
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2011-2013 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Share one Crazyradio between the links to several Crazyflies.
+
+A RadioMultiplexer owns the dongle and runs one thread that time-slices it
+between its links. Before each transfer the radio is switched to the
+channel, data rate and address of the link, if it is not already set. The
+links are served with a smooth weighted round-robin: a link with weight 2
+gets twice the transfers of a link with weight 1 when both are busy. Idle
+links are only polled as often as their polling policy asks for.
+"""
+
+__author__ = 'Bitcraze AB'
+__all__ = ['RadioMultiplexer', 'MuxLink', 'get_multiplexer',
+           'release_multiplexer', 'is_open']
+
+import threading
+import time
+import array
+import Queue
+
+from .crtpstack import CRTPPacket
+from cflib.drivers.crazyradio import Crazyradio
+
+import logging
+logger = logging.getLogger(__name__)
+
+RETRYCOUNT_BEFORE_DISCONNECT = 10
+# How often the packet rates are updated (s)
+STATS_PERIOD = 1.0
+# A warning is logged for the first dropped received packet and then once
+# every that many
+DROPPED_WARNING_INTERVAL = 1000
+
+# Multiplexers by dongle number
+_multiplexers = {}
+_multiplexers_lock = threading.Lock()
+
+
+def _get(devid):
+    """
+    Return the multiplexer of the dongle devid, or None. A multiplexer whose
+    dongle failed is forgotten once it has closed the dongle. Called with
+    _multiplexers_lock held.
+    """
+    mux = _multiplexers.get(devid)
+    if mux is not None and mux.failed:
+        if threading.current_thread() is not mux:
+            mux.join()
+        del _multiplexers[devid]
+        mux = None
+    return mux
+
+
+def get_multiplexer(devid):
+    """Return the multiplexer of the dongle devid, opening it if needed"""
+    with _multiplexers_lock:
+        mux = _get(devid)
+        if mux is None:
+            mux = RadioMultiplexer(devid)
+            mux.start()
+            _multiplexers[devid] = mux
+        return mux
+
+
+def release_multiplexer(mux, link):
+    """Remove link from mux, and close the dongle if it was the last one"""
+    with _multiplexers_lock:
+        if mux.remove_link(link) == 0:
+            if _multiplexers.get(mux.devid) is mux:
+                del _multiplexers[mux.devid]
+            mux.stop()
+
+
+def is_open(devid):
+    """Return True if the dongle devid is used by a multiplexer"""
+    with _multiplexers_lock:
+        return _get(devid) is not None
+
+
+class MuxLink():
+    """A link served by a RadioMultiplexer"""
+
+    def __init__(self, uri, channel, datarate, address, in_queue, out_queue,
+                 polling_policy, link_quality_callback, link_error_callback,
+                 weight=1):
+        self.uri = uri
+        self.config = (channel, datarate, tuple(address))
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.polling_policy = polling_policy
+        self.link_quality_callback = link_quality_callback
+        self.link_error_callback = link_error_callback
+        self.weight = weight
+        # Received packets dropped because in_queue was full
+        self.dropped = 0
+
+        # Packet to send again when the last transfer was not acked
+        self.data_out = None
+        self.next_poll = 0
+        self.retry_before_disconnect = RETRYCOUNT_BEFORE_DISCONNECT
+        # Smooth weighted round-robin state
+        self.current = 0
+
+        # Packets per second sent, received and USB transfers
+        self.tx_rate = 0
+        self.rx_rate = 0
+        self.transfer_rate = 0
+        self._tx = self._rx = self._transfers = 0
+        self._stats_start = time.time()
+
+    def _count(self, sent, received):
+        self._transfers += 1
+        self._tx += sent
+        self._rx += received
+        now = time.time()
+        if now - self._stats_start >= STATS_PERIOD:
+            elapsed = now - self._stats_start
+            self.tx_rate = self._tx / elapsed
+            self.rx_rate = self._rx / elapsed
+            self.transfer_rate = self._transfers / elapsed
+            self._tx = self._rx = self._transfers = 0
+            self._stats_start = now
+
+    def get_stats(self):
+        """Return the effective packet rates and dropped packets of the link"""
+        return {"weight": self.weight,
+                "tx": self.tx_rate,
+                "rx": self.rx_rate,
+                "transfers": self.transfer_rate,
+                "dropped": self.dropped}
+
+
+class RadioMultiplexer(threading.Thread):
+    """Thread time-slicing one Crazyradio between several links"""
+
+    def __init__(self, devid):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.devid = devid
+        self.cradio = Crazyradio(devid=devid)
+        if self.cradio.version >= 0.4:
+            self.cradio.set_arc(10)
+        else:
+            logger.warning("Radio version <0.4 will be obsoleted soon!")
+        self._config = None
+        self._links = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sp = False
+        # Set when the dongle stopped answering, the thread then stops
+        self.failed = False
+        # Number of times the radio configuration was switched
+        self.switches = 0
+
+    def add_link(self, link):
+        with self._lock:
+            self._links = self._links + [link]
+        self.wake()
+
+    def remove_link(self, link):
+        """Remove link and return the number of links left"""
+        with self._lock:
+            self._links = [l for l in self._links if l is not link]
+            return len(self._links)
+
+    def wake(self):
+        """Called when a packet is queued to be sent"""
+        self._wakeup.set()
+
+    def stop(self):
+        self._sp = True
+        self._wakeup.set()
+        if threading.current_thread() is not self:
+            self.join()
+
+    def get_stats(self):
+        """Return the stats of each link by URI"""
+        return dict((l.uri, l.get_stats()) for l in self._links)
+
+    def _next_link(self, now):
+        """Pick the next link to serve, or None if no link is due"""
+        due = [l for l in self._links if l.data_out is not None or
+               l.next_poll <= now or not l.out_queue.empty()]
+        if not due:
+            return None
+        total = 0
+        best = None
+        for l in due:
+            l.current += l.weight
+            total += l.weight
+            if best is None or l.current > best.current:
+                best = l
+        best.current -= total
+        return best
+
+    def _configure(self, link):
+        """Switch the radio to the settings of link"""
+        if self._config == link.config:
+            return
+        (channel, datarate, address) = link.config
+        if self._config is None or self._config[0] != channel:
+            self.cradio.set_channel(channel)
+        if self._config is None or self._config[1] != datarate:
+            self.cradio.set_data_rate(datarate)
+        if self._config is None or self._config[2] != address:
+            self.cradio.set_address(address)
+        self._config = link.config
+        self.switches += 1
+
+    def run(self):
+        try:
+            while not self._sp:
+                self._wakeup.clear()
+                now = time.time()
+                link = self._next_link(now)
+                if link is None:
+                    links = self._links
+                    timeout = (min(l.next_poll for l in links) - now
+                               if links else 0.1)
+                    if timeout > 0:
+                        self._wakeup.wait(timeout)
+                    continue
+                self._transfer(link)
+        finally:
+            try:
+                self.cradio.close()
+            except Exception:
+                # If we pull out the dongle we will not make this call
+                pass
+
+    def _transfer(self, link):
+        """Do one transfer for link"""
+        if link.data_out is None:
+            try:
+                pk = link.out_queue.get_nowait()
+                link.data_out = array.array('B', [pk.header])
+                link.data_out.extend(pk.datab)
+            except Queue.Empty:
+                link.data_out = array.array('B', [0xFF])
+        sent = link.data_out[0] != 0xFF
+
+        try:
+            self._configure(link)
+            ackStatus = self.cradio.send_packet(link.data_out)
+        except Exception as e:
+            self.failed = True
+            for l in self._links:
+                if l.link_error_callback is not None:
+                    l.link_error_callback("Error communicating with crazy "
+                                          "radio, it has probably been "
+                                          "unplugged!\nException:%s" % e)
+            self._sp = True
+            return
+
+        if ackStatus is None:
+            if link.link_error_callback is not None:
+                link.link_error_callback("Dongle communication error"
+                                         " (ackStatus==None)")
+            return
+
+        if link.link_quality_callback is not None:
+            link.link_quality_callback((10 - ackStatus.retry) * 10)
+
+        # If no copter, retry at the next turn of the link
+        if ackStatus.ack is False:
+            link.retry_before_disconnect -= 1
+            if (link.retry_before_disconnect == 0 and
+                    link.link_error_callback is not None):
+                link.link_error_callback("Too many packets lost")
+            return
+        link.retry_before_disconnect = RETRYCOUNT_BEFORE_DISCONNECT
+        link.data_out = None
+
+        data = ackStatus.data
+        received = len(data) > 0
+        if received:
+            # Do not stall the other links on a full queue
+            try:
+                link.in_queue.put_nowait(CRTPPacket(data[0], buffer(data, 1)))
+            except Queue.Full:
+                link.dropped += 1
+                if link.dropped % DROPPED_WARNING_INTERVAL == 1:
+                    logger.warning("Incoming queue of %s full, %d packets "
+                                   "dropped", link.uri, link.dropped)
+        link._count(sent, received)
+        link.next_poll = time.time() + link.polling_policy.transfer(sent,
+                                                                     received)
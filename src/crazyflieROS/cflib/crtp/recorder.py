@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2011-2013 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Flight recorder for the raw CRTP traffic of a link, and a reader for the
+recorded files. The recordings can be played back with the replay driver.
+
+The file starts with a header holding the wall clock time of the start of the
+recording. It is followed by one record per packet: the time since the start
+(from a monotonic clock, see _monotonic_clock), the direction, the CRTP header and
+the data. Every INDEX_INTERVAL packets an index record is added that points
+at the first packet of the chunk it covers and at the previous index record.
+When the recording is closed a trailer pointing at the last index record is
+written, so the index can be loaded without reading the whole file. A file
+without a trailer (i.e. from a crash) is indexed by scanning it.
+"""
+
+__author__ = 'Bitcraze AB'
+__all__ = ['FlightRecorder', 'FlightLog', 'RECORD_IN', 'RECORD_OUT']
+
+import os
+import struct
+import time
+import ctypes
+import ctypes.util
+from threading import Lock
+
+from .crtpstack import CRTPPacket
+
+import logging
+logger = logging.getLogger(__name__)
+
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _monotonic_clock():
+    """
+    Return a function giving the time (s) of a monotonic clock: time.monotonic
+    when there is one, else clock_gettime(CLOCK_MONOTONIC) through ctypes.
+    Without either the wall clock is used, and the packet times of a
+    recording jump when the system time is changed.
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        for name in ("c", "rt"):
+            lib = ctypes.CDLL(ctypes.util.find_library(name), use_errno=True)
+            if hasattr(lib, "clock_gettime"):
+                break
+        clock_gettime = lib.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        def monotonic():
+            ts = _timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError) as exp:
+        logger.warning("No monotonic clock (%s), recording with the wall "
+                       "clock", str(exp))
+        return time.time
+
+_clock = _monotonic_clock()
+
+# Directions of the packet records, and the kind used for index records
+RECORD_IN = 0
+RECORD_OUT = 1
+RECORD_INDEX = 2
+
+INDEX_INTERVAL = 256
+
+_MAGIC = "CFREC\x01"
+_END_MAGIC = "CFEND\x01"
+# Magic and wall clock time of the start of the recording
+_HEADER = struct.Struct("<6sd")
+# Time since the start, kind, CRTP header and length of the data
+_RECORD = struct.Struct("<dBBB")
+# Offset of the previous index record, offset of the first record in the
+# chunk and number of packets before the chunk
+_INDEX = struct.Struct("<QQI")
+# Offset of the last index record, number of packets and magic
+_TRAILER = struct.Struct("<QI6s")
+
+
+class FlightRecorder():
+    """
+    Append the packets of a link to a recording file.
+
+    filename -- File to write the recording to, it is overwritten
+    index_interval -- Number of packets between the index records
+    """
+
+    def __init__(self, filename, index_interval=INDEX_INTERVAL):
+        self.filename = filename
+        self.index_interval = max(1, index_interval)
+        self._file = open(filename, 'wb')
+        self._lock = Lock()
+        self._crazyflie = None
+
+        self._start = _clock()
+        self._file.write(_HEADER.pack(_MAGIC, time.time()))
+
+        self.nbr_of_packets = 0
+        self._last_index = 0
+        self._chunk_offset = self._file.tell()
+        self._chunk_time = 0.0
+        self._chunk_count = 0
+
+    def attach(self, crazyflie):
+        """Record all the packets sent and received by crazyflie"""
+        self.detach()
+        self._crazyflie = crazyflie
+        crazyflie.packet_received.add_callback(self._packet_received_cb)
+        crazyflie.packet_sent.add_callback(self._packet_sent_cb)
+
+    def detach(self):
+        """Stop recording the packets of the attached Crazyflie"""
+        if self._crazyflie:
+            self._crazyflie.packet_received.remove_callback(
+                self._packet_received_cb)
+            self._crazyflie.packet_sent.remove_callback(self._packet_sent_cb)
+            self._crazyflie = None
+
+    def _packet_received_cb(self, pk):
+        self.record(RECORD_IN, pk)
+
+    def _packet_sent_cb(self, pk):
+        self.record(RECORD_OUT, pk)
+
+    def record(self, direction, pk):
+        """Append a packet sent (RECORD_OUT) or received (RECORD_IN)"""
+        data = pk.datab
+        with self._lock:
+            if self._file is None:
+                return
+            t = _clock() - self._start
+            if self._chunk_count == 0:
+                self._chunk_time = t
+            self._file.write(_RECORD.pack(t, direction, pk.header, len(data)))
+            self._file.write(data)
+            self.nbr_of_packets += 1
+            self._chunk_count += 1
+            if self._chunk_count >= self.index_interval:
+                self._write_index()
+
+    def _write_index(self):
+        """Add an index record for the current chunk and start a new one"""
+        offset = self._file.tell()
+        self._file.write(_RECORD.pack(self._chunk_time, RECORD_INDEX, 0,
+                                      _INDEX.size))
+        self._file.write(_INDEX.pack(self._last_index, self._chunk_offset,
+                                     self.nbr_of_packets - self._chunk_count))
+        self._last_index = offset
+        self._chunk_offset = self._file.tell()
+        self._chunk_count = 0
+
+    def close(self):
+        """Stop recording and finish the file"""
+        self.detach()
+        with self._lock:
+            if self._file is None:
+                return
+            if self._chunk_count > 0:
+                self._write_index()
+            self._file.write(_TRAILER.pack(self._last_index,
+                                           self.nbr_of_packets, _END_MAGIC))
+            self._file.close()
+            self._file = None
+        logger.info("Recorded %d packets to [%s]", self.nbr_of_packets,
+                    self.filename)
+
+
+class FlightLog():
+    """
+    Read a recording made by FlightRecorder.
+
+    The index is a list of (time, offset, packets before) for each chunk of
+    the file and is used to start reading at any time in the recording.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        [magic, self.start_time] = _HEADER.unpack(
+            self._file.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise Exception("[%s] is not a flight recording" % filename)
+        self.nbr_of_packets = None
+        # Offset of the end of the records, before the trailer
+        self._end = None
+        self.index = self._read_index()
+
+    def _read_index(self):
+        """Load the index from the trailer, or by scanning the file"""
+        self._file.seek(0, 2)
+        size = self._file.tell()
+        self._end = size
+        if size >= _HEADER.size + _TRAILER.size:
+            self._file.seek(size - _TRAILER.size)
+            [last, count, magic] = _TRAILER.unpack(
+                self._file.read(_TRAILER.size))
+            if magic == _END_MAGIC:
+                self.nbr_of_packets = count
+                self._end = size - _TRAILER.size
+                return self._follow_index(last)
+        logger.warning("No trailer in [%s], scanning the recording",
+                       self.filename)
+        return self._scan_index()
+
+    def _follow_index(self, offset):
+        """Walk the index records backwards from offset"""
+        index = []
+        while offset:
+            self._file.seek(offset)
+            [t, kind, header, length] = _RECORD.unpack(
+                self._file.read(_RECORD.size))
+            [prev, chunk, before] = _INDEX.unpack(self._file.read(length))
+            index.append((t, chunk, before))
+            offset = prev
+        index.reverse()
+        return index
+
+    def _scan_index(self):
+        """Build the index by reading the record headers of the file"""
+        index = []
+        count = 0
+        offset = _HEADER.size
+        self._file.seek(offset)
+        while True:
+            raw = self._file.read(_RECORD.size)
+            if len(raw) < _RECORD.size:
+                break
+            [t, kind, header, length] = _RECORD.unpack(raw)
+            if kind != RECORD_INDEX:
+                if count % INDEX_INTERVAL == 0:
+                    index.append((t, offset, count))
+                count += 1
+            offset += _RECORD.size + length
+            self._file.seek(offset)
+        self.nbr_of_packets = count
+        return index
+
+    def packets(self, start=0.0):
+        """
+        Generate (time, direction, packet) for the packets recorded from
+        start seconds into the recording.
+        """
+        offset = _HEADER.size
+        for (t, chunk, before) in self.index:
+            if t > start:
+                break
+            offset = chunk
+
+        f = self._file
+        f.seek(offset)
+        while offset + _RECORD.size <= self._end:
+            raw = f.read(_RECORD.size)
+            [t, kind, header, length] = _RECORD.unpack(raw)
+            offset += _RECORD.size + length
+            if offset > self._end:
+                return
+            data = f.read(length)
+            if len(data) < length:
+                return
+            if kind not in (RECORD_IN, RECORD_OUT):
+                if kind != RECORD_INDEX:
+                    logger.warning("Bad record in [%s], stopping",
+                                   self.filename)
+                    return
+                continue
+            if t < start:
+                continue
+            yield (t, kind, CRTPPacket(header, data))
+
+    def close(self):
+        """Close the recording"""
+        self._file.close()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2011-2013 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Driver that plays back a link recorded with the FlightRecorder. The URI is
+replay://<file>[?speed=<factor>&start=<seconds>&sync=<0|1>].
+
+speed -- Playback speed relative to real time, 0 plays as fast as possible
+         (default 1)
+start -- Time into the recording to start playing from (default 0)
+sync -- Wait for the packets that were sent in the recording to be sent
+        again before playing the packets that followed them, so answers are
+        not played before they are requested. Setpoints are never waited for
+        (default 1)
+"""
+
+__author__ = 'Bitcraze AB'
+__all__ = ['ReplayDriver']
+
+from threading import Thread, Condition, current_thread
+from .crtpdriver import CRTPDriver
+from .crtpstack import CRTPPort
+from .exceptions import WrongUriType
+from .recorder import FlightLog, RECORD_OUT
+import Queue
+import re
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Max number of packets read ahead of the receiver
+QUEUE_SIZE = 1000
+# Max time to wait for a recorded packet to be sent again when syncing
+SYNC_TIMEOUT = 0.5
+
+
+class ReplayDriver(CRTPDriver):
+    """ Replay link driver """
+
+    # Replay URIs reported by the scans, so they can be picked like a
+    # Crazyflie that was found
+    recordings = []
+
+    def __init__(self):
+        """ Create the link driver """
+        self.uri = ""
+        self.in_queue = None
+        self._thread = None
+        self._log = None
+        self.nbr_of_sent = 0
+
+    def connect(self, uri, link_quality_callback, link_error_callback):
+        """
+        Connect the link driver to the recording given by the URI
+        """
+        match = re.search("^replay://([^?]+)(\?(.*))?$", uri)
+        if not match:
+            raise WrongUriType("Not a replay URI")
+
+        options = {"speed": "1", "start": "0", "sync": "1"}
+        if match.group(3):
+            for option in match.group(3).split("&"):
+                (key, _, value) = option.partition("=")
+                if key not in options:
+                    raise Exception("Unknown replay option [%s]" % key)
+                options[key] = value
+
+        self.uri = uri
+        self.nbr_of_sent = 0
+        self._log = FlightLog(match.group(1))
+        self.in_queue = Queue.Queue(QUEUE_SIZE)
+        self._thread = _ReplayThread(self._log, self.in_queue,
+                                     float(options["speed"]),
+                                     float(options["start"]),
+                                     options["sync"] != "0",
+                                     link_error_callback)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+        if link_quality_callback is not None:
+            link_quality_callback(100)
+
+    def receive_packet(self, time=0):
+        """
+        Receive a packet though the link. This call is blocking but will
+        timeout and return None if a timeout is supplied.
+        """
+        try:
+            if time == 0:
+                return self.in_queue.get(False)
+            elif time < 0:
+                return self.in_queue.get(True)
+            else:
+                return self.in_queue.get(True, time)
+        except Queue.Empty:
+            return None
+
+    def send_packet(self, pk):
+        """ Sent packets are only matched against the recording """
+        self.nbr_of_sent += 1
+        if self._thread:
+            self._thread.packet_sent(pk)
+
+    def close(self):
+        """ Stop the playback """
+        if self._thread:
+            self._thread.stop()
+            # The thread itself closes the link at the end of the recording
+            if self._thread is not current_thread():
+                self._thread.join()
+            self._thread = None
+        if self._log:
+            self._log.close()
+            self._log = None
+
+    def get_status(self):
+        return "Replay driver"
+
+    def get_name(self):
+        return "replay"
+
+    def scan_interface(self):
+        """ Report the recordings set in ReplayDriver.recordings """
+        return [[uri, ""] for uri in self.recordings]
+
+    def get_help(self):
+        return "replay://<file>[?speed=<factor>&start=<seconds>&sync=<0|1>]"
+
+
+class _ReplayThread(Thread):
+    """
+    Thread that puts the received packets of a recording in the queue at the
+    recorded times
+    """
+
+    def __init__(self, log, in_queue, speed, start, sync,
+                 link_error_callback):
+        Thread.__init__(self)
+        self._log = log
+        self._in_queue = in_queue
+        self._speed = speed
+        self._start = start
+        self._sync = sync
+        self.link_error_callback = link_error_callback
+        self._sp = False
+        # Sent packets not yet matched against the recording
+        self._sent = {}
+        self._sent_cond = Condition()
+
+    def stop(self):
+        """ Stop the thread """
+        self._sp = True
+        with self._sent_cond:
+            self._sent_cond.notify()
+
+    def packet_sent(self, pk):
+        """ Called by the driver for every packet sent """
+        if self._sync:
+            key = (pk.header, str(pk.datab))
+            with self._sent_cond:
+                self._sent[key] = self._sent.get(key, 0) + 1
+                self._sent_cond.notify()
+
+    def _wait_for_sent(self, pk):
+        """ Wait for the recorded packet pk to be sent again """
+        key = (pk.header, str(pk.datab))
+        deadline = time.time() + SYNC_TIMEOUT
+        with self._sent_cond:
+            while not self._sp and not self._sent.get(key):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.debug("Packet %s never sent, continuing", key)
+                    return
+                self._sent_cond.wait(remaining)
+            if self._sent.get(key):
+                self._sent[key] -= 1
+
+    def run(self):
+        """ Run the replay """
+        base = None
+        for (t, direction, pk) in self._log.packets(self._start):
+            if self._sp:
+                return
+            if base is None:
+                base = time.time() - t / self._speed if self._speed else 0
+
+            if direction == RECORD_OUT:
+                if self._sync and pk.port != CRTPPort.COMMANDER:
+                    self._wait_for_sent(pk)
+                    if self._speed:
+                        # Keep the relative timing of the rest of the
+                        # recording if we had to wait
+                        base = max(base, time.time() - t / self._speed)
+                continue
+
+            if self._speed:
+                delay = base + t / self._speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            while not self._sp:
+                try:
+                    self._in_queue.put(pk, True, 0.1)
+                    break
+                except Queue.Full:
+                    pass
+
+        # Let the receiver get the last packets before closing the link
+        while not self._sp and not self._in_queue.empty():
+            time.sleep(0.01)
+
+        if not self._sp and self.link_error_callback:
+            self.link_error_callback("End of recording [%s]" %
+                                     self._log.filename)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2011-2013 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Single producer, single consumer ring buffer used to pass packets between the
+threads of a link driver. It can be used in place of a Queue.Queue.
+
+The slots are preallocated and the producer and consumer each only move their
+own end of the ring, so passing a packet does not take any lock. Events are
+only used to wake up the other side when it is waiting on an empty or full
+ring.
+"""
+
+__author__ = 'Bitcraze AB'
+__all__ = ['RingBuffer']
+
+from threading import Event, Lock
+import time
+import Queue
+
+# Waits with a timeout poll the ring with an interval growing from
+# POLL_MIN to POLL_MAX. Timed waits on an Event are implemented by polling
+# with sleeps of up to 50 ms in Python 2, which is too slow for packets.
+POLL_MIN = 0.0001
+POLL_MAX = 0.005
+
+
+class RingBuffer():
+    """
+    Ring buffer of size slots.
+
+    The put and get methods behave like the ones of Queue.Queue and raise
+    Queue.Full and Queue.Empty. Only one thread may call put and only one
+    thread may call get, unless multi_producer is set in which case puts are
+    serialised with a lock.
+    """
+
+    def __init__(self, size, multi_producer=False):
+        # One slot is kept free to tell a full ring from an empty one
+        self._size = size + 1
+        self._slots = [None] * self._size
+        # Next slot to read, only moved by the consumer
+        self._head = 0
+        # Next slot to write, only moved by the producer
+        self._tail = 0
+
+        self._put_lock = Lock() if multi_producer else None
+        self._not_empty = Event()
+        self._not_full = Event()
+        self._get_waiting = False
+        self._put_waiting = False
+
+    def qsize(self):
+        """Return the number of items in the ring"""
+        return (self._tail - self._head) % self._size
+
+    def empty(self):
+        return self._head == self._tail
+
+    def full(self):
+        return (self._tail + 1) % self._size == self._head
+
+    def put(self, item, block=True, timeout=None):
+        """Put an item in the ring, see Queue.Queue.put"""
+        if self._put_lock:
+            with self._put_lock:
+                self._put(item, block, timeout)
+        else:
+            self._put(item, block, timeout)
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def _put(self, item, block, timeout):
+        tail = self._tail
+        next_tail = (tail + 1) % self._size
+        if next_tail == self._head:
+            if not block:
+                raise Queue.Full
+            self._wait(self._not_full, "_put_waiting",
+                       lambda: next_tail != self._head, timeout, Queue.Full)
+
+        self._slots[tail] = item
+        self._tail = next_tail
+        if self._get_waiting:
+            self._not_empty.set()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return an item from the ring, see Queue.Queue.get"""
+        head = self._head
+        if head == self._tail:
+            if not block:
+                raise Queue.Empty
+            self._wait(self._not_empty, "_get_waiting",
+                       lambda: head != self._tail, timeout, Queue.Empty)
+
+        item = self._slots[head]
+        self._slots[head] = None
+        self._head = (head + 1) % self._size
+        if self._put_waiting:
+            self._not_full.set()
+        return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def _wait(self, event, waiting, ready, timeout, exception):
+        """
+        Wait until ready() is true, or raise exception after timeout seconds.
+
+        Without a timeout the wait is done on event. The waiting flag is set
+        before checking ready() again, so the other side either sees the flag
+        and sets the event or has already made ready() true.
+        """
+        if timeout is not None:
+            if timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            deadline = time.time() + timeout
+            delay = POLL_MIN
+            while not ready():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise exception
+                time.sleep(min(remaining, delay))
+                delay = min(delay * 2, POLL_MAX)
+            return
+
+        try:
+            while True:
+                event.clear()
+                setattr(self, waiting, True)
+                if ready():
+                    return
+                event.wait()
+        finally:
+            setattr(self, waiting, False)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2011-2013 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+
+"""
+Cache of the Crazyflies found by the radio scans.
+
+For each Crazyradio, by serial number, the cache remembers the
+(data rate, channel) pairs that answered and when. Scans probe these pairs
+first, and a quick scan only probes them, which takes milliseconds instead
+of a sweep of all the channels. The cache can be kept in a JSON file so it
+survives restarts.
+"""
+
+__author__ = 'Bitcraze AB'
+__all__ = ['ScanCache']
+
+import os
+import json
+import time
+import tempfile
+from threading import Lock
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ScanCache():
+    """
+    (data rate, channel) pairs that answered by dongle serial. Pairs not
+    seen for max_age seconds are forgotten.
+    """
+
+    def __init__(self, max_age=7 * 24 * 3600):
+        self.max_age = max_age
+        self._filename = None
+        self._lock = Lock()
+        # {serial: {(data rate, channel): time last seen}}
+        self._seen = {}
+
+    def load(self, filename):
+        """
+        Load the cache from filename, and save it there after every update.
+        A missing or broken file leaves the cache empty.
+        """
+        with self._lock:
+            self._filename = filename
+            self._seen = {}
+            if not os.path.isfile(filename):
+                return
+            try:
+                with open(filename) as f:
+                    data = json.load(f)
+                for (serial, pairs) in data.items():
+                    self._seen[str(serial)] = dict(
+                        ((rate, channel), seen)
+                        for (rate, channel, seen) in pairs)
+                logger.info("Loaded scan cache from [%s]", filename)
+            except Exception as exp:
+                logger.warning("Could not load scan cache [%s]: %s",
+                               filename, str(exp))
+
+    def known(self, serial):
+        """
+        Return the (data rate, channel) pairs that answered the dongle
+        serial, the most recently seen first
+        """
+        oldest = time.time() - self.max_age
+        with self._lock:
+            seen = self._seen.get(serial, {})
+            pairs = sorted((t, pair) for (pair, t) in seen.items()
+                           if t >= oldest)
+        return [pair for (t, pair) in reversed(pairs)]
+
+    def update(self, serial, found, probed):
+        """
+        Record the pairs found by the dongle serial. The pairs it probed
+        without an answer are removed.
+        """
+        now = time.time()
+        with self._lock:
+            seen = self._seen.setdefault(serial, {})
+            for pair in probed:
+                seen.pop(pair, None)
+            for pair in found:
+                seen[pair] = now
+            if self._filename:
+                self._save()
+
+    def _save(self):
+        """Atomically write the cache to its file"""
+        data = dict((serial, [[rate, channel, t] for ((rate, channel), t)
+                              in seen.items()])
+                    for (serial, seen) in self._seen.items())
+        try:
+            path = os.path.dirname(os.path.abspath(self._filename))
+            if not os.path.exists(path):
+                os.makedirs(path)
+            (fd, tmp_name) = tempfile.mkstemp(dir=path, prefix=".",
+                                              suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.rename(tmp_name, self._filename)
+            except:
+                os.remove(tmp_name)
+                raise
+        except Exception as exp:
+            logger.warning("Could not save scan cache [%s]: %s",
+                           self._filename, str(exp))
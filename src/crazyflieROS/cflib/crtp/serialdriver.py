@@ -25,25 +25,129 @@
 #  along with this program; if not, write to the Free Software
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #  MA  02110-1301, USA.
-
 """
-An early serial link driver. This could still be used (after some fixing) to
-run high-speed CRTP with the Crazyflie. The UART can be run at 2Mbit.
+Serial link driver, to run CRTP with a Crazyflie over a UART bridge. The UART
+can be run at 2Mbit. The URI is serial://<device>[?baud=<rate>], where the
+device is a name in /dev or an absolute path (serial:///dev/pts/3). The form
+serial://<name>/<baud> is also accepted.
+
+Each packet is sent as its header, data and a checksum byte (the sum of the
+header and data modulo 256), COBS encoded so it contains no zero byte, and
+followed by a zero byte ending the frame. A reader thread does large reads
+and parses the frames into packets. A writer thread sends the packets queued
+together with one write.
 """
 
 __author__ = 'Bitcraze AB'
 __all__ = ['SerialDriver']
 
+from threading import Thread
 from .crtpdriver import CRTPDriver
-
+from .crtpstack import CRTPPacket
 from .exceptions import WrongUriType
-
+from .ringbuffer import RingBuffer
+import Queue
+import os
+import sys
 import re
+import errno
+import select
+
+try:
+    import termios
+except ImportError:
+    # Serial ports are only supported on POSIX systems
+    termios = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_BAUDRATE = 1000000
+# Size of the queue of received packets, packets received when it is full
+# are dropped
+IN_QUEUE_SIZE = 1000
+# Size of the queue of packets to send
+OUT_QUEUE_SIZE = 50
+# Most packets sent with one write
+WRITE_BATCH = 16
+# Longest time (s) to wait for room in the queue of packets to send, it only
+# stays full if the writer is stuck or has stopped on an error
+SEND_TIMEOUT = 1.0
+# Largest read from the port (bytes)
+READ_SIZE = 4096
+# Longest time (s) the reader waits on the port before checking if it has
+# been stopped
+POLL_TIMEOUT = 0.1
+
+# Linux speeds above 460800 baud, missing from the termios module of older
+# Pythons
+_LINUX_SPEEDS = {500000: 0o010005, 576000: 0o010006, 921600: 0o010007,
+                 1000000: 0o010010, 1152000: 0o010011, 1500000: 0o010012,
+                 2000000: 0o010013, 2500000: 0o010014, 3000000: 0o010015,
+                 3500000: 0o010016, 4000000: 0o010017}
+
+
+def _cobs_encode(data):
+    """Return data COBS encoded, without the ending zero"""
+    out = bytearray()
+    for block in data.split(b'\x00'):
+        while len(block) >= 0xFE:
+            out.append(0xFF)
+            out += block[:0xFE]
+            block = block[0xFE:]
+        out.append(len(block) + 1)
+        out += block
+    return out
+
+
+def _cobs_decode(data):
+    """Return the COBS encoded data decoded, or None if it is invalid"""
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        code = data[i]
+        if code == 0 or i + code > n:
+            return None
+        out += data[i + 1:i + code]
+        i += code
+        if code < 0xFF and i < n:
+            out.append(0)
+    return out
+
+
+def _encode(pk):
+    """Return the frame of the packet pk"""
+    raw = bytearray([pk.header]) + pk.datab
+    raw.append(sum(raw) & 0xFF)
+    frame = _cobs_encode(raw)
+    frame.append(0)
+    return frame
+
+
+def _decode(frame):
+    """Return the packet of frame (without the ending zero), or None"""
+    raw = _cobs_decode(frame)
+    if raw is None or len(raw) < 2 or sum(raw[:-1]) & 0xFF != raw[-1]:
+        return None
+    return CRTPPacket(raw[0], raw[1:-1])
 
 
 class SerialDriver (CRTPDriver):
+    """ Serial link driver """
+
     def __init__(self):
-        None
+        """ Create the link driver """
+        CRTPDriver.__init__(self)
+        self.uri = ""
+        self.device = None
+        self.baudrate = DEFAULT_BAUDRATE
+        self.fd = None
+        self.in_queue = None
+        self.out_queue = None
+        self._reader = None
+        self._writer = None
+        self.link_error_callback = None
 
     def connect(self, uri, linkQualityCallback, linkErrorCallback):
         #check if the URI is a serial URI
@@ -51,12 +155,225 @@ class SerialDriver (CRTPDriver):
             raise WrongUriType("Not a serial URI")
 
         #Check if it is a valid serial URI
-        uriRe = re.search("^serial://([a-z A-Z 0-9]+)/?([0-9]+)?$", uri)
-        if not uriRe:
-            raise Exception("Invalid serial URI")
+        uriRe = re.search("^serial://([a-zA-Z0-9]+)/([0-9]+)$", uri)
+        if uriRe:
+            (device, baudrate) = uriRe.groups()
+        else:
+            uriRe = re.search("^serial://([^?]+)(\?baud=([0-9]+))?$", uri)
+            if not uriRe:
+                raise Exception("Invalid serial URI")
+            device = uriRe.group(1)
+            baudrate = uriRe.group(3) or DEFAULT_BAUDRATE
+        if termios is None:
+            raise Exception("Serial links are not supported on this system")
+
+        self.uri = uri
+        self.device = device if device.startswith("/") else "/dev/" + device
+        self.baudrate = int(baudrate)
+        self.fd = self._open(self.device, self.baudrate)
+        self.link_error_callback = linkErrorCallback
+
+        self.in_queue = RingBuffer(IN_QUEUE_SIZE)
+        self.out_queue = RingBuffer(OUT_QUEUE_SIZE, multi_producer=True)
+        self._reader = _SerialReaderThread(self.fd, self.in_queue,
+                                           linkErrorCallback)
+        self._reader.start()
+        self._writer = _SerialWriterThread(self.fd, self.out_queue,
+                                           linkErrorCallback)
+        self._writer.start()
+
+        if linkQualityCallback is not None:
+            linkQualityCallback(100)
+
+    @staticmethod
+    def _open(device, baudrate):
+        """ Open device as a raw 8N1 port at baudrate """
+        speed = getattr(termios, "B%d" % baudrate, None)
+        if speed is None and sys.platform.startswith("linux"):
+            speed = _LINUX_SPEEDS.get(baudrate)
+        if speed is None:
+            raise Exception("Unsupported baudrate [%d]" % baudrate)
+        fd = os.open(device, os.O_RDWR | os.O_NOCTTY)
+        try:
+            attr = termios.tcgetattr(fd)
+            # Raw mode: no echo, no line editing, no translation
+            attr[0] = 0
+            attr[1] = 0
+            attr[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+            attr[3] = 0
+            attr[4] = attr[5] = speed
+            attr[6][termios.VMIN] = 0
+            attr[6][termios.VTIME] = 0
+            termios.tcsetattr(fd, termios.TCSANOW, attr)
+            termios.tcflush(fd, termios.TCIOFLUSH)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    def receive_packet(self, time=0):
+        """
+        Receive a packet though the link. This call is blocking but will
+        timeout and return None if a timeout is supplied.
+        """
+        try:
+            if time == 0:
+                return self.in_queue.get(False)
+            elif time < 0:
+                return self.in_queue.get(True)
+            else:
+                return self.in_queue.get(True, time)
+        except Queue.Empty:
+            return None
+
+    def send_packet(self, pk):
+        """ Queue the packet pk to be sent """
+        writing = self._writer is not None and self._writer.is_alive()
+        try:
+            # No wait for room once the writer has stopped on an error
+            self.out_queue.put(pk, writing, SEND_TIMEOUT)
+        except Queue.Full:
+            if self.link_error_callback is not None:
+                self.link_error_callback("Serial port not being written, the"
+                                         " send queue is full")
+
+    def close(self):
+        """ Send the queued packets and close the port """
+        if self._writer:
+            self._writer.stop()
+            self._writer = None
+        if self._reader:
+            self._reader.stop()
+            self._reader = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def get_status(self):
+        if self._reader:
+            return "Serial link on %s at %d baud, %d bad frames" % (
+                self.device, self.baudrate, self._reader.bad_frames)
+        return "Serial driver"
 
     def get_name(self):
         return "serial"
 
     def scan_interface(self):
         return []
+
+    def get_help(self):
+        return "serial://<device>[?baud=<rate>]"
+
+
+class _SerialReaderThread(Thread):
+    """
+    Thread reading the port in large chunks and putting the packets of the
+    complete frames in the queue
+    """
+
+    def __init__(self, fd, in_queue, link_error_callback):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self._fd = fd
+        self._in_queue = in_queue
+        self.link_error_callback = link_error_callback
+        self._sp = False
+        # Frames dropped for a bad encoding or checksum, or a full queue
+        self.bad_frames = 0
+
+    def stop(self):
+        """ Stop the thread """
+        self._sp = True
+        self.join()
+
+    def run(self):
+        # Bytes of the frame being received
+        buf = bytearray()
+        while not self._sp:
+            try:
+                (readable, _, _) = select.select([self._fd], [], [],
+                                                 POLL_TIMEOUT)
+                if not readable:
+                    continue
+                data = os.read(self._fd, READ_SIZE)
+            except (OSError, select.error) as e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                    continue
+                if self.link_error_callback is not None:
+                    self.link_error_callback("Error reading the serial "
+                                             "port: %s" % e)
+                return
+            if not data:
+                continue
+
+            buf += data
+            frames = buf.split(b'\x00')
+            # The last frame is not complete yet
+            buf = frames.pop()
+            for frame in frames:
+                # Empty frames are sent to resynchronise
+                if not frame:
+                    continue
+                pk = _decode(frame)
+                if pk is None:
+                    self.bad_frames += 1
+                    continue
+                try:
+                    self._in_queue.put_nowait(pk)
+                except Queue.Full:
+                    self.bad_frames += 1
+
+
+class _SerialWriterThread(Thread):
+    """
+    Thread writing the queued packets, up to WRITE_BATCH packets queued
+    together with one write
+    """
+
+    def __init__(self, fd, out_queue, link_error_callback):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self._fd = fd
+        self._out_queue = out_queue
+        self.link_error_callback = link_error_callback
+
+    def stop(self):
+        """
+        Send the packets still queued and stop the thread. Gives up if the
+        queue stays full, as the thread is then stuck.
+        """
+        if not self.is_alive():
+            return
+        try:
+            self._out_queue.put(None, True, SEND_TIMEOUT)
+        except Queue.Full:
+            logger.warning("Serial writer stuck, %d packets not sent",
+                           self._out_queue.qsize())
+            return
+        self.join()
+
+    def run(self):
+        while True:
+            pk = self._out_queue.get()
+            data = bytearray()
+            count = 0
+            while pk is not None:
+                data += _encode(pk)
+                count += 1
+                if count == WRITE_BATCH:
+                    break
+                try:
+                    pk = self._out_queue.get_nowait()
+                except Queue.Empty:
+                    break
+            try:
+                while data:
+                    data = data[os.write(self._fd, data):]
+            except OSError as e:
+                if self.link_error_callback is not None:
+                    self.link_error_callback("Error writing the serial "
+                                             "port: %s" % e)
+                return
+            # None is queued by stop()
+            if pk is None:
+                break
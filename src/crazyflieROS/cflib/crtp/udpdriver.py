@@ -25,81 +25,309 @@
 #  along with this program; if not, write to the Free Software
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #  MA  02110-1301, USA.
+"""
+CRTP UDP driver, used to run the library against a simulator or any other
+program speaking CRTP over UDP. The URI is
+udp://[<host>][:<port>][?batch=<packets>] (default localhost:7777).
 
-""" CRTP UDP Driver. Work either with the UDP server or with an UDP device
-See udpserver.py for the protocol"""
+Each packet is sent as its header and data followed by a checksum byte, the
+sum of the header and data modulo 256. With batch set to more than 1, up to
+that many queued packets are packed in one datagram, each prefixed with the
+length of its header and data. Both ends of the link must use the same
+setting.
+
+The driver registers with the server by sending the packet 0xFF 0x01 0x01 on
+connect and unregisters with 0xFF 0x01 0x02 on close. Datagrams with a wrong
+checksum are dropped.
+"""
 
 __author__ = 'Bitcraze AB'
 __all__ = ['UdpDriver']
 
-
+from threading import Thread
 from .crtpdriver import CRTPDriver
 from .crtpstack import CRTPPacket
 from .exceptions import WrongUriType
+from .ringbuffer import RingBuffer
 import Queue
 import re
-import struct
-from socket import socket
+import errno
+import select
+import socket
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 7777
+# Size of the queue of received packets, packets received when it is full
+# are dropped
+IN_QUEUE_SIZE = 1000
+# Size of the queue of packets waiting to be batched
+OUT_QUEUE_SIZE = 50
+# Longest time (s) the receive thread waits on the socket before checking
+# if it has been stopped
+POLL_TIMEOUT = 0.1
+MAX_DATAGRAM = 65507
+# Receive buffer of the socket (bytes), to absorb the bursts of the server
+# while the receive thread is not scheduled
+SOCKET_BUFFER = 1 << 20
+
+# Control packets to register and unregister with the server
+CONNECT_PACKET = CRTPPacket(0xFF, (0x01, 0x01))
+DISCONNECT_PACKET = CRTPPacket(0xFF, (0x01, 0x02))
+
+# Errors of a non-blocking socket that do not break the link. A refused
+# connection means the server is not listening (yet).
+_TRANSIENT_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNREFUSED,
+                     errno.EINTR)
+
+
+def _encode(pk):
+    """Return the packet pk as header, data and checksum"""
+    raw = bytearray([pk.header]) + pk.datab
+    raw.append(sum(raw) & 0xFF)
+    return raw
+
+
+def _decode(raw):
+    """Return the packet in raw, or None if its checksum is wrong"""
+    if len(raw) < 2 or sum(raw[:-1]) & 0xFF != raw[-1]:
+        return None
+    return CRTPPacket(raw[0], raw[1:-1])
 
 
 class UdpDriver(CRTPDriver):
+    """ UDP link driver """
+
     def __init__(self):
-        None
+        """ Create the link driver """
+        CRTPDriver.__init__(self)
+        self.uri = ""
+        self.addr = None
+        self.batch = 1
+        self.socket = None
+        self.in_queue = None
+        self.out_queue = None
+        self._receiver = None
+        self._sender = None
+        self.link_error_callback = None
 
-    def connect(self, uri, linkQualityCallback, linkErrorCallback):
-        #check if the URI is a radio URI
-        if not re.search("^udp://", uri):
+    def connect(self, uri, link_quality_callback, link_error_callback):
+        """
+        Connect the link driver to the UDP server given by the URI
+        """
+        match = re.search("^udp://([^:/?]*)(:([0-9]+))?/?(\?(.*))?$", uri)
+        if not match:
             raise WrongUriType("Not an UDP URI")
 
-        self.queue = Queue.Queue()
-        self.socket = socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.addr = ("localhost", 7777)
+        options = {"batch": "1"}
+        if match.group(5):
+            for option in match.group(5).split("&"):
+                (key, _, value) = option.partition("=")
+                if key not in options:
+                    raise Exception("Unknown UDP option [%s]" % key)
+                options[key] = value
+
+        self.uri = uri
+        self.addr = (match.group(1) or DEFAULT_HOST,
+                     int(match.group(3) or DEFAULT_PORT))
+        self.batch = max(1, int(options["batch"]))
+        self.link_error_callback = link_error_callback
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               SOCKET_BUFFER)
         self.socket.connect(self.addr)
+        self.socket.setblocking(0)
 
-        #Add this to the server clients list
-        self.socket.sendto("\xFF\x01\x01\x01", self.addr)
+        self.in_queue = RingBuffer(IN_QUEUE_SIZE)
+        self._receiver = _UdpReceiveThread(self.socket, self.in_queue,
+                                           self.batch, link_error_callback)
+        self._receiver.start()
+        if self.batch > 1:
+            self.out_queue = RingBuffer(OUT_QUEUE_SIZE, multi_producer=True)
+            self._sender = _UdpSendThread(self, self.out_queue)
+            self._sender.start()
 
-    def receive_packet(self, time=0):
-        data, addr = self.socket.recvfrom(1024)
+        # Add this to the server clients list
+        self._send([CONNECT_PACKET])
 
-        if data:
-            data = struct.unpack('b' * (len(data) - 1), data[0:len(data) - 1])
-            pk = CRTPPacket()
-            pk.port = data[0]
-            pk.data = data[1:]
-            return pk
+        if link_quality_callback is not None:
+            link_quality_callback(100)
 
+    def receive_packet(self, time=0):
+        """
+        Receive a packet though the link. This call is blocking but will
+        timeout and return None if a timeout is supplied.
+        """
         try:
             if time == 0:
-                return self.rxqueue.get(False)
+                return self.in_queue.get(False)
             elif time < 0:
-                while True:
-                    return self.rxqueue.get(True, 10)
+                return self.in_queue.get(True)
             else:
-                return self.rxqueue.get(True, time)
+                return self.in_queue.get(True, time)
         except Queue.Empty:
             return None
 
     def send_packet(self, pk):
-        raw = (pk.port,) + struct.unpack("B"* len(pk.data), pk.data)
-
-        cksum = 0
-        for i in raw:
-            cksum += i
+        """ Send the packet pk though the link """
+        if self.out_queue is not None:
+            self.out_queue.put(pk)
+        else:
+            self._send([pk])
 
-        cksum %= 256
+    def _send(self, packets):
+        """ Send packets in one datagram """
+        if self.batch > 1:
+            data = bytearray()
+            for pk in packets:
+                raw = _encode(pk)
+                data.append(len(raw) - 1)
+                data.extend(raw)
+        else:
+            data = _encode(packets[0])
 
-        data = ''.join(chr(v) for v in (raw + (cksum,)))
-
-        #print tuple(data)
-        self.socket.sendto(data, self.addr)
+        try:
+            self.socket.send(data)
+        except socket.error as e:
+            if e.errno in _TRANSIENT_ERRORS:
+                logger.debug("Packet not sent to %s: %s", self.addr, e)
+            elif self.link_error_callback is not None:
+                self.link_error_callback("Error sending to %s:%d: %s" % (
+                    self.addr + (e,)))
 
     def close(self):
-        #Remove this to the server clients list
-        self.socket.sendto("\xFF\x01\x02\x02", self.addr)
+        """ Close the link """
+        if self._sender:
+            self._sender.stop()
+            self._sender = None
+            self.out_queue = None
+        if self.socket:
+            # Remove this from the server clients list
+            self._send([DISCONNECT_PACKET])
+        if self._receiver:
+            self._receiver.stop()
+            self._receiver = None
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def get_status(self):
+        if self._receiver:
+            return "UDP link to %s:%d, %d packets dropped" % (
+                self.addr + (self._receiver.dropped,))
+        return "UDP driver"
 
     def get_name(self):
         return "udp"
 
     def scan_interface(self):
         return []
+
+    def get_help(self):
+        return "udp://[<host>][:<port>][?batch=<packets>]"
+
+
+class _UdpReceiveThread(Thread):
+    """
+    Thread reading the datagrams from the socket and putting their packets
+    in the queue
+    """
+
+    def __init__(self, sock, in_queue, batch, link_error_callback):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self._socket = sock
+        self._in_queue = in_queue
+        self._batch = batch
+        self.link_error_callback = link_error_callback
+        self._sp = False
+        # Packets dropped for a wrong checksum or a full queue
+        self.dropped = 0
+
+    def stop(self):
+        """ Stop the thread """
+        self._sp = True
+        self.join()
+
+    def run(self):
+        while not self._sp:
+            try:
+                (readable, _, _) = select.select([self._socket], [], [],
+                                                 POLL_TIMEOUT)
+            except select.error:
+                continue
+            # Empty the socket before waiting again
+            while readable and not self._sp:
+                try:
+                    data = bytearray(self._socket.recv(MAX_DATAGRAM))
+                except socket.error as e:
+                    if e.errno not in _TRANSIENT_ERRORS:
+                        if self.link_error_callback is not None:
+                            self.link_error_callback(
+                                "Error receiving UDP packets: %s" % e)
+                        return
+                    break
+                for pk in self._unpack(data):
+                    try:
+                        self._in_queue.put_nowait(pk)
+                    except Queue.Full:
+                        self.dropped += 1
+
+    def _unpack(self, data):
+        """ Return the valid packets of a datagram """
+        if self._batch == 1:
+            raw = [data]
+        else:
+            raw = []
+            i = 0
+            while i < len(data):
+                end = i + 2 + data[i]
+                raw.append(data[i + 1:end])
+                i = end
+        packets = []
+        for r in raw:
+            pk = _decode(r)
+            if pk is None:
+                self.dropped += 1
+            else:
+                packets.append(pk)
+        return packets
+
+
+class _UdpSendThread(Thread):
+    """
+    Thread sending the queued packets, packing the packets queued together
+    in one datagram
+    """
+
+    def __init__(self, driver, out_queue):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self._driver = driver
+        self._out_queue = out_queue
+
+    def stop(self):
+        """ Send the packets still queued and stop the thread """
+        self._out_queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            pk = self._out_queue.get()
+            packets = []
+            while pk is not None:
+                packets.append(pk)
+                if len(packets) == self._driver.batch:
+                    break
+                try:
+                    pk = self._out_queue.get_nowait()
+                except Queue.Empty:
+                    break
+            if packets:
+                self._driver._send(packets)
+            # None is queued by stop()
+            if pk is None:
+                break
@@ -36,6 +36,8 @@ __all__ = ['Crazyradio']
 
 import os
 import usb
+import threading
+import Queue
 import logging
 logger = logging.getLogger(__name__)
 
@@ -56,6 +58,9 @@ SET_CONT_CARRIER = 0x20
 SCANN_CHANNELS = 0x21
 LAUNCH_BOOTLOADER = 0xFF
 
+# Timeout of the USB transfers (ms)
+USB_TIMEOUT = 1000
+
 try:
     import usb.core
     pyusb_backend = None
@@ -95,6 +100,45 @@ class _radio_ack:
     data = ()
 
 
+class _BatchWriter(threading.Thread):
+    """
+    Thread writing the packets of the batches to the dongle, at most window
+    packets ahead of the acks read by Crazyradio.send_packets
+    """
+
+    def __init__(self, write, window):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._write = write
+        self.packets = Queue.Queue()
+        # True for each packet written, False if it was not
+        self.results = Queue.Queue()
+        self.slots = threading.Semaphore(window)
+        # Set when a transfer failed or a packet was not acked, the rest of
+        # the batch is not written
+        self.cancel = False
+
+    def stop(self):
+        self.packets.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            dataOut = self.packets.get()
+            if dataOut is None:
+                break
+            self.slots.acquire()
+            written = False
+            if not self.cancel:
+                try:
+                    self._write(dataOut)
+                    written = True
+                except usb.USBError as e:
+                    logger.warning("Crazyradio write failed: %s", e)
+                    self.cancel = True
+            self.results.put(written)
+
+
 class Crazyradio:
     """ Used for communication with the Crazyradio USB dongle """
     #configuration constants
@@ -107,6 +151,10 @@ class Crazyradio:
     P_M6DBM = 2
     P_0DBM = 3
 
+    # Number of packets of a batch written to the dongle before their acks
+    # are read
+    batch_window = 4
+
     def __init__(self, device=None, devid=0):
         """ Create object and scan for USB dongle if no device is supplied """
         if device is None:
@@ -116,6 +164,7 @@ class Crazyradio:
                 raise Exception("Cannot find a Crazyradio Dongle")
 
         self.dev = device
+        self._writer = None
 
         if (pyusb1 is True):
             self.dev.set_configuration(1)
@@ -146,6 +195,10 @@ class Crazyradio:
             self.set_ard_bytes(32)
 
     def close(self):
+        if self._writer:
+            self._writer.stop()
+            self._writer = None
+
         if (pyusb1 is False):
             if self.handle:
                 self.handle.releaseInterface()
@@ -158,6 +211,18 @@ class Crazyradio:
         self.handle = None
         self.dev = None
 
+    def get_serial(self):
+        """ Return the serial number of the dongle, or None if it has none
+            or it cannot be read """
+        try:
+            if (pyusb1 is True):
+                return self.dev.serial_number
+            elif self.dev.iSerialNumber:
+                return self.handle.getString(self.dev.iSerialNumber, 255)
+        except Exception as e:
+            logger.debug("Cannot read the Crazyradio serial number: %s", e)
+        return None
+
     ### Dongle configuration ###
     def set_channel(self, channel):
         """ Set the radio channel to be used """
@@ -222,41 +287,102 @@ class Crazyradio:
             return tuple(_get_vendor_setup(self.handle, SCANN_CHANNELS,
                                            0, 0, 64))
         else:  # Slow PC-driven scann
-            result = tuple()
+            result = []
             for i in range(start, stop + 1):
                 self.set_channel(i)
                 status = self.send_packet(packet)
                 if status and status.ack:
-                    result = result + (i,)
-            return result
+                    result.append(i)
+            return tuple(result)
 
     ### Data transferts ###
     def send_packet(self, dataOut):
         """ Send a packet and receive the ack from the radio dongle
             The ack contains information about the packet transmition
             and a data payload if the ack packet contained any """
-        ackIn = None
         data = None
         try:
-            if (pyusb1 is False):
-                self.handle.bulkWrite(1, dataOut, 1000)
-                data = self.handle.bulkRead(0x81, 64, 1000)
-            else:
-                self.handle.write(1, dataOut, 0, 1000)
-                data = self.handle.read(0x81, 64, 0, 1000)
-        except usb.USBError:
-            pass
-
-        if data is not None:
-            ackIn = _radio_ack()
-            if data[0] != 0:
-                ackIn.ack = (data[0] & 0x01) != 0
-                ackIn.powerDet = (data[0] & 0x02) != 0
-                ackIn.retry = data[0] >> 4
-                ackIn.data = data[1:]
-            else:
-                ackIn.retry = self.arc
+            self._write(dataOut)
+            data = self._read()
+        except usb.USBError as e:
+            logger.warning("Crazyradio transfer failed: %s", e)
+
+        return self._parse_ack(data)
+
+    def send_packets(self, packets):
+        """ Send several packets and return the list of their acks, with
+            None for the packets that could not be transferred. The packets
+            are written by a second thread up to batch_window packets ahead
+            of the acks, so the USB round trips of the batch overlap. Once a
+            packet is not acked the packets not yet written are dropped and
+            get None, as they have to be sent again after it. After a failed
+            read the rest of the batch gets None, and the acks of the packets
+            already written are read and discarded. """
+        if len(packets) < 2 or self.batch_window < 2:
+            return [self.send_packet(p) for p in packets]
+
+        if self._writer is None:
+            self._writer = _BatchWriter(self._write, self.batch_window)
+            self._writer.start()
+        writer = self._writer
+        writer.cancel = False
+        for dataOut in packets:
+            writer.packets.put(dataOut)
+
+        acks = []
+        failed = False
+        # Set while the acks of the packets written after a failed read are
+        # read and discarded, so they are not taken for the answers to the
+        # next transfers
+        draining = False
+        for dataOut in packets:
+            data = None
+            if writer.results.get():
+                try:
+                    if draining:
+                        self._read()
+                    elif not failed:
+                        data = self._read()
+                except usb.USBError as e:
+                    if failed:
+                        # The dongle does not answer any more
+                        draining = False
+                    else:
+                        logger.warning("Crazyradio read failed: %s", e)
+                        failed = writer.cancel = True
+                        draining = True
+            writer.slots.release()
+            ack = self._parse_ack(data)
+            if ack is not None and not ack.ack:
+                writer.cancel = True
+            acks.append(ack)
+        return acks
+
+    def _write(self, dataOut):
+        if (pyusb1 is False):
+            self.handle.bulkWrite(1, dataOut, USB_TIMEOUT)
+        else:
+            self.handle.write(1, dataOut, 0, USB_TIMEOUT)
 
+    def _read(self):
+        if (pyusb1 is False):
+            return self.handle.bulkRead(0x81, 64, USB_TIMEOUT)
+        else:
+            return self.handle.read(0x81, 64, 0, USB_TIMEOUT)
+
+    def _parse_ack(self, data):
+        """ Return the ack of the USB data read from the dongle, or None """
+        if data is None:
+            return None
+
+        ackIn = _radio_ack()
+        if data[0] != 0:
+            ackIn.ack = (data[0] & 0x01) != 0
+            ackIn.powerDet = (data[0] & 0x02) != 0
+            ackIn.retry = data[0] >> 4
+            ackIn.data = data[1:]
+        else:
+            ackIn.retry = self.arc
         return ackIn
 
 
@@ -31,6 +31,27 @@ if __name__ == '__main__':
                         action="store_true",
                         dest="reset",
                         help="Reset saved session settings")
+    parser.add_argument("--scan-cache",
+                        action="store",
+                        dest="scan_cache",
+                        default="~/.ros/crazyflie_scan_cache.json",
+                        help="File remembering the flies found by the scans, so the startup scan finds them in milliseconds. Empty to disable.")
+    parser.add_argument("--scan-interval",
+                        action="store",
+                        dest="scan_interval",
+                        type=float,
+                        default=0,
+                        help="Interval (s) of the full scans done in the background while not connected. 0 to disable.")
+    parser.add_argument("--scan-all-dongles",
+                        action="store_true",
+                        dest="scan_all_dongles",
+                        help="Scan with every dongle that is not in use instead of only the one given with --radio. The other driver nodes' dongles are taken too, so only use this when a single driver node runs.")
+
+    parser.add_argument("--replay",
+                        action="append",
+                        dest="replay",
+                        default=[],
+                        help="Recording to offer in the connect list, as a file or a replay:// URI. Can be given several times.")
 
     (options, unused) = parser.parse_known_args()
 
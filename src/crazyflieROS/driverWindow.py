@@ -14,6 +14,8 @@ from rosTools import generateRosMessages, ROSNode
 from ui.driverGUI import Ui_MainWindow
 from ui.masterDialog import Ui_Dialog
 from cflib.crtp import scan_interfaces, init_drivers, get_interfaces_status
+from cflib.crtp.radiodriver import RadioDriver
+from cflib.crtp.replaydriver import ReplayDriver
 from functools import partial
 
 import rospy
@@ -45,7 +47,7 @@ class Message:
 class DriverWindow(QtGui.QMainWindow ):
     """ Main window and application """
 
-    sig_requestScan = pyqtSignal()
+    sig_requestScan = pyqtSignal(bool)
     sig_requestConnect = pyqtSignal(str)
     sig_requestDisconnect = pyqtSignal()
 
@@ -191,7 +193,7 @@ class DriverWindow(QtGui.QMainWindow ):
 
 
         # Set up URI scanner
-        self.scanner = ScannerThread(radio=options.radio)
+        self.scanner = ScannerThread()
         self.scanner.start()
 
 
@@ -240,19 +242,26 @@ class DriverWindow(QtGui.QMainWindow ):
 
         # Connections Within
         self.scanner.sig_foundURI.connect(self.receiveScanURI)
+        self.scanner.sig_scanURI.connect(self.receivePartialScanURI)
         self.sig_requestScan.connect(self.scanner.scan)
         self.sig_requestConnect.connect(self.flie.requestConnect)
         self.sig_requestDisconnect.connect(self.flie.requestDisconnect)
         self.flie.sig_stateUpdate.connect(self.updateFlieState)
         self.flie.sig_console.connect(self.ui.console.insertPlainText)
+        self.flie.sig_consoleLines.connect(self.ros.publishConsole)
 
 
         # Show window
         self.show()
 
-        # Initiate an initial Scan
+        # Initiate an initial Scan, of the flies found before if there are any
         init_drivers(enable_debug_driver=False)
-        self.startScanURI()
+        if options.scan_cache:
+            RadioDriver.scan_cache.load(os.path.expanduser(options.scan_cache))
+        RadioDriver.background_scan_interval = options.scan_interval
+        RadioDriver.scan_dongles = None if options.scan_all_dongles else (max(0, options.radio),)
+        ReplayDriver.recordings = [r if r.startswith("replay://") else "replay://"+os.path.abspath(os.path.expanduser(r)) for r in options.replay]
+        self.startScanURI(quick=True)
 
 
 
@@ -462,10 +471,11 @@ class DriverWindow(QtGui.QMainWindow ):
         pb.setValue(hz)
 
 
-    def startScanURI(self):
+    def startScanURI(self, quick=False):
         """ User Clicked Scan
             Remove all previously found URIs from dropdown
             Disable rescanning
+            A quick scan only looks for the flies found before
         """
         self.ui.comboBox_connect.clear()
 
@@ -473,11 +483,27 @@ class DriverWindow(QtGui.QMainWindow ):
         self.ui.pushButton_connect.setDisabled(True)
 
         #self.scanner.sig_requestScan.emit()
-        self.sig_requestScan.emit()
+        self.sig_requestScan.emit(quick)
 
 
 
 
+    def addScanURI(self, uri):
+        """ Add a found URI to the dropdown, unless it is already there """
+        text = "%s - %s" % (uri[0], uri[1]) if len(uri[1]) > 0 else uri[0]
+        if self.ui.comboBox_connect.findText(text) < 0:
+            rescan = self.ui.comboBox_connect.findText("Rescan")
+            if rescan < 0:
+                self.ui.comboBox_connect.addItem(text)
+            else:
+                self.ui.comboBox_connect.insertItem(rescan, text)
+
+    def receivePartialScanURI(self, uri):
+        """ A URI found while the scan is still running
+            Show it in the dropdown straight away
+        """
+        self.addScanURI(uri)
+
     def receiveScanURI(self, uri):
         """ Results from URI scan
             Add them to dropdown
@@ -491,10 +517,7 @@ class DriverWindow(QtGui.QMainWindow ):
 
         self.ui.pushButton_connect.setText('Connect')
         for i in uri:
-            if len(i[1]) > 0:
-                self.ui.comboBox_connect.addItem("%s - %s" % (i[0], i[1]))
-            else:
-                self.ui.comboBox_connect.addItem(i[0])
+            self.addScanURI(i)
 
         self.ui.comboBox_connect.addItem("Rescan")
 
@@ -643,18 +666,15 @@ class DriverWindow(QtGui.QMainWindow ):
 class ScannerThread(QThread):
     """ A thread dedicated to scanning the interfaces for crazyflie URIs. """
 
-    sig_foundURI = pyqtSignal(object)
-    def __init__(self, radio=0):
+    sig_foundURI = pyqtSignal(object) # All the URIs found, when the scan is done
+    sig_scanURI = pyqtSignal(object)  # Each URI as soon as it is found
+    def __init__(self):
         QThread.__init__(self)
-        self.radio = max(0,radio)
         self.moveToThread(self)
 
-    @pyqtSlot()
-    def scan(self):
-        interfaces = scan_interfaces()
-
-        for i in enumerate(interfaces):
-            interfaces[i[0]][0] = interfaces[i[0]][0].replace("radio://0", "radio://"+str(self.radio))
+    @pyqtSlot(bool)
+    def scan(self, quick=False):
+        interfaces = scan_interfaces(self.sig_scanURI.emit, quick)
         self.sig_foundURI.emit(interfaces)
 
 
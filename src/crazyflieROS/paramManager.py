@@ -4,8 +4,9 @@ __all__ = ['ParamManager']
 
 from PyQt4 import QtGui, uic
 from PyQt4.QtCore import Qt, pyqtSignal, pyqtSlot,  QVariant, QTimer
-from PyQt4.QtGui import  QTreeWidget, QTreeWidgetItem, QAbstractItemView
+from PyQt4.QtGui import  QTreeWidget, QTreeWidgetItem, QAbstractItemView, QAction, QFileDialog
 import rospy
+from cflib.crazyflie.param import save_snapshot, load_snapshot
 
 #import logging
 #logger = logging.getLogger(__name__)
@@ -89,7 +90,7 @@ class ParamItem(QTreeWidgetItem):
         """ Send new value to flie. Flie callback updates GUI """
         try:
             self.cf.param.set_value("%s.%s" % (self.param.group, self.param.name), value)
-        except NameError, err:
+        except ValueError, err:
             QtGui.QTreeWidgetItem.setData(self, 2, Qt.DisplayRole, QVariant("Invalid..."))
             rospy.logwarn("Parameter [%s.%s] could not be updated from [%s] to [%s]: %s ", self.param.group, self.param.name, self.text(2), value, err)
             self.requestUpdate()
@@ -149,6 +150,15 @@ class ParamManager(QTreeWidget):
         self.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.itemDoubleClicked.connect(self.userStartEdit)
 
+        # Snapshot actions in the context menu
+        self.setContextMenuPolicy(Qt.ActionsContextMenu)
+        saveAction = QAction("Save snapshot...", self)
+        saveAction.triggered.connect(self.saveSnapshot)
+        self.addAction(saveAction)
+        loadAction = QAction("Load snapshot...", self)
+        loadAction.triggered.connect(self.loadSnapshot)
+        self.addAction(loadAction)
+
     def userStartEdit(self, item, col):
         if col == 2:
             self.editItem(item, col)
@@ -181,7 +191,8 @@ class ParamManager(QTreeWidget):
         self.cf.param.add_update_callback(group="flightmode",  cb=self.hoverCB)
 
 
-        # Read TOC Values
+        # Read TOC Values, and log how long it took
+        self.cf.param.refresh_done.add_callback(self.refreshDoneCB)
         self.forceUpdate()
 
 
@@ -233,6 +244,8 @@ class ParamManager(QTreeWidget):
 
     def uppopulate(self, uri):
         self.cf.param.remove_update_callbacks()
+        if self.refreshDoneCB in self.cf.param.refresh_done.callbacks:
+            self.cf.param.refresh_done.remove_callback(self.refreshDoneCB)
         self.clear()
 
 
@@ -243,6 +256,43 @@ class ParamManager(QTreeWidget):
                 for p in g.getChildren():
                     p.requestUpdate()
 
+    def refreshDoneCB(self, answers, duration):
+        """ All the params requested when populating have been read, later refreshes are not logged """
+        self.cf.param.refresh_done.remove_callback(self.refreshDoneCB)
+        rospy.loginfo("Read %d params in %.0fms", answers, duration*1000)
+
+    def saveSnapshot(self):
+        """ Read all params from the flie and save them to a file """
+        if not self.cf.param.toc.toc:
+            rospy.logwarn("Cannot save a param snapshot, not connected")
+            return
+        filename = str(QFileDialog.getSaveFileName(self, "Save param snapshot", "", "Param snapshots (*.json)"))
+        if not filename:
+            return
+
+        def save(snapshot):
+            try:
+                save_snapshot(filename, snapshot)
+                rospy.loginfo("Saved %d params to [%s]", len(snapshot), filename)
+            except IOError as e:
+                rospy.logerr("Could not save param snapshot: %s", e)
+        self.cf.param.take_snapshot(save)
+
+    def loadSnapshot(self):
+        """ Write the params of a snapshot file that differ from the ones of the flie """
+        if not self.cf.param.toc.toc:
+            rospy.logwarn("Cannot load a param snapshot, not connected")
+            return
+        filename = str(QFileDialog.getOpenFileName(self, "Load param snapshot", "", "Param snapshots (*.json)"))
+        if not filename:
+            return
+        try:
+            snapshot = load_snapshot(filename)
+        except (IOError, ValueError) as e:
+            rospy.logerr("Could not load param snapshot: %s", e)
+            return
+        self.cf.param.restore_snapshot(snapshot, lambda changed: rospy.loginfo("Restored %d params from [%s] %s", len(changed), filename, ", ".join(changed)))
+
     def setWidths(self, ws):
         """ Set Column Widths """
         for i in range(min(len(ws), self.columnCount())):
@@ -14,6 +14,7 @@ from roslib.packages import get_pkg_dir
 roslib.load_manifest('crazyflieROS')
 from crazyflieROS import msg as msgCF
 from crazyflieROS.msg import cmd as cmdMSG
+from std_msgs.msg import String
 
 import tf
 
@@ -47,6 +48,7 @@ class ROSNode(QObject):
         # Publishers
         self.publishers   = {} #Generated publishers will go here
         self.pub_tf       = tf.TransformBroadcaster()
+        self.pub_console  = rospy.Publisher("/cf%d/console" % self.options.radio, String, queue_size=100)
 
         # Subscribers
         self.sub_tf    = tf.TransformListener()
@@ -113,6 +115,13 @@ class ROSNode(QObject):
 
 
 
+    @pyqtSlot(object)
+    def publishConsole(self, lines):
+        """ Publish a batch of console lines from the flie, one message per line """
+        for line in lines:
+            self.pub_console.publish(line)
+
+
     @pyqtSlot(object, int, object)
     def receiveCrazyflieLog(self, log, tsCF, tsROS):
         """ Handle sending messages to ROS """